@@ -1,6 +1,9 @@
 import argparse
 
-def setup_argparse():
+def setup_argparse(argv=None, **defaults):
+	r"""
+	Options of a training run, parsed from argv (Default: sys.argv), with the defaults of the entry point overridden by defaults
+	"""
 	### Data 
 	parser = argparse.ArgumentParser(description='Configurations for Survival Analysis on TCGA Data.')
 	parser.add_argument('--run_name',      type=str, default='run')
@@ -28,7 +31,7 @@ def setup_argparse():
 
 	parser.add_argument('--model_type',      type=str, choices=['deepset', 'amil', 'mcat', "motcat", "porpoise", "deepattnmisl", "cmta"], default='porpoise', help='Type of model (Default: porpoise)')
 	parser.add_argument('--mode',            type=str, choices=['omic', 'path', 'pathomic', 'cluster', 'coattn'], default='pathomic', help='Specifies which modalities to use / collate function in dataloader.')
-	parser.add_argument('--fusion',          type=str, choices=['None', 'concat', 'bilinear'], default='bilinear', help='Type of fusion. (Default: bilinear).')
+	parser.add_argument('--fusion',          type=str, choices=['None', 'concat', 'bilinear', 'lrb'], default='bilinear', help='Type of fusion, lrb is a low-rank bilinear fusion. (Default: bilinear).')
 	parser.add_argument('--apply_sig',		 action='store_true', default=False, help='Use genomic features as signature embeddings.')
 	parser.add_argument('--apply_sigfeats',  action='store_true', default=False, help='Use genomic features as tabular features.')
 	parser.add_argument('--drop_out',        action='store_true', default=True, help='Enable dropout (p=0.25)')
@@ -37,9 +40,23 @@ def setup_argparse():
 
 	# MOTCAT Parameters
 	parser.add_argument('--bs_micro', type=int, default=256, help='The Size of Micro-batch (Default: 256)')  # new
-	parser.add_argument('--ot_impl', type=str, default='pot-uot-l2', help='impl of ot (default: pot-uot-l2)')  # new
+	parser.add_argument('--ot_impl', type=str, default='pot-uot-l2', choices=['pot-uot-l2', 'pot-sinkhorn-l2', 'torch-uot-l2', 'torch-sinkhorn-l2'], help='impl of ot, the torch solvers give the plans of POT batched on the device of the model (default: pot-uot-l2)')  # new
 	parser.add_argument('--ot_reg', type=float, default=0.1, help='epsilon of OT (default: 0.1)')
 	parser.add_argument('--ot_tau', type=float, default=0.5, help='tau of UOT (default: 0.5)')
+	parser.add_argument('--ot_fp32', action='store_true', default=False, help='Solve the OT of the torch solvers in float32 instead of float64')
+	parser.add_argument('--ot_cache_size', type=int, default=0, help='Number of patients whose Sinkhorn scalings are cached to warm-start the torch OT solvers of the next epochs (Default: 0, off)')
+	parser.add_argument('--attn_chunk_size', type=int, default=0, help='Path instances attended per chunk by the co-attention of mcat and cmta, with an online softmax that bounds its memory (Default: 0, all at once)')
+	parser.add_argument('--stream_chunk_size', type=int, default=0, help='Evaluate deepset, amil and porpoise on bags read from the store this many instances at a time, with memory independent of the bag size (Default: 0, whole bags)')
+	parser.add_argument('--merge_ratio', type=float, default=0.0, help='Fraction of the patch tokens merged by bipartite matching between the layers of the pathomics transformers of cmta, at most 0.5 (Default: 0, no merging)')
+	parser.add_argument('--landmark_budget', type=int, default=0, help='Size (tokens x landmarks) of the Nystrom attention of cmta, its landmarks are then chosen from the bag length instead of fixed to 128 (Default: 0, fixed)')
+	parser.add_argument('--topk_instances', type=int, default=0, help='Train amil, porpoise and deepattnmisl with the backward through the top-k patches by attention and --random_instances others of each bag only, the forward over the whole bag (Default: 0, all patches)')
+	parser.add_argument('--random_instances', type=int, default=64, help='Patches drawn at random besides the top-k, with --topk_instances (Default: 64)')
+	parser.add_argument('--patch_budget', type=int, default=0, help='Train amil and porpoise on at most this many patches per bag, drawn from the attention the patches had in the previous epochs (Default: 0, whole bags)')
+	parser.add_argument('--patch_explore', type=float, default=0.25, help='Fraction of --patch_budget drawn at random instead of by attention (Default: 0.25)')
+	parser.add_argument('--teacher_dir', type=str, default=None, help='Results directory of a trained mcat, motcat or cmta whose outputs supervise the deepset, amil or porpoise being trained, cached there once per fold (Default: None, no distillation)')
+	parser.add_argument('--teacher_ckpt', type=str, default='s_{}_checkpoint.pt', help='Checkpoint of the teacher in --teacher_dir, {} is the fold (Default: s_{}_checkpoint.pt)')
+	parser.add_argument('--distill_weight', type=float, default=0.5, help='Weight of the teacher hazards against the survival loss (Default: 0.5)')
+	parser.add_argument('--distill_attention', type=float, default=0.0, help='Weight of the KL divergence of the attention of amil or porpoise to the co-attention of an mcat or motcat teacher (Default: 0, off)')
 
 	# PORPOISE Parameters
 	parser.add_argument('--gate_path', action='store_true', default=False)
@@ -50,9 +67,23 @@ def setup_argparse():
 	parser.add_argument('--dropinput', type=float, default=0.0)
 	parser.add_argument('--use_mlp', action='store_true', default=False)
 
+	# Coreset Parameters
+	parser.add_argument('--coreset_weights', action='store_true', default=False, help='Weight the instances of a coreset bag by the number of patches they represent (deepset, amil, porpoise)')
+
+	# Execution Parameters
+	parser.add_argument('--precision', type=str, choices=['fp32', 'bf16'], default='fp32', help='Precision of the forward passes, bf16 autocasts the matmuls to bfloat16 while the survival head, losses, Sinkhorn and Moore-Penrose iterations stay in float32 (Default: fp32)')
+	parser.add_argument('--compile', action='store_true', default=False, help='Compile the model and the loss with torch.compile, the bags of deepset, amil, porpoise and mcat are padded to bucket lengths (masked) to limit the recompilations')
+	parser.add_argument('--compile_buckets', type=str, default='', help='Comma separated bucket lengths of --compile (Default: powers of two from 512)')
+	parser.add_argument('--checkpoint_activations', type=str, nargs='?', const='default', default=None, help='Recompute the activations of these comma separated submodules in the backward instead of keeping them, the default blocks of the model if given without value (see benchmark_checkpointing.py)')
+	parser.add_argument('--num_workers', type=int, default=-1, help='DataLoader worker processes (Default: -1, 4 on cuda and 0 on cpu)')
+	parser.add_argument('--num_threads', type=int, default=0, help='Intra-op threads of torch (Default: 0, torch default or the compute cores left by --pin_workers)')
+	parser.add_argument('--num_interop_threads', type=int, default=0, help='Inter-op threads of torch (Default: 0, torch default)')
+	parser.add_argument('--pin_workers', action='store_true', default=False, help='Pin the DataLoader workers to their own cores, away from the compute threads')
+
 	### Optimizer Parameters + Survival Loss Function
 	parser.add_argument('--opt',             type=str, choices = ['adam', 'sgd'], default='adam')
-	parser.add_argument('--batch_size',      type=int, default=1, help='Batch Size (Default: 1, due to varying bag sizes)')
+	parser.add_argument('--batch_size',      type=int, default=1, help='Batch Size (Default: 1). deepset, amil and porpoise concatenate the bags of a batch, mcat, motcat and cmta pad them')
+	parser.add_argument('--max_padding',     type=float, default=0.25, help='Maximum fraction of padded instances in a batch of mcat, motcat and cmta (Default: 0.25)')
 	parser.add_argument('--gc',              type=int, default=32, help='Gradient Accumulation Step.')
 	parser.add_argument('--max_epochs',      type=int, default=20, help='Maximum number of epochs to train (default: 20)')
 	parser.add_argument('--lr',				 type=float, default=2e-4, help='Learning rate (default: 0.0001)')
@@ -65,5 +96,8 @@ def setup_argparse():
 	parser.add_argument('--weighted_sample', action='store_true', default=True, help='Enable weighted sampling')
 	parser.add_argument('--early_stopping',  type=int, default=20, help='Enable early stopping')
 
-	args = parser.parse_args()
+	parser.set_defaults(**defaults)
+	args = parser.parse_args(argv)
+	if not 0 <= args.patch_explore <= 1:
+		parser.error('--patch_explore is a fraction of --patch_budget, between 0 and 1')
 	return args
\ No newline at end of file
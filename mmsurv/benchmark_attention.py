@@ -0,0 +1,75 @@
+import argparse
+from timeit import default_timer as timer
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+
+from mmsurv.models.model_utils import Attn_Net_Gated
+
+device=torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def setup_argparse():
+	parser = argparse.ArgumentParser(description='Patch throughput of the gated attention, fused against two branches.')
+	parser.add_argument('--L', type=int, default=512, help='Input dimension (Default: 512)')
+	parser.add_argument('--D', type=int, default=256, help='Hidden dimension (Default: 256)')
+	parser.add_argument('--bag_sizes', type=str, default='1000,10000,100000', help='Comma separated numbers of patches (Default: 1000,10000,100000)')
+	parser.add_argument('--n_repeats', type=int, default=10, help='Timed passes (Default: 10)')
+	parser.add_argument('--threads', type=int, default=None, help='CPU threads (Default: torch default)')
+	parser.add_argument('--out_csv', type=str, default=None)
+	return parser.parse_args()
+
+
+def two_branch(attn, x):
+	r"""
+	Gated attention with separate tanh and sigmoid projections, as before the fused Linear(L, 2D)
+	"""
+	weight_a, weight_b = [w.contiguous() for w in attn.attention_ab.weight.split(attn.D)]
+	bias_a, bias_b = attn.attention_ab.bias.split(attn.D)
+	a = attn.dropout(torch.tanh(F.linear(x, weight_a, bias_a)))
+	b = attn.dropout(torch.sigmoid(F.linear(x, weight_b, bias_b)))
+	return attn.attention_c(a.mul(b)), x
+
+
+def throughput(fn, x, training, n_repeats):
+	r"""
+	Patches per second of a forward pass (inference) or a forward and backward pass (training), median over the passes
+	"""
+	def step():
+		if training:
+			fn(x)[0].sum().backward()
+		else:
+			with torch.no_grad():
+				fn(x)
+	step()
+	times = []
+	for _ in range(n_repeats):
+		if device.type == 'cuda':
+			torch.cuda.synchronize()
+		start = timer()
+		step()
+		if device.type == 'cuda':
+			torch.cuda.synchronize()
+		times.append(timer() - start)
+	return x.shape[0] / float(np.median(times))
+
+
+if __name__ == "__main__":
+	args = setup_argparse()
+	if args.threads:
+		torch.set_num_threads(args.threads)
+	attn = Attn_Net_Gated(L=args.L, D=args.D, dropout=True, n_classes=1).to(device)
+	results = []
+	for bag_size in [int(n) for n in args.bag_sizes.split(',')]:
+		x = torch.randn(bag_size, args.L, device=device)
+		for training in [False, True]:
+			attn.train(training)
+			fused = throughput(attn, x, training, args.n_repeats)
+			unfused = throughput(lambda x: two_branch(attn, x), x, training, args.n_repeats)
+			results.append({'bag_size': bag_size, 'pass': 'train' if training else 'inference', 'two_branch_patches_per_s': unfused, 'fused_patches_per_s': fused, 'speedup': fused / unfused})
+
+	results = pd.DataFrame(results)
+	print(results.to_string(index=False))
+	if args.out_csv:
+		results.to_csv(args.out_csv, index=False)
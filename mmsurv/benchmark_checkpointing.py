@@ -0,0 +1,110 @@
+import argparse
+import copy
+from timeit import default_timer as timer
+import numpy as np
+import pandas as pd
+import torch
+
+from mmsurv.models.model_set_mil import MIL_Sum_FC_surv, MIL_Attention_FC_surv
+from mmsurv.models.model_coattn import MCAT_Surv
+from mmsurv.models.model_motcat import MOTCAT_Surv
+from mmsurv.models.model_porpoise import PorpoiseMMF
+from mmsurv.models.model_cmta import CMTA
+from mmsurv.models.model_utils import checkpoint_activations
+
+device=torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def setup_argparse():
+	parser = argparse.ArgumentParser(description='Memory against step time of activation checkpointing, per model and block.')
+	parser.add_argument('--model_types', type=str, default='deepset,amil,porpoise,mcat,motcat,cmta', help='Comma separated models (Default: deepset,amil,porpoise,mcat,motcat,cmta)')
+	parser.add_argument('--bag_sizes', type=str, default='1000,5000', help='Comma separated numbers of patches (Default: 1000,5000)')
+	parser.add_argument('--path_input_dim', type=int, default=1024, help='Dimension of the patch features (Default: 1024)')
+	parser.add_argument('--omic_sizes', type=str, default='100,200,300,400,500,600', help='Comma separated signature sizes, concatenated for deepset, amil and porpoise (Default: 100,200,300,400,500,600)')
+	parser.add_argument('--n_repeats', type=int, default=3, help='Timed training steps (Default: 3)')
+	parser.add_argument('--out_csv', type=str, default=None)
+	return parser.parse_args()
+
+
+def build_model(model_type, path_input_dim, omic_sizes):
+	if model_type == 'deepset':
+		return MIL_Sum_FC_surv(path_input_dim=path_input_dim, omic_input_dim=sum(omic_sizes), fusion='concat')
+	elif model_type == 'amil':
+		return MIL_Attention_FC_surv(path_input_dim=path_input_dim, omic_input_dim=sum(omic_sizes), fusion='concat')
+	elif model_type == 'porpoise':
+		return PorpoiseMMF(omic_input_dim=sum(omic_sizes), path_input_dim=path_input_dim, fusion='concat')
+	elif model_type == 'mcat':
+		return MCAT_Surv(path_input_dim=path_input_dim, omic_sizes=omic_sizes, fusion='concat')
+	elif model_type == 'motcat':
+		return MOTCAT_Surv(path_input_dim=path_input_dim, omic_sizes=omic_sizes, fusion='concat')
+	elif model_type == 'cmta':
+		return CMTA(path_input_dim=path_input_dim, omic_input_dim=omic_sizes, fusion='concat')
+	raise NotImplementedError
+
+
+def train_step(model, inputs):
+	r"""
+	Forward and backward pass, returns the bytes of the activations kept for the backward (outside the checkpointed
+	blocks, parameters excluded) and the peak memory of the step (cuda only)
+	"""
+	params = {p.untyped_storage().data_ptr() for p in model.parameters()}
+	saved = {}
+	def pack(t):
+		storage = t.untyped_storage()
+		if storage.data_ptr() not in params:
+			saved[storage.data_ptr()] = storage.nbytes()
+		return t
+
+	model.zero_grad()
+	if device.type == 'cuda':
+		torch.cuda.synchronize()
+		torch.cuda.reset_peak_memory_stats()
+	with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+		hazards = model(**inputs)[0]
+	hazards.sum().backward()
+	peak = torch.cuda.max_memory_allocated() if device.type == 'cuda' else float('nan')
+	return sum(saved.values()), peak
+
+
+def benchmark(model, inputs, n_repeats):
+	saved, peak = train_step(model, inputs)
+	times = []
+	for _ in range(n_repeats):
+		if device.type == 'cuda':
+			torch.cuda.synchronize()
+		start = timer()
+		train_step(model, inputs)
+		if device.type == 'cuda':
+			torch.cuda.synchronize()
+		times.append(timer() - start)
+	return {'saved_MB': saved / 2**20, 'peak_MB': peak / 2**20, 'step_ms': float(np.median(times)) * 1e3}
+
+
+if __name__ == "__main__":
+	args = setup_argparse()
+	omic_sizes = [int(s) for s in args.omic_sizes.split(',')]
+	results = []
+	for model_type in args.model_types.split(','):
+		model = build_model(model_type, args.path_input_dim, omic_sizes).to(device).train()
+		# no checkpointing, each default block on its own, then all of them
+		configs = [('none', [])] + [(block, [block]) for block in model.checkpoint_blocks]
+		if len(model.checkpoint_blocks) > 1:
+			configs.append(('default', model.checkpoint_blocks))
+		for bag_size in [int(n) for n in args.bag_sizes.split(',')]:
+			inputs = {'x_path': torch.randn(bag_size, args.path_input_dim, device=device)}
+			if model_type in ['deepset', 'amil', 'porpoise']:
+				inputs['x_omic'] = torch.randn(sum(omic_sizes), device=device)
+			else:
+				inputs.update({'x_omic%d' % (i+1): torch.randn(size, device=device) for i, size in enumerate(omic_sizes)})
+			baseline = None
+			for name, blocks in configs:
+				result = benchmark(checkpoint_activations(copy.deepcopy(model), blocks), inputs, args.n_repeats)
+				baseline = baseline or result
+				results.append({'model_type': model_type, 'bag_size': bag_size, 'checkpointed': name, **result,
+					'memory_ratio': result['saved_MB'] / baseline['saved_MB'], 'time_ratio': result['step_ms'] / baseline['step_ms']})
+				print(results[-1])
+
+	results = pd.DataFrame(results)
+	print(results.to_string(index=False))
+	if args.out_csv:
+		results.to_csv(args.out_csv, index=False)
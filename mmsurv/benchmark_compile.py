@@ -0,0 +1,81 @@
+import argparse
+import copy
+from timeit import default_timer as timer
+import numpy as np
+import pandas as pd
+import torch
+
+from mmsurv.benchmark_checkpointing import build_model
+from mmsurv.utils.utils import compile_stats
+
+device=torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def setup_argparse():
+	parser = argparse.ArgumentParser(description='Step time of the compiled model against eager mode, per model and bucket length.')
+	parser.add_argument('--model_types', type=str, default='deepset,amil,porpoise,mcat', help='Comma separated models (Default: deepset,amil,porpoise,mcat)')
+	parser.add_argument('--bag_sizes', type=str, default='512,1024,2048,4096', help='Comma separated bucket lengths (Default: 512,1024,2048,4096)')
+	parser.add_argument('--path_input_dim', type=int, default=1024, help='Dimension of the patch features (Default: 1024)')
+	parser.add_argument('--omic_sizes', type=str, default='100,200,300,400,500,600', help='Comma separated signature sizes, concatenated for deepset, amil and porpoise (Default: 100,200,300,400,500,600)')
+	parser.add_argument('--n_repeats', type=int, default=10, help='Timed steps per bucket (Default: 10)')
+	parser.add_argument('--out_csv', type=str, default=None)
+	return parser.parse_args()
+
+
+def padded_inputs(model_type, bag_size, path_input_dim, omic_sizes):
+	r"""
+	A bag padded to bag_size as the training loop passes it, the last quarter of it padding
+	"""
+	n = bag_size - bag_size // 4
+	x_path = torch.randn(bag_size, path_input_dim, device=device)
+	if model_type == 'mcat':
+		mask = (torch.arange(bag_size, device=device) >= n).unsqueeze(0)
+		return {'x_path': x_path.unsqueeze(0), 'mask': mask, **{'x_omic%d' % (i+1): torch.randn(1, size, device=device) for i, size in enumerate(omic_sizes)}}
+	weights = (torch.arange(bag_size, device=device) < n).float()
+	return {'x_path': x_path, 'x_omic': torch.randn(1, sum(omic_sizes), device=device), 'x_weight': weights, 'bag_offsets': torch.tensor([0, bag_size], device=device)}
+
+
+def step_time(model, inputs, training, n_repeats):
+	r"""
+	Time of the first step (with the compilation) and median time of the next ones, of a training step (forward and backward) or of inference
+	"""
+	model.train(training)
+	def step():
+		with torch.set_grad_enabled(training):
+			hazards = model(**inputs)[0]
+		if training:
+			hazards.sum().backward()
+		if device.type == 'cuda':
+			torch.cuda.synchronize()
+	start = timer()
+	step()
+	first = timer() - start
+	times = []
+	for _ in range(n_repeats):
+		start = timer()
+		step()
+		times.append(timer() - start)
+	return first, float(np.median(times))
+
+
+if __name__ == "__main__":
+	args = setup_argparse()
+	omic_sizes = [int(s) for s in args.omic_sizes.split(',')]
+	results = []
+	for model_type in args.model_types.split(','):
+		eager = build_model(model_type, args.path_input_dim, omic_sizes).to(device)
+		compiled = copy.deepcopy(eager)
+		compiled.compile()
+		for bag_size in [int(n) for n in args.bag_sizes.split(',')]:
+			inputs = padded_inputs(model_type, bag_size, args.path_input_dim, omic_sizes)
+			for training in [True, False]:
+				_, eager_time = step_time(eager, inputs, training, args.n_repeats)
+				compile_time, compiled_time = step_time(compiled, inputs, training, args.n_repeats)
+				results.append({'model_type': model_type, 'bucket': bag_size, 'pass': 'train' if training else 'inference', 'eager_ms': eager_time * 1e3, 'compiled_ms': compiled_time * 1e3,
+					'speedup': eager_time / compiled_time, 'first_step_s': compile_time, **compile_stats()})
+				print(results[-1])
+
+	results = pd.DataFrame(results)
+	print(results.to_string(index=False))
+	if args.out_csv:
+		results.to_csv(args.out_csv, index=False)
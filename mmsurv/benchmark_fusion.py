@@ -0,0 +1,60 @@
+import argparse
+from timeit import default_timer as timer
+import pandas as pd
+import torch
+
+from mmsurv.models.model_utils import BilinearFusion, LRBilinearFusion
+
+device=torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def setup_argparse():
+	parser = argparse.ArgumentParser(description='Memory and latency of the dense and low-rank bilinear fusions.')
+	parser.add_argument('--dim', type=int, default=256, help='Dimension of both modalities (Default: 256)')
+	parser.add_argument('--scale_dims', type=str, default='1,8', help='Comma separated reductions of the modalities before the fusion (Default: 1,8)')
+	parser.add_argument('--rank', type=int, default=16, help='Rank of the low-rank fusion (Default: 16)')
+	parser.add_argument('--batch_size', type=int, default=1, help='Patients per forward pass (Default: 1)')
+	parser.add_argument('--n_repeats', type=int, default=50, help='Timed forward and backward passes (Default: 50)')
+	parser.add_argument('--out_csv', type=str, default=None)
+	return parser.parse_args()
+
+
+def benchmark(fusion, args):
+	r"""
+	Parameters, their memory, the peak memory (cuda only) and the latency of a forward and backward pass
+	"""
+	vec1 = torch.randn(args.batch_size, args.dim, device=device)
+	vec2 = torch.randn(args.batch_size, args.dim, device=device)
+	n_params = sum(p.numel() for p in fusion.parameters())
+	fusion(vec1, vec2).sum().backward()
+	if device.type == 'cuda':
+		torch.cuda.synchronize()
+		torch.cuda.reset_peak_memory_stats()
+	start = timer()
+	for _ in range(args.n_repeats):
+		fusion.zero_grad()
+		fusion(vec1, vec2).sum().backward()
+	if device.type == 'cuda':
+		torch.cuda.synchronize()
+	latency = (timer() - start) / args.n_repeats
+	peak = torch.cuda.max_memory_allocated() / 2**20 if device.type == 'cuda' else float('nan')
+	return {'params_M': n_params / 1e6, 'params_MB': n_params * 4 / 2**20, 'peak_MB': peak, 'latency_ms': latency * 1e3}
+
+
+if __name__ == "__main__":
+	args = setup_argparse()
+	results = []
+	for scale_dim in [int(s) for s in args.scale_dims.split(',')]:
+		for name, fusion in [
+			('bilinear', BilinearFusion(dim1=args.dim, dim2=args.dim, scale_dim1=scale_dim, scale_dim2=scale_dim, mmhid=256)),
+			('lrb', LRBilinearFusion(dim1=args.dim, dim2=args.dim, scale_dim1=scale_dim, scale_dim2=scale_dim, mmhid=256, rank=args.rank)),
+		]:
+			results.append({'fusion': name, 'scale_dim': scale_dim, **benchmark(fusion.to(device), args)})
+			del fusion
+			if device.type == 'cuda':
+				torch.cuda.empty_cache()
+
+	results = pd.DataFrame(results)
+	print(results.to_string(index=False))
+	if args.out_csv:
+		results.to_csv(args.out_csv, index=False)
@@ -0,0 +1,69 @@
+import argparse
+import copy
+import os
+from timeit import default_timer as timer
+import pandas as pd
+import torch
+
+from mmsurv.arguments import setup_argparse as setup_argparse_training
+from mmsurv.main import run
+from mmsurv.models.model_cmta import CMTA
+
+device=torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def setup_argparse():
+	r"""
+	Benchmark options, every other option is passed on to the training (see arguments.py)
+	"""
+	parser = argparse.ArgumentParser(description='Throughput versus c-index of cmta at several token merging ratios.')
+	parser.add_argument('--merge_ratios', type=str, default='0,0.25,0.5', help='Comma separated merging ratios (Default: 0,0.25,0.5)')
+	parser.add_argument('--bag_sizes', type=str, default='1000,10000', help='Comma separated bag sizes of the throughput measurement (Default: 1000,10000)')
+	parser.add_argument('--n_repeats', type=int, default=5, help='Timed forward passes per bag size (Default: 5)')
+	bench_args, rest = parser.parse_known_args()
+	return bench_args, setup_argparse_training(rest + ['--model_type', 'cmta'])
+
+
+def throughput(args, merge_ratio, bag_size, n_repeats):
+	r"""
+	Bags per second of inference of cmta on random bags of bag_size instances
+	"""
+	model = CMTA(path_input_dim=args.path_input_dim, omic_input_dim=args.omic_sizes, fusion=args.fusion, n_classes=args.n_classes, merge_ratio=merge_ratio).to(device).eval()
+	x_path = torch.randn(bag_size, args.path_input_dim, device=device)
+	x_omic = {'x_omic%d' % (i+1): torch.randn(size, device=device) for i, size in enumerate(args.omic_sizes)}
+	with torch.no_grad():
+		model(x_path=x_path, **x_omic)
+		if device.type == 'cuda':
+			torch.cuda.synchronize()
+		start = timer()
+		for _ in range(n_repeats):
+			model(x_path=x_path, **x_omic)
+		if device.type == 'cuda':
+			torch.cuda.synchronize()
+	return n_repeats / (timer() - start)
+
+
+if __name__ == "__main__":
+	bench_args, args = setup_argparse()
+	merge_ratios = [float(r) for r in bench_args.merge_ratios.split(',')]
+	bag_sizes = [int(n) for n in bench_args.bag_sizes.split(',')]
+
+	results = []
+	for merge_ratio in merge_ratios:
+		run_args = copy.deepcopy(args)
+		run_args.merge_ratio = merge_ratio
+		run_args.run_name = '{}_merge{}'.format(args.run_name, merge_ratio)
+		start = timer()
+		run(run_args)
+		train_time = timer() - start
+
+		summary = pd.read_csv(os.path.join(run_args.results_dir, 'summary_latest.csv'))
+		result = {'merge_ratio': merge_ratio, 'val_cindex': summary['val_cindex'].mean(), 'test_cindex': summary['test_cindex'].mean(), 'train_time': train_time}
+		for bag_size in bag_sizes:
+			result['bags_per_s_{}'.format(bag_size)] = throughput(run_args, merge_ratio, bag_size, bench_args.n_repeats)
+		results.append(result)
+
+	results = pd.DataFrame(results)
+	print(results.to_string(index=False))
+	os.makedirs(args.results_dir, exist_ok=True)
+	results.to_csv(os.path.join(args.results_dir, 'benchmark_merging_{}.csv'.format(args.data_name)), index=False)
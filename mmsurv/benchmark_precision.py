@@ -0,0 +1,91 @@
+import argparse
+import copy
+import os
+from timeit import default_timer as timer
+import numpy as np
+import pandas as pd
+import torch
+
+from mmsurv.arguments import setup_argparse as setup_argparse_training
+from mmsurv.main import run
+from mmsurv.utils.core_utils import init_model
+from mmsurv.utils.utils import get_autocast
+
+device=torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def setup_argparse():
+	r"""
+	Benchmark options, every other option is passed on to the training (see arguments.py)
+	"""
+	parser = argparse.ArgumentParser(description='Throughput and c-index of bf16 autocast against fp32.')
+	parser.add_argument('--bag_sizes', type=str, default='1000,10000', help='Comma separated bag sizes of the throughput measurement (Default: 1000,10000)')
+	parser.add_argument('--n_repeats', type=int, default=5, help='Timed passes per bag size (Default: 5)')
+	bench_args, rest = parser.parse_known_args()
+	return bench_args, setup_argparse_training(rest)
+
+
+def random_inputs(args, bag_size, model):
+	x_path = torch.randn(bag_size, args.path_input_dim, device=device)
+	if args.model_type in ['mcat', 'motcat', 'cmta']:
+		return {'x_path': x_path, **{'x_omic%d' % (i+1): torch.randn(size, device=device) for i, size in enumerate(args.omic_sizes)}}
+	elif args.model_type in ['deepset', 'amil', 'porpoise']:
+		return {'x_path': x_path, 'x_omic': torch.randn(args.omic_sizes, device=device)}
+	elif args.model_type == 'deepattnmisl':
+		# patches spread at random over the clusters of the model
+		return {'x_path': x_path, 'cluster_id': torch.randint(model.num_clusters, (bag_size,), device=device), 'x_omic': torch.randn(args.omic_sizes, device=device)}
+	raise NotImplementedError
+
+
+def throughput(model, inputs, precision, training, n_repeats):
+	r"""
+	Patches per second of inference or of a training step (forward and backward), median over the passes
+	"""
+	model.train(training)
+	def step():
+		with torch.set_grad_enabled(training), get_autocast(precision):
+			hazards = model(**inputs)[0]
+		if training:
+			hazards.sum().backward()
+	step()
+	times = []
+	for _ in range(n_repeats):
+		if device.type == 'cuda':
+			torch.cuda.synchronize()
+		start = timer()
+		step()
+		if device.type == 'cuda':
+			torch.cuda.synchronize()
+		times.append(timer() - start)
+	return inputs['x_path'].shape[0] / float(np.median(times))
+
+
+if __name__ == "__main__":
+	bench_args, args = setup_argparse()
+	bag_sizes = [int(n) for n in bench_args.bag_sizes.split(',')]
+
+	results = []
+	for precision in ['fp32', 'bf16']:
+		run_args = copy.deepcopy(args)
+		run_args.precision = precision
+		run_args.run_name = '{}_{}'.format(args.run_name, precision)
+		start = timer()
+		run(run_args)
+		train_time = timer() - start
+
+		summary = pd.read_csv(os.path.join(run_args.results_dir, 'summary_latest.csv'))
+		result = {'precision': precision, 'val_cindex': summary['val_cindex'].mean(), 'test_cindex': summary['test_cindex'].mean(), 'train_time': train_time}
+		model = init_model(run_args).to(device)
+		for bag_size in bag_sizes:
+			inputs = random_inputs(run_args, bag_size, model)
+			result['train_patches_per_s_{}'.format(bag_size)] = throughput(model, inputs, precision, True, bench_args.n_repeats)
+			result['eval_patches_per_s_{}'.format(bag_size)] = throughput(model, inputs, precision, False, bench_args.n_repeats)
+		results.append(result)
+
+	# bf16 against fp32: differences of the c-indices, ratios of the times and throughputs
+	fp32, bf16 = results
+	results.append({'precision': 'bf16 vs fp32', **{k: bf16[k] - fp32[k] if 'cindex' in k else bf16[k] / fp32[k] for k in fp32 if k != 'precision'}})
+	results = pd.DataFrame(results)
+	print(results.to_string(index=False))
+	os.makedirs(args.results_dir, exist_ok=True)
+	results.to_csv(os.path.join(args.results_dir, 'benchmark_precision_{}.csv'.format(args.data_name)), index=False)
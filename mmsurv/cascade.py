@@ -0,0 +1,114 @@
+import argparse
+import json
+import os
+from timeit import default_timer as timer
+import numpy as np
+import pandas as pd
+from scipy.stats import kendalltau, spearmanr
+import torch
+
+from mmsurv.main import load_trained
+from mmsurv.utils.core_utils import init_loss, loop_survival
+from mmsurv.utils.utils import get_split_loader
+
+device=torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def setup_argparse():
+	parser = argparse.ArgumentParser(description='Two-stage inference: a cheap attention model screens every patch, the co-attention model runs on the top-k patches only.')
+	parser.add_argument('--screen_dir', type=str, required=True, help='Results directory of the screening model, amil or porpoise (its experiment.json and checkpoints)')
+	parser.add_argument('--model_dir', type=str, required=True, help='Results directory of the expensive model, mcat, motcat or cmta')
+	parser.add_argument('--screen_ckpt', type=str, default='s_{}_checkpoint.pt', help='Checkpoint of the screening model in --screen_dir, {} is the fold (Default: s_{}_checkpoint.pt)')
+	parser.add_argument('--model_ckpt', type=str, default='s_{}_checkpoint.pt', help='Checkpoint of the expensive model in --model_dir, {} is the fold (Default: s_{}_checkpoint.pt)')
+	parser.add_argument('--top_k', type=int, default=512, help='Patches of highest screening attention passed on to the expensive model, per patient (Default: 512)')
+	parser.add_argument('--chunk_size', type=int, default=4096, help='Patches screened at a time, read from the memory-mapped features (Default: 4096)')
+	parser.add_argument('--split', type=str, default='test', choices=['val', 'test'], help='Split to score (Default: test)')
+	parser.add_argument('--folds', type=str, default=None, help='Comma separated folds (Default: all the folds of the expensive model)')
+	return parser.parse_args()
+
+
+def screen(model, dataset, idx, top_k, chunk_size):
+	r"""
+	Rows of the top_k patches of the bag by attention of the screening model, the bag read chunk_size patches at a time
+	"""
+	scores, rows, start = None, None, 0
+	for x, _ in dataset.iter_path_chunks(idx, chunk_size, device=device):
+		A = model.attention_net(x)[0].squeeze(1)
+		chunk_rows = torch.arange(start, start + len(x), device=device)
+		start += len(x)
+		scores = A if scores is None else torch.cat([scores, A])
+		rows = chunk_rows if rows is None else torch.cat([rows, chunk_rows])
+		if len(scores) > top_k:
+			scores, keep = scores.topk(top_k)
+			rows = rows[keep]
+	return np.sort(rows.cpu().numpy())
+
+
+def split_rows(rows, lengths):
+	r"""
+	Rows of a bag split into the rows of each of its slides
+	"""
+	bounds = np.cumsum([0] + lengths)
+	cuts = np.searchsorted(rows, bounds)
+	return [rows[cuts[s]:cuts[s+1]] - bounds[s] for s in range(len(lengths))]
+
+
+def score(args, model, split, fold):
+	r"""
+	Risk of each patient of the split and c-index, with the loop of the evaluation
+	"""
+	loader = get_split_loader(split, mode=args.mode, num_workers=0)
+	start = timer()
+	results, c_index = loop_survival(fold, 0, model, loader, init_loss(args), model_type=args.model_type, training=False, return_summary=True, bs_micro=args.bs_micro, precision=args.precision)
+	risk = pd.Series({slide_id: float(result['risk'][0]) for slide_id, result in results.items()})
+	return risk, c_index, timer() - start
+
+
+if __name__ == "__main__":
+	cascade_args = setup_argparse()
+	with open(os.path.join(cascade_args.model_dir, 'experiment.json')) as f:
+		n_folds = json.load(f)['k']
+	folds = [int(fold) for fold in cascade_args.folds.split(',')] if cascade_args.folds else range(n_folds)
+
+	results = []
+	for fold in folds:
+		split_index = ['train', 'val', 'test'].index(cascade_args.split)
+		screen_args, screen_model, screen_split = load_trained(cascade_args.screen_dir, cascade_args.screen_ckpt, fold)
+		args, model, split = load_trained(cascade_args.model_dir, cascade_args.model_ckpt, fold)
+		screen_split, split = screen_split[split_index], split[split_index]
+		assert screen_args.model_type in ['amil', 'porpoise'], "The screening model is amil or porpoise"
+		assert args.mode == 'coattn', "The expensive model is a co-attention model (mcat, motcat or cmta)"
+		full_risk, full_cindex, full_time = score(args, model, split, fold)
+
+		# stage 1, the top-k patches of every patient by screening attention
+		start = timer()
+		top_rows = {}
+		with torch.no_grad():
+			for idx, case_id in enumerate(screen_split.slide_data['case_id']):
+				top_rows[case_id] = screen(screen_model, screen_split, idx, cascade_args.top_k, cascade_args.chunk_size)
+		screen_time = timer() - start
+
+		# stage 2, the expensive model on these patches, the features of both stages are assumed to come from the same patching
+		screen_lengths, lengths = screen_split.get_slide_lengths(), split.get_slide_lengths()
+		split.patch_rows = {}
+		for idx, case_id in enumerate(split.slide_data['case_id']):
+			slide_ids = [slide_id.rstrip('.svs') for slide_id in split.patient_dict[case_id]]
+			assert all(lengths[slide_id] == screen_lengths[slide_id] for slide_id in slide_ids), "The patches of {} differ between the two feature stores".format(case_id)
+			split.patch_rows[idx] = (split_rows(top_rows[case_id], [lengths[slide_id] for slide_id in slide_ids]), None)
+		cascade_risk, cascade_cindex, cascade_time = score(args, model, split, fold)
+		split.patch_rows = None
+
+		full_risk, cascade_risk = full_risk.align(cascade_risk)
+		results.append({
+			'fold': fold, 'top_k': cascade_args.top_k,
+			'full_cindex': full_cindex, 'cascade_cindex': cascade_cindex,
+			# agreement of the cascade risks with the risks of the full model
+			'spearman': spearmanr(full_risk, cascade_risk)[0], 'kendall': kendalltau(full_risk, cascade_risk)[0],
+			'risk_group_agreement': np.mean((full_risk > full_risk.median()) == (cascade_risk > cascade_risk.median())),
+			'full_time': full_time, 'screen_time': screen_time, 'cascade_time': screen_time + cascade_time, 'speedup': full_time / (screen_time + cascade_time),
+		})
+		print(results[-1])
+
+	results = pd.DataFrame(results)
+	print(results.to_string(index=False))
+	results.to_csv(os.path.join(cascade_args.model_dir, 'cascade_{}_top{}.csv'.format(cascade_args.split, cascade_args.top_k)), index=False)
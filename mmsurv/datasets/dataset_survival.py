@@ -24,6 +24,7 @@ class Generic_WSI_Survival_Dataset(Dataset):
 		self.print_info = print_info
 		self.data_dir = None
 		self.cluster_id_path = None
+		self.coreset_path = None
 		self.num_intervals = n_bins
 		self.mode = mode
 		
@@ -127,14 +128,14 @@ class Generic_WSI_Survival_Dataset(Dataset):
 
 	def get_split_from_df(self, all_splits=None, split_key='train', scaler=None):
 		if split_key == 'all':
-			return Generic_Split(self.slide_data, self.time_breaks, self.indep_vars, self.mode, self.data_dir, self.cluster_id_path, patient_dict=self.patient_dict, print_info=self.print_info, num_classes=self.num_classes, signatures=self.signatures, omic_sizes=self.omic_sizes, omic_names=self.omic_names)
+			return Generic_Split(self.slide_data, self.time_breaks, self.indep_vars, self.mode, self.data_dir, self.cluster_id_path, patient_dict=self.patient_dict, print_info=self.print_info, num_classes=self.num_classes, signatures=self.signatures, omic_sizes=self.omic_sizes, omic_names=self.omic_names, coreset_path=self.coreset_path)
 		split = all_splits[split_key]
 		split = split.dropna().reset_index(drop=True)
 
 		if len(split) > 0:
 			mask = self.slide_data['slide_id'].isin(split.tolist())
 			df_slice = self.slide_data[mask].reset_index(drop=True)
-			split = Generic_Split(df_slice, self.time_breaks, self.indep_vars, self.mode, self.data_dir, self.cluster_id_path, patient_dict=self.patient_dict, print_info=self.print_info, num_classes=self.num_classes, signatures=self.signatures, omic_sizes=self.omic_sizes, omic_names=self.omic_names)
+			split = Generic_Split(df_slice, self.time_breaks, self.indep_vars, self.mode, self.data_dir, self.cluster_id_path, patient_dict=self.patient_dict, print_info=self.print_info, num_classes=self.num_classes, signatures=self.signatures, omic_sizes=self.omic_sizes, omic_names=self.omic_names, coreset_path=self.coreset_path)
 		else:
 			split = None
 		
@@ -184,10 +185,92 @@ class Generic_WSI_Survival_Dataset(Dataset):
 
 
 class MIL_Survival_Dataset(Generic_WSI_Survival_Dataset):
-	def __init__(self, data_dir, cluster_id_path, **kwargs):
+	def __init__(self, data_dir, cluster_id_path, coreset_path=None, **kwargs):
 		super(MIL_Survival_Dataset, self).__init__(**kwargs)
 		self.data_dir = data_dir
 		self.cluster_id_path = cluster_id_path
+		self.coreset_path = coreset_path
+		self.stream_path = False
+		self.patch_rows = None
+
+	def get_path_weights(self, idx, coreset=True):
+		r"""
+		Number of patches represented by each instance of the bag (all ones without a coreset), times the sampling
+		weight of the instance when the bag is sampled (see AttentionPatchSampler).
+		"""
+		case_id = self.slide_data['case_id'][idx]
+		rows = self.patch_rows.get(idx) if self.patch_rows else None
+		weights = []
+		for s, slide_id in enumerate(self.patient_dict[case_id]):
+			slide_id = slide_id.rstrip('.svs')
+			if coreset and self.coreset is not None:
+				slide_weights = torch.from_numpy(self.coreset[slide_id]['weights']).float()
+			else:
+				slide_weights = torch.ones(self.get_slide_lengths()[slide_id])
+			if rows is not None:
+				slide_weights = slide_weights[torch.from_numpy(rows[0][s])] * torch.from_numpy(rows[1][s])
+			weights.append(slide_weights)
+		return torch.cat(weights, dim=0)
+
+	def iter_path_chunks(self, idx, chunk_size, weights=False, device=None):
+		r"""
+		Instances of the bag of a patient, chunk_size at a time, read from the memory-mapped feature files.
+		Yields (features, weights) chunks, weights is None unless requested (coreset bags).
+		"""
+		case_id = self.slide_data['case_id'][idx]
+		for slide_id in self.patient_dict[case_id]:
+			slide_id = slide_id.rstrip('.svs')
+			wsi_bag = torch.load(os.path.join(self.data_dir, '{}.pt'.format(slide_id)), mmap=True, weights_only=True)
+			slide_weights = torch.from_numpy(self.coreset[slide_id]['weights']) if weights else None
+			for start in range(0, wsi_bag.shape[0], chunk_size):
+				x = wsi_bag[start:start + chunk_size].to(device)
+				w = slide_weights[start:start + chunk_size].to(device) if weights else None
+				yield x, w
+
+	def load_path_features(self, idx):
+		r"""
+		Instances of the bag of a patient, only the rows of patch_rows when it has an entry for the bag
+		(see AttentionPatchSampler and cascade.py).
+		"""
+		case_id = self.slide_data['case_id'][idx]
+		rows = self.patch_rows.get(idx) if self.patch_rows else None
+		path_features = []
+		for s, slide_id in enumerate(self.patient_dict[case_id]):
+			wsi_path = os.path.join(self.data_dir, '{}.pt'.format(slide_id.rstrip('.svs')))
+			if rows is None:
+				wsi_bag = torch.load(wsi_path, weights_only=True)
+			else:
+				# only the selected rows are read from the memory-mapped features
+				wsi_bag = torch.load(wsi_path, mmap=True, weights_only=True)[torch.from_numpy(rows[0][s])]
+			path_features.append(wsi_bag)
+		return torch.cat(path_features, dim=0)
+
+	def get_slide_lengths(self):
+		r"""
+		Number of instances of each slide, see get_bag_lengths.
+		"""
+		self.get_bag_lengths()
+		return self.slide_lengths
+
+	def get_bag_lengths(self):
+		r"""
+		Number of instances in the bag of each patient, read without loading the features.
+		"""
+		if self.bag_lengths is None:
+			slide_lengths = {}
+			for case_id in self.slide_data['case_id']:
+				for slide_id in self.patient_dict[case_id]:
+					slide_id = slide_id.rstrip('.svs')
+					if slide_id in slide_lengths:
+						continue
+					if self.coreset is not None:
+						slide_lengths[slide_id] = len(self.coreset[slide_id]['indices'])
+					else:
+						wsi_path = os.path.join(self.data_dir, '{}.pt'.format(slide_id))
+						slide_lengths[slide_id] = torch.load(wsi_path, mmap=True, weights_only=True).shape[0]
+			self.bag_lengths = [sum(slide_lengths[slide_id.rstrip('.svs')] for slide_id in self.patient_dict[case_id]) for case_id in self.slide_data['case_id']]
+			self.slide_lengths = slide_lengths
+		return self.bag_lengths
 
 	def __getitem__(self, idx):
 		case_id = self.slide_data['case_id'][idx]
@@ -197,20 +280,10 @@ class MIL_Survival_Dataset(Generic_WSI_Survival_Dataset):
 		slide_ids = self.patient_dict[case_id]
 		
 		if self.mode == 'coattn':
-			path_features = []
-			for slide_id in slide_ids:
-				wsi_path = os.path.join(self.data_dir, '{}.pt'.format(slide_id.rstrip('.svs')))
-				wsi_bag = torch.load(wsi_path, weights_only=True)
-				path_features.append(wsi_bag)
-			path_features = torch.cat(path_features, dim=0)
-			omic1 = torch.tensor(self.slide_data[self.omic_names[0]].iloc[idx])
-			omic2 = torch.tensor(self.slide_data[self.omic_names[1]].iloc[idx])
-			omic3 = torch.tensor(self.slide_data[self.omic_names[2]].iloc[idx])
-			omic4 = torch.tensor(self.slide_data[self.omic_names[3]].iloc[idx])
-			omic5 = torch.tensor(self.slide_data[self.omic_names[4]].iloc[idx])
-			omic6 = torch.tensor(self.slide_data[self.omic_names[5]].iloc[idx])
+			path_features = self.load_path_features(idx)
+			omics = [torch.tensor(self.slide_data[omic_names].iloc[idx]) for omic_names in self.omic_names]
 			
-			return (path_features, omic1, omic2, omic3, omic4, omic5, omic6, label, event_time, c)
+			return (path_features, *omics, label, event_time, c, idx)
 		
 		if self.mode == 'cluster':
 			path_features = []
@@ -219,20 +292,21 @@ class MIL_Survival_Dataset(Generic_WSI_Survival_Dataset):
 				wsi_path = os.path.join(self.data_dir, '{}.pt'.format(slide_id.rstrip('.svs')))
 				wsi_bag = torch.load(wsi_path, weights_only=True)
 				path_features.append(wsi_bag)
-				cluster_ids.extend(self.fname2ids[slide_id.rstrip('.svs')])
+				slide_cluster_ids = self.fname2ids[slide_id.rstrip('.svs')]
+				if self.coreset is not None:
+					slide_cluster_ids = slide_cluster_ids[self.coreset[slide_id.rstrip('.svs')]['indices']]
+				cluster_ids.extend(slide_cluster_ids)
 			path_features = torch.cat(path_features, dim=0)
 			cluster_ids = torch.Tensor(cluster_ids)
 			genomic_features = torch.tensor(self.slide_data[self.indep_vars].iloc[idx])
 			
-			return (cluster_ids, path_features, genomic_features, label, event_time, c)
+			return (cluster_ids, path_features, genomic_features, label, event_time, c, idx)
 
-		if "path" in self.mode:
-			path_features = []
-			for slide_id in slide_ids:
-				wsi_path = os.path.join(self.data_dir, '{}.pt'.format(slide_id.rstrip('.svs')))
-				wsi_bag = torch.load(wsi_path, weights_only=True)
-				path_features.append(wsi_bag)
-			path_features = torch.cat(path_features, dim=0)
+		if "path" in self.mode and self.stream_path:
+			# the bag is read chunk by chunk by the model, see iter_path_chunks
+			path_features = torch.zeros(0, 1)
+		elif "path" in self.mode:
+			path_features = self.load_path_features(idx)
 		else:
 			path_features = torch.zeros(1,)
 		if 'omic' in self.mode:
@@ -241,20 +315,95 @@ class MIL_Survival_Dataset(Generic_WSI_Survival_Dataset):
 		else:
 			genomic_features = torch.zeros(1,)
 			
-		return (path_features, genomic_features, label, event_time, c)
+		return (path_features, genomic_features, label, event_time, c, idx)
+
+
+class AttentionPatchSampler:
+	r"""
+	Patches of the training bags drawn from the attention of the previous epochs, within a budget of patches per bag
+
+	The attention logit each patch had in the last forward pass that saw it is kept per slide, in float16 aligned
+	with the feature rows (NaN until the patch is scored). Before every epoch, each bag longer than the budget is
+	planned: its patches of highest attention fill (1 - explore) of the budget and the rest is drawn uniformly from
+	the other patches, weighted by the number of patches it stands for, so that the pooling over the sample
+	estimates the pooling of the whole bag. Bags not scored yet are drawn uniformly.
+
+	args:
+		budget (int): Patches per bag
+		explore (float): Fraction of the budget drawn at random
+		seed (int): Seed of the random draws
+	"""
+	def __init__(self, budget, explore=0.25, seed=1):
+		self.budget = budget
+		self.explore = explore
+		self.rng = np.random.default_rng(seed)
+		self.scores = {}
+
+	def get_slide_ids(self, dataset, idx):
+		return [slide_id.rstrip('.svs') for slide_id in dataset.patient_dict[dataset.slide_data['case_id'][idx]]]
+
+	def plan(self, dataset):
+		r"""
+		Sets dataset.patch_rows, the sampled rows and sampling weights of each slide of the bags longer than the budget
+		"""
+		slide_lengths = dataset.get_slide_lengths()
+		dataset.patch_rows = {}
+		for idx in range(len(dataset)):
+			slide_ids = self.get_slide_ids(dataset, idx)
+			lengths = [slide_lengths[slide_id] for slide_id in slide_ids]
+			if sum(lengths) <= self.budget:
+				continue
+			scores = np.concatenate([self.scores.get(slide_id, np.full(n, np.nan, dtype=np.float16)) for slide_id, n in zip(slide_ids, lengths)]).astype(np.float32)
+			scored = np.flatnonzero(~np.isnan(scores))
+			n_top = min(len(scored), int(round(self.budget * (1 - self.explore))))
+			top = scored[np.argpartition(-scores[scored], n_top - 1)[:n_top]] if n_top else scored[:0]
+			rest = np.setdiff1d(np.arange(len(scores)), top)
+			explore = self.rng.choice(rest, self.budget - n_top, replace=False)
+			rows = np.concatenate([top, explore])
+			# the drawn patches stand for the rest of the bag, nothing is drawn when the top patches fill the budget
+			weights = np.ones(len(rows), dtype=np.float32)
+			if len(explore):
+				weights[n_top:] = len(rest) / len(explore)
+			order = np.argsort(rows)
+			rows, weights = rows[order], weights[order]
+
+			bounds = np.cumsum([0] + lengths)
+			cuts = np.searchsorted(rows, bounds)
+			dataset.patch_rows[idx] = ([rows[cuts[s]:cuts[s+1]] - bounds[s] for s in range(len(lengths))], [weights[cuts[s]:cuts[s+1]] for s in range(len(lengths))])
+
+	def update(self, dataset, index, attention, bag_offsets):
+		r"""
+		Stores the attention logits of the instances of a batch
+
+		args:
+			index (list): Dataset index of each bag of the batch
+			attention (np.ndarray): Attention logit of each instance of the batch
+			bag_offsets (list): Start offsets of each bag in the instances
+		"""
+		slide_lengths = dataset.get_slide_lengths()
+		for b, idx in enumerate(index):
+			rows = dataset.patch_rows.get(idx) if dataset.patch_rows else None
+			start = bag_offsets[b]
+			for s, slide_id in enumerate(self.get_slide_ids(dataset, idx)):
+				if slide_id not in self.scores:
+					self.scores[slide_id] = np.full(slide_lengths[slide_id], np.nan, dtype=np.float16)
+				slide_rows = rows[0][s] if rows is not None else np.arange(slide_lengths[slide_id])
+				self.scores[slide_id][slide_rows] = attention[start:start + len(slide_rows)]
+				start += len(slide_rows)
 
 
 class Generic_Split(MIL_Survival_Dataset):
 	def __init__(self, slide_data, time_breaks, indep_vars,
 	mode, data_dir=None, cluster_id_path=None, patient_dict=None, 
 	print_info=False, num_classes=4, signatures=None,
-	omic_sizes=None, omic_names=None):
+	omic_sizes=None, omic_names=None, coreset_path=None):
 		"""
 		Args:
 			slide_data (DataFrame): Data for the current split.
 			time_breaks (list): Time intervals for survival analysis.
 			data_dir (string): Directory where the slide features are located.
 			patient_dict (dict): Dictionary mapping patient IDs to slide data.
+			coreset_path (string): Selected patches and their weights, when data_dir is a coreset store.
 		"""
 		self.slide_data = slide_data
 		self.data_dir = data_dir
@@ -267,6 +416,14 @@ class Generic_Split(MIL_Survival_Dataset):
 				self.fname2ids = pickle.load(handle)
 		else:
 			print("Cluster ID path not found.")
+		self.coreset_path = coreset_path
+		self.coreset = None
+		if coreset_path is not None:
+			with open(coreset_path, 'rb') as handle:
+				self.coreset = pickle.load(handle)
+		self.bag_lengths = None
+		self.stream_path = False
+		self.patch_rows = None
 
 		self.slide_cls_ids = [[] for i in range(num_classes)]
 		for i in range(num_classes):
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from mmsurv.datasets.dataset_survival import AttentionPatchSampler
+
+
+class SlideBags:
+	# the parts of a Generic_Split the sampler uses: patients, their slides and the slide lengths
+	def __init__(self, patient_slides):
+		self.slide_data = pd.DataFrame({'case_id': list(patient_slides)})
+		self.patient_dict = {case_id: [slide_id + '.svs' for slide_id in slides] for case_id, slides in patient_slides.items()}
+		self.slide_lengths = {slide_id: n for slides in patient_slides.values() for slide_id, n in slides.items()}
+		self.patch_rows = None
+
+	def __len__(self):
+		return len(self.slide_data)
+
+	def get_slide_lengths(self):
+		return self.slide_lengths
+
+
+def scored_bags(sampler, dataset):
+	# one epoch over the whole bags, the attention logit of a patch is its row in the bag
+	for idx, case_id in enumerate(dataset.slide_data['case_id']):
+		n = sum(dataset.slide_lengths[slide_id.rstrip('.svs')] for slide_id in dataset.patient_dict[case_id])
+		sampler.update(dataset, [idx], np.arange(n, dtype=np.float32), [0, n])
+
+
+@pytest.mark.parametrize("explore", [0, 0.25, 1])
+def test_attention_patch_sampler(explore):
+	dataset = SlideBags({'short': {'s0': 50}, 'long': {'s1': 300, 's2': 200}})
+	sampler = AttentionPatchSampler(budget=100, explore=explore)
+	scored_bags(sampler, dataset)
+	sampler.plan(dataset)
+
+	# bags within the budget are read whole
+	assert list(dataset.patch_rows) == [1]
+	(rows_s1, rows_s2), (weights_s1, weights_s2) = dataset.patch_rows[1]
+	rows, weights = np.concatenate([rows_s1, rows_s2 + 300]), np.concatenate([weights_s1, weights_s2])
+	assert len(rows) == 100 and len(np.unique(rows)) == 100
+	assert np.all(rows_s1 < 300) and np.all(rows_s2 < 200)
+
+	# the patches of highest attention fill (1 - explore) of the budget, the others stand for the rest of the bag
+	n_top = int(round(100 * (1 - explore)))
+	top = rows >= 500 - n_top
+	assert top.sum() == n_top and np.all(weights[top] == 1)
+	if explore == 0:
+		# nothing is drawn when the top patches fill the budget
+		assert np.all(rows == np.arange(400, 500)) and np.all(weights == 1)
+	else:
+		assert np.isclose(weights.sum(), 500)
+	if explore == 1:
+		assert np.allclose(weights, 5)
+
+
+def test_attention_patch_sampler_unscored():
+	# bags not scored yet are drawn uniformly, and their scores kept at the rows the sample read
+	dataset = SlideBags({'long': {'s1': 300, 's2': 200}})
+	sampler = AttentionPatchSampler(budget=100)
+	sampler.plan(dataset)
+	(rows_s1, rows_s2), (weights_s1, weights_s2) = dataset.patch_rows[0]
+	assert len(rows_s1) + len(rows_s2) == 100
+	assert np.allclose(np.concatenate([weights_s1, weights_s2]), 5)
+
+	sampler.update(dataset, [0], np.arange(100, dtype=np.float32), [0, 100])
+	assert np.array_equal(np.flatnonzero(~np.isnan(sampler.scores['s1'])), rows_s1)
+	assert np.array_equal(sampler.scores['s2'][rows_s2], np.arange(len(rows_s1), 100, dtype=np.float16))
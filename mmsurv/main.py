@@ -10,15 +10,17 @@ import pandas as pd
 import torch
 
 ### Internal Imports
+from mmsurv.arguments import setup_argparse
 from mmsurv.datasets.dataset_survival import MIL_Survival_Dataset
 from mmsurv.utils.file_utils import save_pkl
-from mmsurv.utils.core_utils import train
-from mmsurv.utils.utils import check_directories, get_data
+from mmsurv.utils.core_utils import init_model, teacher_outputs, train
+from mmsurv.utils.utils import check_directories, get_data, set_execution_profile
 
 device=torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 def run(args):
 	seed_torch(args.seed)
+	args.worker_cores = set_execution_profile(args)
 
 	args = check_directories(args)
 		
@@ -37,17 +39,7 @@ def run(args):
 		print("{}:  {}".format(key, val)) 
 
 	print("Loading all the data ...")
-	df, indep_vars = get_data(args)
-	dataset = MIL_Survival_Dataset(
-		df=df,
-		data_dir=args.feats_dir,
-		cluster_id_path=os.path.join(args.dataset_dir, f"{args.data_name}_cluster_ids.pkl"),
-		mode= args.mode,
-		sign_path=os.path.join(args.dataset_dir, "signatures.csv") if args.apply_sig else None,
-		print_info=True,
-		n_bins=args.n_classes,
-		indep_vars=indep_vars
-	)
+	dataset = load_dataset(args)
 
 	if args.k_start == -1:
 		start = 0
@@ -76,7 +68,12 @@ def run(args):
 		if train_stats is not None:
 			train_stats.to_csv(os.path.join(args.results_dir, f'train_stats_{i}.csv'))
 		
-		log, val_latest, test_latest = train(datasets, i, args)
+		distill = None
+		if args.teacher_dir:
+			distill = get_teacher_outputs(args, i, datasets[0])
+			# the same training whether the teacher outputs were cached or computed
+			seed_torch(args.seed)
+		log, val_latest, test_latest = train(datasets, i, args, teacher_outputs=distill)
 		
 		if results is None:
 			results = {k: [] for k in log.keys()}
@@ -92,6 +89,69 @@ def run(args):
 	
 		pd.DataFrame(results).to_csv(os.path.join(args.results_dir, 'summary_latest.csv'))
 
+def load_dataset(args):
+	df, indep_vars = get_data(args)
+	coreset_path = os.path.join(args.feats_dir, "coreset.pkl") if args.feats_dir else None
+	coreset_path = coreset_path if coreset_path and os.path.isfile(coreset_path) else None
+	assert coreset_path or not args.coreset_weights, "--coreset_weights requires a coreset store as --feats_dir (see save_coresets.py)"
+	return MIL_Survival_Dataset(
+		df=df,
+		data_dir=args.feats_dir,
+		cluster_id_path=os.path.join(args.dataset_dir, f"{args.data_name}_cluster_ids.pkl"),
+		coreset_path=coreset_path,
+		mode= args.mode,
+		sign_path=os.path.join(args.dataset_dir, "signatures.csv") if args.apply_sig else None,
+		print_info=True,
+		n_bins=args.n_classes,
+		indep_vars=indep_vars
+	)
+
+def load_trained(results_dir, ckpt, fold):
+	r"""
+	Model of a training run (experiment.json of results_dir, missing options at their defaults) with the checkpoint
+	of the fold, and the train, val and test splits of the fold
+	"""
+	args = vars(setup_argparse([]))
+	with open(os.path.join(results_dir, 'experiment.json')) as f:
+		args.update(json.load(f))
+	args = argparse.Namespace(**args)
+
+	datasets, _ = load_dataset(args).return_splits(os.path.join(args.split_dir, 'splits_{}.csv'.format(fold)))
+	args.fusion = None if args.fusion == 'None' else args.fusion
+	args.omic_sizes = datasets[0].omic_sizes
+	args.checkpoint_activations = None
+	model = init_model(args)
+	model.load_state_dict(torch.load(os.path.join(results_dir, ckpt.format(fold)), map_location='cpu', weights_only=True))
+	return args, model.to(device).eval(), datasets
+
+def get_teacher_outputs(args, fold, split):
+	r"""
+	Outputs of the teacher (args.teacher_dir) for the training patients of the fold (split), computed once and cached next to
+	its checkpoint with the patients and the feature directory they were computed on
+	"""
+	case_ids = [str(case_id) for case_id in split.slide_data['case_id']]
+	cache_path = os.path.join(args.teacher_dir, 'teacher_outputs_{}'.format(args.teacher_ckpt.format(fold)))
+	cache = torch.load(cache_path, weights_only=True) if os.path.isfile(cache_path) else None
+	if cache is not None and 'outputs' in cache and set(case_ids) <= set(cache['case_ids']) and (not args.distill_attention or all('attention' in output for output in cache['outputs'].values())):
+		print("Teacher outputs loaded from", cache_path)
+	else:
+		teacher_args, teacher, datasets = load_trained(args.teacher_dir, args.teacher_ckpt, fold)
+		outputs = teacher_outputs(teacher_args, teacher, datasets[0], attention=bool(args.distill_attention))
+		cache = {'case_ids': list(outputs.keys()), 'feats_dir': teacher_args.feats_dir, 'outputs': outputs}
+		torch.save(cache, cache_path)
+		print("Teacher outputs cached to", cache_path)
+
+	missing = set(case_ids) - set(cache['case_ids'])
+	assert not missing, "{} training patients of fold {} are not training patients of the teacher, its data_name or split_dir differ".format(len(missing), fold)
+	if args.distill_attention:
+		# the attention of the teacher is over the patches of its bags, which must be the student's, slide by slide
+		slide_lengths = split.get_slide_lengths()
+		for case_id in split.slide_data['case_id']:
+			lengths = [slide_lengths[slide_id.rstrip('.svs')] for slide_id in split.patient_dict[case_id]]
+			assert lengths == cache['outputs'][str(case_id)]['slide_lengths'].tolist(), \
+				"The slides of {} have other patches in {} (teacher) than in {}, the attention can't be distilled".format(case_id, cache['feats_dir'], args.feats_dir)
+	return cache['outputs']
+
 ### Sets Seed for reproducible experiments.
 def seed_torch(seed=7):
 	import random
@@ -106,7 +166,6 @@ def seed_torch(seed=7):
 	torch.backends.cudnn.deterministic = True
 
 if __name__ == '__main__':
-	import arguments
-	args = arguments.setup_argparse()
+	args = setup_argparse()
 	run(args)
 	
\ No newline at end of file
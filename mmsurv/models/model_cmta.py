@@ -5,13 +5,15 @@ import torch.nn as nn
 
 from mmsurv.models.cmta_util import initialize_weights
 from mmsurv.models.cmta_util import NystromAttention
+from mmsurv.models.cmta_util import bipartite_merge
 from mmsurv.models.cmta_util import BilinearFusion
-from mmsurv.models.cmta_util import SNN_Block
-from mmsurv.models.cmta_util import MultiheadAttention
+from mmsurv.models.model_utils import SNN_Signatures
+from mmsurv.models.model_utils import LRBilinearFusion
+from mmsurv.models.model_utils import MultiheadAttention
 
 
 class TransLayer(nn.Module):
-    def __init__(self, norm_layer=nn.LayerNorm, dim=512):
+    def __init__(self, norm_layer=nn.LayerNorm, dim=512, landmark_budget=None):
         super().__init__()
         self.norm = norm_layer(dim)
         self.attn = NystromAttention(
@@ -22,12 +24,17 @@ class TransLayer(nn.Module):
             pinv_iterations=6,  # number of moore-penrose iterations for approximating pinverse. 6 was recommended by the paper
             residual=True,  # whether to do an extra residual with the value or not. supposedly faster convergence if turned on
             dropout=0.1,
+            landmark_budget=landmark_budget,  # landmarks chosen from the sequence length within this n x m budget, if set
         )
 
     def forward(self, x):
         x = x + self.attn(self.norm(x))
         return x
 
+    def attention_rows(self, x, **kwargs):
+        # rows of the attention map of the layer, streamed in blocks (see NystromAttention.attention_rows)
+        return self.attn.attention_rows(self.norm(x), **kwargs)
+
 
 class PPEG(nn.Module):
     def __init__(self, dim=512):
@@ -47,14 +54,15 @@ class PPEG(nn.Module):
 
 
 class Transformer_P(nn.Module):
-    def __init__(self, feature_dim=512):
+    def __init__(self, feature_dim=512, merge_ratio=0.0, landmark_budget=None):
         super(Transformer_P, self).__init__()
+        self.merge_ratio = merge_ratio  # fraction of the patch tokens merged away between the two layers, at most 0.5
         # Encoder
         self.pos_layer = PPEG(dim=feature_dim)
         self.cls_token = nn.Parameter(torch.randn(1, 1, feature_dim))
         nn.init.normal_(self.cls_token, std=1e-6)
-        self.layer1 = TransLayer(dim=feature_dim)
-        self.layer2 = TransLayer(dim=feature_dim)
+        self.layer1 = TransLayer(dim=feature_dim, landmark_budget=landmark_budget)
+        self.layer2 = TransLayer(dim=feature_dim, landmark_budget=landmark_budget)
         self.norm = nn.LayerNorm(feature_dim)
         # Decoder
 
@@ -66,10 +74,16 @@ class Transformer_P(nn.Module):
         h = torch.cat([features, features[:, :add_length, :]], dim=1)  # [B, N, 512]
         # ---->cls_token
         B = h.shape[0]
-        cls_tokens = self.cls_token.expand(B, -1, -1).cuda()
+        cls_tokens = self.cls_token.expand(B, -1, -1)
         h = torch.cat((cls_tokens, h), dim=1)
         # ---->Translayer x1
         h = self.layer1(h)  # [B, N, 512]
+        # ---->token merging, the grid of PPEG is rebuilt on the remaining tokens
+        if self.merge_ratio > 0:
+            h = torch.cat((h[:, :1], bipartite_merge(h[:, 1:], int(h.shape[1] * self.merge_ratio))), dim=1)
+            H = h.shape[1] - 1
+            _H, _W = int(np.ceil(np.sqrt(H))), int(np.ceil(np.sqrt(H)))
+            h = torch.cat([h, h[:, 1:_H * _W - H + 1, :]], dim=1)
         # ---->PPEG
         h = self.pos_layer(h, _H, _W)  # [B, N, 512]
         # ---->Translayer x2
@@ -80,19 +94,19 @@ class Transformer_P(nn.Module):
 
 
 class Transformer_G(nn.Module):
-    def __init__(self, feature_dim=512):
+    def __init__(self, feature_dim=512, landmark_budget=None):
         super(Transformer_G, self).__init__()
         # Encoder
         self.cls_token = nn.Parameter(torch.randn(1, 1, feature_dim))
         nn.init.normal_(self.cls_token, std=1e-6)
-        self.layer1 = TransLayer(dim=feature_dim)
-        self.layer2 = TransLayer(dim=feature_dim)
+        self.layer1 = TransLayer(dim=feature_dim, landmark_budget=landmark_budget)
+        self.layer2 = TransLayer(dim=feature_dim, landmark_budget=landmark_budget)
         self.norm = nn.LayerNorm(feature_dim)
         # Decoder
 
     def forward(self, features):
         # ---->pad
-        cls_tokens = self.cls_token.expand(features.shape[0], -1, -1).cuda()
+        cls_tokens = self.cls_token.expand(features.shape[0], -1, -1)
         h = torch.cat((cls_tokens, features), dim=1)
         # ---->Translayer x1
         h = self.layer1(h)  # [B, N, 512]
@@ -104,7 +118,7 @@ class Transformer_G(nn.Module):
 
 
 class CMTA(nn.Module):
-    def __init__(self, path_input_dim=1024, omic_input_dim=[100, 200, 300, 400, 500, 600], n_classes=4, fusion="concat", model_size="small"):
+    def __init__(self, path_input_dim=1024, omic_input_dim=[100, 200, 300, 400, 500, 600], n_classes=4, fusion="concat", model_size="small", attn_chunk_size=None, merge_ratio=0.0, landmark_budget=None):
         super(CMTA, self).__init__()
         self.omic_sizes = omic_input_dim
         self.n_classes = n_classes
@@ -125,30 +139,24 @@ class CMTA(nn.Module):
         self.pathomics_fc = nn.Sequential(*fc)
         # Genomic Embedding Network
         hidden = self.size_dict["genomics"][model_size]
-        sig_networks = []
-        for input_dim in self.omic_sizes:
-            fc_omic = [SNN_Block(dim1=input_dim, dim2=hidden[0])]
-            for i, _ in enumerate(hidden[1:]):
-                fc_omic.append(SNN_Block(dim1=hidden[i], dim2=hidden[i + 1], dropout=0.25))
-            sig_networks.append(nn.Sequential(*fc_omic))
-        self.genomics_fc = nn.ModuleList(sig_networks)
+        self.genomics_fc = SNN_Signatures(self.omic_sizes, hidden=hidden, dropout=0.25, init_fn=initialize_weights)
 
         # Pathomics Transformer
         # Encoder
-        self.pathomics_encoder = Transformer_P(feature_dim=hidden[-1])
+        self.pathomics_encoder = Transformer_P(feature_dim=hidden[-1], merge_ratio=merge_ratio, landmark_budget=landmark_budget)
         # Decoder
-        self.pathomics_decoder = Transformer_P(feature_dim=hidden[-1])
+        self.pathomics_decoder = Transformer_P(feature_dim=hidden[-1], merge_ratio=merge_ratio, landmark_budget=landmark_budget)
 
         # P->G Attention
         self.P_in_G_Att = MultiheadAttention(embed_dim=256, num_heads=1)
         # G->P Attention
-        self.G_in_P_Att = MultiheadAttention(embed_dim=256, num_heads=1)
+        self.G_in_P_Att = MultiheadAttention(embed_dim=256, num_heads=1, kv_chunk_size=attn_chunk_size)  # patch tokens attended in chunks, if set
 
         # Pathomics Transformer Decoder
         # Encoder
-        self.genomics_encoder = Transformer_G(feature_dim=hidden[-1])
+        self.genomics_encoder = Transformer_G(feature_dim=hidden[-1], landmark_budget=landmark_budget)
         # Decoder
-        self.genomics_decoder = Transformer_G(feature_dim=hidden[-1])
+        self.genomics_decoder = Transformer_G(feature_dim=hidden[-1], landmark_budget=landmark_budget)
 
         # Classification Layer
         if self.fusion == "concat":
@@ -157,48 +165,75 @@ class CMTA(nn.Module):
             )
         elif self.fusion == "bilinear":
             self.mm = BilinearFusion(dim1=hidden[-1], dim2=hidden[-1], scale_dim1=8, scale_dim2=8, mmhid=hidden[-1])
+        elif self.fusion == "lrb":
+            self.mm = LRBilinearFusion(dim1=hidden[-1], dim2=hidden[-1], scale_dim1=8, scale_dim2=8, mmhid=hidden[-1])
         else:
             raise NotImplementedError("Fusion [{}] is not implemented".format(self.fusion))
 
         self.classifier = nn.Linear(hidden[-1], self.n_classes)
+        self.checkpoint_blocks = ['pathomics_fc', 'pathomics_encoder', 'pathomics_decoder', 'genomics_encoder', 'genomics_decoder']  # recomputed in the backward with --checkpoint_activations
 
         self.apply(initialize_weights)
 
+    def _encode_bags(self, transformer, features, lengths):
+        r"""
+        Runs a pathomics transformer on each bag of a padded batch and pads its patch tokens again.
+        Also returns the number of patch tokens of each bag.
+        """
+        if len(features) == 1:
+            cls_tokens, patch_tokens = transformer(features[:, :lengths[0]])
+            return cls_tokens, patch_tokens, [patch_tokens.shape[1]]
+        cls_tokens, patch_tokens = zip(*[transformer(features[b:b + 1, :n]) for b, n in enumerate(lengths)])
+        token_lengths = [t.shape[1] for t in patch_tokens]
+        patch_tokens = torch.nn.utils.rnn.pad_sequence([t[0] for t in patch_tokens], batch_first=True)
+        return torch.cat(cls_tokens, dim=0), patch_tokens, token_lengths
+
     def forward(self, **kwargs):
         # meta genomics and pathomics features
         x_path = kwargs["x_path"]
-        x_omic = [kwargs["x_omic%d" % i] for i in range(1, 7)]
+        x_omic = [kwargs["x_omic%d" % i] for i in range(1, len(self.omic_sizes) + 1)]
+        mask = kwargs.get("mask")  # B x N, True on the padded instances of a batch of bags
+        if x_path.dim() == 2:
+            x_path, x_omic = x_path.unsqueeze(0), [sig_feat.unsqueeze(0) if sig_feat.dim() == 1 else sig_feat for sig_feat in x_omic]
+        lengths = [x_path.shape[1]] * x_path.shape[0] if mask is None else (~mask).sum(dim=1).tolist()
 
         # Enbedding
         # genomics embedding
-        genomics_features = [self.genomics_fc[idx].forward(sig_feat) for idx, sig_feat in enumerate(x_omic)]
-        genomics_features = torch.stack(genomics_features).unsqueeze(0)  # [1, 6, 1024]
+        genomics_features = self.genomics_fc(x_omic).transpose(1, 0)  # [B, S, 256]
         # pathomics embedding
-        pathomics_features = self.pathomics_fc(x_path).unsqueeze(0)
+        pathomics_features = self.pathomics_fc(x_path)
 
         # encoder
-        # pathomics encoder
-        cls_token_pathomics_encoder, patch_token_pathomics_encoder = self.pathomics_encoder(
-            pathomics_features)  # cls token + patch tokens
+        # pathomics encoder, bag by bag since the PPEG grid and the landmarks depend on the bag length
+        cls_token_pathomics_encoder, patch_token_pathomics_encoder, token_lengths = self._encode_bags(
+            self.pathomics_encoder, pathomics_features, lengths)  # cls token + patch tokens
         # genomics encoder
         cls_token_genomics_encoder, patch_token_genomics_encoder = self.genomics_encoder(
             genomics_features)  # cls token + patch tokens
 
         # cross-omics attention
+        token_mask = None
+        if len(set(token_lengths)) > 1:
+            token_mask = torch.arange(max(token_lengths), device=x_path.device).unsqueeze(0) >= torch.tensor(token_lengths, device=x_path.device).unsqueeze(1)
+        patch_token_pathomics = patch_token_pathomics_encoder.transpose(1, 0)
+        patch_token_genomics = patch_token_genomics_encoder.transpose(1, 0)
         pathomics_in_genomics, Att = self.P_in_G_Att(
-            patch_token_pathomics_encoder.transpose(1, 0),
-            patch_token_genomics_encoder.transpose(1, 0),
-            patch_token_genomics_encoder.transpose(1, 0),
+            patch_token_pathomics,
+            patch_token_genomics,
+            patch_token_genomics,
+            need_weights=False,
         )  # ([14642, 1, 256])
         genomics_in_pathomics, Att = self.G_in_P_Att(
-            patch_token_genomics_encoder.transpose(1, 0),
-            patch_token_pathomics_encoder.transpose(1, 0),
-            patch_token_pathomics_encoder.transpose(1, 0),
+            patch_token_genomics,
+            patch_token_pathomics,
+            patch_token_pathomics,
+            key_padding_mask=token_mask,
+            need_weights=False,
         )  # ([7, 1, 256])
         # decoder
         # pathomics decoder
-        cls_token_pathomics_decoder, _ = self.pathomics_decoder(
-            pathomics_in_genomics.transpose(1, 0))  # cls token + patch tokens
+        cls_token_pathomics_decoder, _, _ = self._encode_bags(
+            self.pathomics_decoder, pathomics_in_genomics.transpose(1, 0), token_lengths)  # cls token + patch tokens
         # genomics decoder
         cls_token_genomics_decoder, _ = self.genomics_decoder(
             genomics_in_pathomics.transpose(1, 0))  # cls token + patch tokens
@@ -214,7 +249,7 @@ class CMTA(nn.Module):
                     dim=1,
                 )
             )  # take cls token to make prediction
-        elif self.fusion == "bilinear":
+        elif self.fusion in ["bilinear", "lrb"]:
             fusion = self.mm(
                 (cls_token_pathomics_encoder + cls_token_pathomics_decoder) / 2,
                 (cls_token_genomics_encoder + cls_token_genomics_decoder) / 2,
@@ -224,7 +259,7 @@ class CMTA(nn.Module):
 
         # predict
         logits = self.classifier(fusion)  # [1, n_classes]
-        hazards = torch.sigmoid(logits)
+        hazards = torch.sigmoid(logits.float())
         S = torch.cumprod(1 - hazards, dim=1)
         return hazards, S, cls_token_pathomics_encoder, cls_token_pathomics_decoder, cls_token_genomics_encoder, cls_token_genomics_decoder
 
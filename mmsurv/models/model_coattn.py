@@ -8,7 +8,7 @@ from mmsurv.models.model_utils import *
 ###########################
 class MCAT_Surv(nn.Module):
 	def __init__(self, path_input_dim, fusion='concat', omic_sizes=[100, 200, 300, 400, 500, 600], n_classes=4,
-				 model_size_wsi: str='small', model_size_omic: str='small', dropout=0.25):
+				 model_size_wsi: str='small', model_size_omic: str='small', dropout=0.25, attn_chunk_size=None):
 		super(MCAT_Surv, self).__init__()
 		self.fusion = fusion
 		self.omic_sizes = omic_sizes
@@ -22,19 +22,12 @@ class MCAT_Surv(nn.Module):
 		fc.append(nn.Dropout(0.25))
 		self.wsi_net = nn.Sequential(*fc)
 		
-		### Constructing Genomic SNN
+		### Constructing Genomic SNN, one per signature
 		hidden = self.size_dict_omic[model_size_omic]
-		sig_networks = []
-		
-		for input_dim in omic_sizes:
-			fc_omic = [SNN_Block(dim1=input_dim, dim2=hidden[0])]
-			for i, _ in enumerate(hidden[1:]):
-				fc_omic.append(SNN_Block(dim1=hidden[i], dim2=hidden[i+1], dropout=0.25))
-			sig_networks.append(nn.Sequential(*fc_omic))
-		self.sig_networks = nn.ModuleList(sig_networks)
+		self.sig_networks = SNN_Signatures(omic_sizes, hidden=hidden, dropout=0.25)
 
 		### Multihead Attention
-		self.coattn = MultiheadAttention(embed_dim=256, num_heads=1)
+		self.coattn = MultiheadAttention(embed_dim=256, num_heads=1, kv_chunk_size=attn_chunk_size) # path instances attended in chunks of attn_chunk_size, if set
 
 		### Path Transformer + Attention Head
 		path_encoder_layer = nn.TransformerEncoderLayer(d_model=256, nhead=8, dim_feedforward=512, dropout=dropout, activation='relu')
@@ -53,46 +46,51 @@ class MCAT_Surv(nn.Module):
 			self.mm = nn.Sequential(*[nn.Linear(256*2, size[2]), nn.ReLU(), nn.Linear(size[2], size[2]), nn.ReLU()])
 		elif self.fusion == 'bilinear':
 			self.mm = BilinearFusion(dim1=256, dim2=256, scale_dim1=8, scale_dim2=8, mmhid=256)
+		elif self.fusion == 'lrb':
+			self.mm = LRBilinearFusion(dim1=256, dim2=256, scale_dim1=8, scale_dim2=8, mmhid=256)
 		else:
 			self.mm = None
 		
 		### Classifier
 		self.classifier = nn.Linear(size[2], n_classes)
+		self.checkpoint_blocks = ['wsi_net', 'coattn']  # recomputed in the backward with --checkpoint_activations, the transformers only see the signatures
 
 	def forward(self, **kwargs):
 		x_path = kwargs['x_path']
-		x_omic = [kwargs['x_omic%d' % i] for i in range(1,7)]
+		x_omic = [kwargs['x_omic%d' % i] for i in range(1,len(self.omic_sizes)+1)]
+		mask = kwargs.get('mask') # B x N, True on the padded instances of a batch of bags
+		if x_path.dim() == 2:
+			x_path, x_omic = x_path.unsqueeze(0), [sig_feat.unsqueeze(0) if sig_feat.dim() == 1 else sig_feat for sig_feat in x_omic]
 
-		h_path_bag = self.wsi_net(x_path).unsqueeze(1) ### path embeddings are fed through a FC layer
-		h_omic = [self.sig_networks[idx].forward(sig_feat) for idx, sig_feat in enumerate(x_omic)] ### each omic signature goes through it's own FC layer
-		h_omic_bag = torch.stack(h_omic).unsqueeze(1) ### omic embeddings are stacked (to be used in co-attention)
+		h_path_bag = self.wsi_net(x_path).transpose(1, 0) ### path embeddings are fed through a FC layer, N x B x 256
+		h_omic_bag = self.sig_networks(x_omic) ### each omic signature goes through it's own FC layer, S x B x 256 (to be used in co-attention)
 
 		# Coattn
-		h_path_coattn, A_coattn = self.coattn(h_omic_bag, h_path_bag, h_path_bag)
+		h_path_coattn, A_coattn = self.coattn(h_omic_bag, h_path_bag, h_path_bag, key_padding_mask=mask, need_weights=kwargs.get('return_attn', False)) # the weights are only materialized on demand
 
 		### Path
 		h_path_trans = self.path_transformer(h_path_coattn)
-		A_path, h_path = self.path_attention_head(h_path_trans.squeeze(1))
-		A_path = torch.transpose(A_path, 1, 0)
-		h_path = torch.mm(F.softmax(A_path, dim=1) , h_path)
-		h_path = self.path_rho(h_path).squeeze()
+		A_path, h_path = self.path_attention_head(h_path_trans.transpose(1, 0))
+		A_path = torch.transpose(A_path, 2, 1)
+		h_path = torch.bmm(F.softmax(A_path, dim=2) , h_path).squeeze(1)
+		h_path = self.path_rho(h_path)
 		
 		### Omic
 		h_omic_trans = self.omic_transformer(h_omic_bag)
-		A_omic, h_omic = self.omic_attention_head(h_omic_trans.squeeze(1))
-		A_omic = torch.transpose(A_omic, 1, 0)
-		h_omic = torch.mm(F.softmax(A_omic, dim=1) , h_omic)
-		h_omic = self.omic_rho(h_omic).squeeze()
+		A_omic, h_omic = self.omic_attention_head(h_omic_trans.transpose(1, 0))
+		A_omic = torch.transpose(A_omic, 2, 1)
+		h_omic = torch.bmm(F.softmax(A_omic, dim=2) , h_omic).squeeze(1)
+		h_omic = self.omic_rho(h_omic)
 		
-		if self.fusion == 'bilinear':
-			h = self.mm(h_path.unsqueeze(dim=0), h_omic.unsqueeze(dim=0)).squeeze()
+		if self.fusion in ['bilinear', 'lrb']:
+			h = self.mm(h_path, h_omic)
 		elif self.fusion == 'concat':
-			h = self.mm(torch.cat([h_path, h_omic], axis=0))
+			h = self.mm(torch.cat([h_path, h_omic], axis=1))
 				
 		### Survival Layer
-		logits = self.classifier(h).unsqueeze(0)
+		logits = self.classifier(h) # B x 4
 		Y_hat = torch.topk(logits, 1, dim = 1)[1]
-		hazards = torch.sigmoid(logits)
+		hazards = torch.sigmoid(logits.float())
 		S = torch.cumprod(1 - hazards, dim=1)
 		
 		attention_scores = {'coattn': A_coattn, 'path': A_path, 'omic': A_omic}
@@ -106,11 +104,10 @@ class MCAT_Surv(nn.Module):
 		x_omic = [x_omic1, x_omic2, x_omic3, x_omic4, x_omic5, x_omic6]
 		h_path_bag = self.wsi_net(x_path)#.unsqueeze(1) ### path embeddings are fed through a FC layer
 		h_path_bag = torch.reshape(h_path_bag, (500, 10, 256))
-		h_omic = [self.sig_networks[idx].forward(sig_feat) for idx, sig_feat in enumerate(x_omic)] ### each omic signature goes through it's own FC layer
-		h_omic_bag = torch.stack(h_omic) ### omic embeddings are stacked (to be used in co-attention)
+		h_omic_bag = self.sig_networks(x_omic) ### each omic signature goes through it's own FC layer
 
 		# Coattn
-		h_path_coattn, A_coattn = self.coattn(h_omic_bag, h_path_bag, h_path_bag)
+		h_path_coattn, A_coattn = self.coattn(h_omic_bag, h_path_bag, h_path_bag, need_weights=False)
 
 		### Path
 		h_path_trans = self.path_transformer(h_path_coattn)
@@ -126,501 +123,14 @@ class MCAT_Surv(nn.Module):
 		A_omic = F.softmax(A_omic.squeeze(dim=2), dim=1).unsqueeze(dim=1)
 		h_omic = torch.bmm(A_omic, h_omic).squeeze(dim=1)
 
-		if self.fusion == 'bilinear':
+		if self.fusion in ['bilinear', 'lrb']:
 			h = self.mm(h_path.unsqueeze(dim=0), h_omic.unsqueeze(dim=0)).squeeze()
 		elif self.fusion == 'concat':
 			h = self.mm(torch.cat([h_path, h_omic], axis=1))
 
 		logits  = self.classifier(h)
-		hazards = torch.sigmoid(logits)
+		hazards = torch.sigmoid(logits.float())
 		S = torch.cumprod(1 - hazards, dim=1)
 
 		risk = -torch.sum(S, dim=1)
 		return risk
-
-
-
-###
-# ========== Modifying PyTorch Functionalities ======================
-###
-from torch.nn.functional import *
-
-def multi_head_attention_forward(
-	query: Tensor,
-	key: Tensor,
-	value: Tensor,
-	embed_dim_to_check: int,
-	num_heads: int,
-	in_proj_weight: Tensor,
-	in_proj_bias: Tensor,
-	bias_k: Optional[Tensor],
-	bias_v: Optional[Tensor],
-	add_zero_attn: bool,
-	dropout_p: float,
-	out_proj_weight: Tensor,
-	out_proj_bias: Tensor,
-	training: bool = True,
-	key_padding_mask: Optional[Tensor] = None,
-	need_weights: bool = True,
-	need_raw: bool = True,
-	attn_mask: Optional[Tensor] = None,
-	use_separate_proj_weight: bool = False,
-	q_proj_weight: Optional[Tensor] = None,
-	k_proj_weight: Optional[Tensor] = None,
-	v_proj_weight: Optional[Tensor] = None,
-	static_k: Optional[Tensor] = None,
-	static_v: Optional[Tensor] = None,
-):
-	r"""
-	Args:
-		query, key, value: map a query and a set of key-value pairs to an output.
-			See "Attention Is All You Need" for more details.
-		embed_dim_to_check: total dimension of the model.
-		num_heads: parallel attention heads.
-		in_proj_weight, in_proj_bias: input projection weight and bias.
-		bias_k, bias_v: bias of the key and value sequences to be added at dim=0.
-		add_zero_attn: add a new batch of zeros to the key and
-					   value sequences at dim=1.
-		dropout_p: probability of an element to be zeroed.
-		out_proj_weight, out_proj_bias: the output projection weight and bias.
-		training: apply dropout if is ``True``.
-		key_padding_mask: if provided, specified padding elements in the key will
-			be ignored by the attention. This is an binary mask. When the value is True,
-			the corresponding value on the attention layer will be filled with -inf.
-		need_weights: output attn_output_weights.
-		attn_mask: 2D or 3D mask that prevents attention to certain positions. A 2D mask will be broadcasted for all
-			the batches while a 3D mask allows to specify a different mask for the entries of each batch.
-		use_separate_proj_weight: the function accept the proj. weights for query, key,
-			and value in different forms. If false, in_proj_weight will be used, which is
-			a combination of q_proj_weight, k_proj_weight, v_proj_weight.
-		q_proj_weight, k_proj_weight, v_proj_weight, in_proj_bias: input projection weight and bias.
-		static_k, static_v: static key and value used for attention operators.
-	Shape:
-		Inputs:
-		- query: :math:`(L, N, E)` where L is the target sequence length, N is the batch size, E is
-		  the embedding dimension.
-		- key: :math:`(S, N, E)`, where S is the source sequence length, N is the batch size, E is
-		  the embedding dimension.
-		- value: :math:`(S, N, E)` where S is the source sequence length, N is the batch size, E is
-		  the embedding dimension.
-		- key_padding_mask: :math:`(N, S)` where N is the batch size, S is the source sequence length.
-		  If a ByteTensor is provided, the non-zero positions will be ignored while the zero positions
-		  will be unchanged. If a BoolTensor is provided, the positions with the
-		  value of ``True`` will be ignored while the position with the value of ``False`` will be unchanged.
-		- attn_mask: 2D mask :math:`(L, S)` where L is the target sequence length, S is the source sequence length.
-		  3D mask :math:`(N*num_heads, L, S)` where N is the batch size, L is the target sequence length,
-		  S is the source sequence length. attn_mask ensures that position i is allowed to attend the unmasked
-		  positions. If a ByteTensor is provided, the non-zero positions are not allowed to attend
-		  while the zero positions will be unchanged. If a BoolTensor is provided, positions with ``True``
-		  are not allowed to attend while ``False`` values will be unchanged. If a FloatTensor
-		  is provided, it will be added to the attention weight.
-		- static_k: :math:`(N*num_heads, S, E/num_heads)`, where S is the source sequence length,
-		  N is the batch size, E is the embedding dimension. E/num_heads is the head dimension.
-		- static_v: :math:`(N*num_heads, S, E/num_heads)`, where S is the source sequence length,
-		  N is the batch size, E is the embedding dimension. E/num_heads is the head dimension.
-		Outputs:
-		- attn_output: :math:`(L, N, E)` where L is the target sequence length, N is the batch size,
-		  E is the embedding dimension.
-		- attn_output_weights: :math:`(N, L, S)` where N is the batch size,
-		  L is the target sequence length, S is the source sequence length.
-	"""
-	tens_ops = (query, key, value, in_proj_weight, in_proj_bias, bias_k, bias_v, out_proj_weight, out_proj_bias)
-	if has_torch_function(tens_ops):
-		return handle_torch_function(
-			multi_head_attention_forward,
-			tens_ops,
-			query,
-			key,
-			value,
-			embed_dim_to_check,
-			num_heads,
-			in_proj_weight,
-			in_proj_bias,
-			bias_k,
-			bias_v,
-			add_zero_attn,
-			dropout_p,
-			out_proj_weight,
-			out_proj_bias,
-			training=training,
-			key_padding_mask=key_padding_mask,
-			need_weights=need_weights,
-			need_raw=need_raw,
-			attn_mask=attn_mask,
-			use_separate_proj_weight=use_separate_proj_weight,
-			q_proj_weight=q_proj_weight,
-			k_proj_weight=k_proj_weight,
-			v_proj_weight=v_proj_weight,
-			static_k=static_k,
-			static_v=static_v,
-		)
-	tgt_len, bsz, embed_dim = query.size()
-	assert embed_dim == embed_dim_to_check
-	# allow MHA to have different sizes for the feature dimension
-	assert key.size(0) == value.size(0) and key.size(1) == value.size(1)
-
-	head_dim = embed_dim // num_heads
-	assert head_dim * num_heads == embed_dim, "embed_dim must be divisible by num_heads"
-	scaling = float(head_dim) ** -0.5
-
-	if not use_separate_proj_weight:
-		if (query is key or torch.equal(query, key)) and (key is value or torch.equal(key, value)):
-			# self-attention
-			q, k, v = linear(query, in_proj_weight, in_proj_bias).chunk(3, dim=-1)
-
-		elif key is value or torch.equal(key, value):
-			# encoder-decoder attention
-			# This is inline in_proj function with in_proj_weight and in_proj_bias
-			_b = in_proj_bias
-			_start = 0
-			_end = embed_dim
-			_w = in_proj_weight[_start:_end, :]
-			if _b is not None:
-				_b = _b[_start:_end]
-			q = linear(query, _w, _b)
-
-			if key is None:
-				assert value is None
-				k = None
-				v = None
-			else:
-
-				# This is inline in_proj function with in_proj_weight and in_proj_bias
-				_b = in_proj_bias
-				_start = embed_dim
-				_end = None
-				_w = in_proj_weight[_start:, :]
-				if _b is not None:
-					_b = _b[_start:]
-				k, v = linear(key, _w, _b).chunk(2, dim=-1)
-
-		else:
-			# This is inline in_proj function with in_proj_weight and in_proj_bias
-			_b = in_proj_bias
-			_start = 0
-			_end = embed_dim
-			_w = in_proj_weight[_start:_end, :]
-			if _b is not None:
-				_b = _b[_start:_end]
-			q = linear(query, _w, _b)
-
-			# This is inline in_proj function with in_proj_weight and in_proj_bias
-			_b = in_proj_bias
-			_start = embed_dim
-			_end = embed_dim * 2
-			_w = in_proj_weight[_start:_end, :]
-			if _b is not None:
-				_b = _b[_start:_end]
-			k = linear(key, _w, _b)
-
-			# This is inline in_proj function with in_proj_weight and in_proj_bias
-			_b = in_proj_bias
-			_start = embed_dim * 2
-			_end = None
-			_w = in_proj_weight[_start:, :]
-			if _b is not None:
-				_b = _b[_start:]
-			v = linear(value, _w, _b)
-	else:
-		q_proj_weight_non_opt = torch.jit._unwrap_optional(q_proj_weight)
-		len1, len2 = q_proj_weight_non_opt.size()
-		assert len1 == embed_dim and len2 == query.size(-1)
-
-		k_proj_weight_non_opt = torch.jit._unwrap_optional(k_proj_weight)
-		len1, len2 = k_proj_weight_non_opt.size()
-		assert len1 == embed_dim and len2 == key.size(-1)
-
-		v_proj_weight_non_opt = torch.jit._unwrap_optional(v_proj_weight)
-		len1, len2 = v_proj_weight_non_opt.size()
-		assert len1 == embed_dim and len2 == value.size(-1)
-
-		if in_proj_bias is not None:
-			q = linear(query, q_proj_weight_non_opt, in_proj_bias[0:embed_dim])
-			k = linear(key, k_proj_weight_non_opt, in_proj_bias[embed_dim : (embed_dim * 2)])
-			v = linear(value, v_proj_weight_non_opt, in_proj_bias[(embed_dim * 2) :])
-		else:
-			q = linear(query, q_proj_weight_non_opt, in_proj_bias)
-			k = linear(key, k_proj_weight_non_opt, in_proj_bias)
-			v = linear(value, v_proj_weight_non_opt, in_proj_bias)
-	q = q * scaling
-
-	if attn_mask is not None:
-		assert (
-			attn_mask.dtype == torch.float32
-			or attn_mask.dtype == torch.float64
-			or attn_mask.dtype == torch.float16
-			or attn_mask.dtype == torch.uint8
-			or attn_mask.dtype == torch.bool
-		), "Only float, byte, and bool types are supported for attn_mask, not {}".format(attn_mask.dtype)
-		if attn_mask.dtype == torch.uint8:
-			warnings.warn("Byte tensor for attn_mask in nn.MultiheadAttention is deprecated. Use bool tensor instead.")
-			attn_mask = attn_mask.to(torch.bool)
-
-		if attn_mask.dim() == 2:
-			attn_mask = attn_mask.unsqueeze(0)
-			if list(attn_mask.size()) != [1, query.size(0), key.size(0)]:
-				raise RuntimeError("The size of the 2D attn_mask is not correct.")
-		elif attn_mask.dim() == 3:
-			if list(attn_mask.size()) != [bsz * num_heads, query.size(0), key.size(0)]:
-				raise RuntimeError("The size of the 3D attn_mask is not correct.")
-		else:
-			raise RuntimeError("attn_mask's dimension {} is not supported".format(attn_mask.dim()))
-		# attn_mask's dim is 3 now.
-
-	# convert ByteTensor key_padding_mask to bool
-	if key_padding_mask is not None and key_padding_mask.dtype == torch.uint8:
-		warnings.warn(
-			"Byte tensor for key_padding_mask in nn.MultiheadAttention is deprecated. Use bool tensor instead."
-		)
-		key_padding_mask = key_padding_mask.to(torch.bool)
-
-	if bias_k is not None and bias_v is not None:
-		if static_k is None and static_v is None:
-			k = torch.cat([k, bias_k.repeat(1, bsz, 1)])
-			v = torch.cat([v, bias_v.repeat(1, bsz, 1)])
-			if attn_mask is not None:
-				attn_mask = pad(attn_mask, (0, 1))
-			if key_padding_mask is not None:
-				key_padding_mask = pad(key_padding_mask, (0, 1))
-		else:
-			assert static_k is None, "bias cannot be added to static key."
-			assert static_v is None, "bias cannot be added to static value."
-	else:
-		assert bias_k is None
-		assert bias_v is None
-
-	q = q.contiguous().view(tgt_len, bsz * num_heads, head_dim).transpose(0, 1)
-	if k is not None:
-		k = k.contiguous().view(-1, bsz * num_heads, head_dim).transpose(0, 1)
-	if v is not None:
-		v = v.contiguous().view(-1, bsz * num_heads, head_dim).transpose(0, 1)
-
-	if static_k is not None:
-		assert static_k.size(0) == bsz * num_heads
-		assert static_k.size(2) == head_dim
-		k = static_k
-
-	if static_v is not None:
-		assert static_v.size(0) == bsz * num_heads
-		assert static_v.size(2) == head_dim
-		v = static_v
-
-	src_len = k.size(1)
-
-	if key_padding_mask is not None:
-		assert key_padding_mask.size(0) == bsz
-		assert key_padding_mask.size(1) == src_len
-
-	if add_zero_attn:
-		src_len += 1
-		k = torch.cat([k, torch.zeros((k.size(0), 1) + k.size()[2:], dtype=k.dtype, device=k.device)], dim=1)
-		v = torch.cat([v, torch.zeros((v.size(0), 1) + v.size()[2:], dtype=v.dtype, device=v.device)], dim=1)
-		if attn_mask is not None:
-			attn_mask = pad(attn_mask, (0, 1))
-		if key_padding_mask is not None:
-			key_padding_mask = pad(key_padding_mask, (0, 1))
-
-	attn_output_weights = torch.bmm(q, k.transpose(1, 2))
-	assert list(attn_output_weights.size()) == [bsz * num_heads, tgt_len, src_len]
-
-	if attn_mask is not None:
-		if attn_mask.dtype == torch.bool:
-			attn_output_weights.masked_fill_(attn_mask, float("-inf"))
-		else:
-			attn_output_weights += attn_mask
-
-	if key_padding_mask is not None:
-		attn_output_weights = attn_output_weights.view(bsz, num_heads, tgt_len, src_len)
-		attn_output_weights = attn_output_weights.masked_fill(
-			key_padding_mask.unsqueeze(1).unsqueeze(2),
-			float("-inf"),
-		)
-		attn_output_weights = attn_output_weights.view(bsz * num_heads, tgt_len, src_len)
-	
-	attn_output_weights_raw = attn_output_weights
-	attn_output_weights = softmax(attn_output_weights, dim=-1)
-	attn_output_weights = dropout(attn_output_weights, p=dropout_p, training=training)
-
-	attn_output = torch.bmm(attn_output_weights, v)
-	assert list(attn_output.size()) == [bsz * num_heads, tgt_len, head_dim]
-	attn_output = attn_output.transpose(0, 1).contiguous().view(tgt_len, bsz, embed_dim)
-	attn_output = linear(attn_output, out_proj_weight, out_proj_bias)
-	
-	if need_weights:
-		if need_raw:
-			
-			attn_output_weights_raw = attn_output_weights_raw.view(bsz, num_heads, tgt_len, src_len)
-			return attn_output,attn_output_weights_raw
-			
-			#attn_output_weights = attn_output_weights.view(bsz, num_heads, tgt_len, src_len)
-			#return attn_output, attn_output_weights.sum(dim=1) / num_heads, attn_output_weights_raw, attn_output_weights_raw.sum(dim=1) / num_heads
-		else:
-			# average attention weights over heads
-			attn_output_weights = attn_output_weights.view(bsz, num_heads, tgt_len, src_len)
-			return attn_output, attn_output_weights.sum(dim=1) / num_heads
-	else:
-		return attn_output, None
-
-import torch
-from torch import Tensor
-from torch.nn.init import xavier_uniform_
-from torch.nn.init import constant_
-from torch.nn.init import xavier_normal_
-from torch.nn.parameter import Parameter
-from torch.nn import Module
-
-class MultiheadAttention(Module):
-	r"""Allows the model to jointly attend to information
-	from different representation subspaces.
-	See reference: Attention Is All You Need
-
-	.. math::
-		\text{MultiHead}(Q, K, V) = \text{Concat}(head_1,\dots,head_h)W^O
-		\text{where} head_i = \text{Attention}(QW_i^Q, KW_i^K, VW_i^V)
-
-	Args:
-		embed_dim: total dimension of the model.
-		num_heads: parallel attention heads.
-		dropout: a Dropout layer on attn_output_weights. Default: 0.0.
-		bias: add bias as module parameter. Default: True.
-		add_bias_kv: add bias to the key and value sequences at dim=0.
-		add_zero_attn: add a new batch of zeros to the key and
-					   value sequences at dim=1.
-		kdim: total number of features in key. Default: None.
-		vdim: total number of features in value. Default: None.
-
-		Note: if kdim and vdim are None, they will be set to embed_dim such that
-		query, key, and value have the same number of features.
-
-	Examples::
-
-		>>> multihead_attn = nn.MultiheadAttention(embed_dim, num_heads)
-		>>> attn_output, attn_output_weights = multihead_attn(query, key, value)
-	"""
-	bias_k: Optional[torch.Tensor]
-	bias_v: Optional[torch.Tensor]
-
-	def __init__(self, embed_dim, num_heads, dropout=0., bias=True, add_bias_kv=False, add_zero_attn=False, kdim=None, vdim=None):
-		super(MultiheadAttention, self).__init__()
-		self.embed_dim = embed_dim
-		self.kdim = kdim if kdim is not None else embed_dim
-		self.vdim = vdim if vdim is not None else embed_dim
-		self._qkv_same_embed_dim = self.kdim == embed_dim and self.vdim == embed_dim
-
-		self.num_heads = num_heads
-		self.dropout = dropout
-		self.head_dim = embed_dim // num_heads
-		assert self.head_dim * num_heads == self.embed_dim, "embed_dim must be divisible by num_heads"
-
-		if self._qkv_same_embed_dim is False:
-			self.q_proj_weight = Parameter(torch.Tensor(embed_dim, embed_dim))
-			self.k_proj_weight = Parameter(torch.Tensor(embed_dim, self.kdim))
-			self.v_proj_weight = Parameter(torch.Tensor(embed_dim, self.vdim))
-			self.register_parameter('in_proj_weight', None)
-		else:
-			self.in_proj_weight = Parameter(torch.empty(3 * embed_dim, embed_dim))
-			self.register_parameter('q_proj_weight', None)
-			self.register_parameter('k_proj_weight', None)
-			self.register_parameter('v_proj_weight', None)
-
-		if bias:
-			self.in_proj_bias = Parameter(torch.empty(3 * embed_dim))
-		else:
-			self.register_parameter('in_proj_bias', None)
-		self.out_proj = nn.Linear(embed_dim, embed_dim)
-
-		if add_bias_kv:
-			self.bias_k = Parameter(torch.empty(1, 1, embed_dim))
-			self.bias_v = Parameter(torch.empty(1, 1, embed_dim))
-		else:
-			self.bias_k = self.bias_v = None
-
-		self.add_zero_attn = add_zero_attn
-
-		self._reset_parameters()
-
-	def _reset_parameters(self):
-		if self._qkv_same_embed_dim:
-			xavier_uniform_(self.in_proj_weight)
-		else:
-			xavier_uniform_(self.q_proj_weight)
-			xavier_uniform_(self.k_proj_weight)
-			xavier_uniform_(self.v_proj_weight)
-
-		if self.in_proj_bias is not None:
-			constant_(self.in_proj_bias, 0.)
-			constant_(self.out_proj.bias, 0.)
-		if self.bias_k is not None:
-			xavier_normal_(self.bias_k)
-		if self.bias_v is not None:
-			xavier_normal_(self.bias_v)
-
-	def __setstate__(self, state):
-		# Support loading old MultiheadAttention checkpoints generated by v1.1.0
-		if '_qkv_same_embed_dim' not in state:
-			state['_qkv_same_embed_dim'] = True
-
-		super(MultiheadAttention, self).__setstate__(state)
-
-	def forward(self, query, key, value, key_padding_mask=None,
-				need_weights=True, need_raw=True, attn_mask=None):
-		# type: (Tensor, Tensor, Tensor, Optional[Tensor], bool, Optional[Tensor]) -> Tuple[Tensor, Optional[Tensor]]
-		r"""
-	Args:
-		query, key, value: map a query and a set of key-value pairs to an output.
-			See "Attention Is All You Need" for more details.
-		key_padding_mask: if provided, specified padding elements in the key will
-			be ignored by the attention. When given a binary mask and a value is True,
-			the corresponding value on the attention layer will be ignored. When given
-			a byte mask and a value is non-zero, the corresponding value on the attention
-			layer will be ignored
-		need_weights: output attn_output_weights.
-		attn_mask: 2D or 3D mask that prevents attention to certain positions. A 2D mask will be broadcasted for all
-			the batches while a 3D mask allows to specify a different mask for the entries of each batch.
-
-	Shape:
-		- Inputs:
-		- query: :math:`(L, N, E)` where L is the target sequence length, N is the batch size, E is
-		  the embedding dimension.
-		- key: :math:`(S, N, E)`, where S is the source sequence length, N is the batch size, E is
-		  the embedding dimension.
-		- value: :math:`(S, N, E)` where S is the source sequence length, N is the batch size, E is
-		  the embedding dimension.
-		- key_padding_mask: :math:`(N, S)` where N is the batch size, S is the source sequence length.
-		  If a ByteTensor is provided, the non-zero positions will be ignored while the position
-		  with the zero positions will be unchanged. If a BoolTensor is provided, the positions with the
-		  value of ``True`` will be ignored while the position with the value of ``False`` will be unchanged.
-		- attn_mask: 2D mask :math:`(L, S)` where L is the target sequence length, S is the source sequence length.
-		  3D mask :math:`(N*num_heads, L, S)` where N is the batch size, L is the target sequence length,
-		  S is the source sequence length. attn_mask ensure that position i is allowed to attend the unmasked
-		  positions. If a ByteTensor is provided, the non-zero positions are not allowed to attend
-		  while the zero positions will be unchanged. If a BoolTensor is provided, positions with ``True``
-		  is not allowed to attend while ``False`` values will be unchanged. If a FloatTensor
-		  is provided, it will be added to the attention weight.
-
-		- Outputs:
-		- attn_output: :math:`(L, N, E)` where L is the target sequence length, N is the batch size,
-		  E is the embedding dimension.
-		- attn_output_weights: :math:`(N, L, S)` where N is the batch size,
-		  L is the target sequence length, S is the source sequence length.
-		"""
-		if not self._qkv_same_embed_dim:
-			return multi_head_attention_forward(
-				query, key, value, self.embed_dim, self.num_heads,
-				self.in_proj_weight, self.in_proj_bias,
-				self.bias_k, self.bias_v, self.add_zero_attn,
-				self.dropout, self.out_proj.weight, self.out_proj.bias,
-				training=self.training,
-				key_padding_mask=key_padding_mask, need_weights=need_weights, need_raw=need_raw,
-				attn_mask=attn_mask, use_separate_proj_weight=True,
-				q_proj_weight=self.q_proj_weight, k_proj_weight=self.k_proj_weight,
-				v_proj_weight=self.v_proj_weight)
-		else:
-			return multi_head_attention_forward(
-				query, key, value, self.embed_dim, self.num_heads,
-				self.in_proj_weight, self.in_proj_bias,
-				self.bias_k, self.bias_v, self.add_zero_attn,
-				self.dropout, self.out_proj.weight, self.out_proj.bias,
-				training=self.training,
-				key_padding_mask=key_padding_mask, need_weights=need_weights, need_raw=need_raw,
-				attn_mask=attn_mask)
\ No newline at end of file
@@ -34,18 +34,13 @@ class SNN(nn.Module):
 
         logits = self.classifier(features).unsqueeze(0)
         Y_hat = torch.topk(logits, 1, dim=1)[1]
-        hazards = torch.sigmoid(logits)
+        hazards = torch.sigmoid(logits.float())
         S = torch.cumprod(1 - hazards, dim=1)
         return hazards, S
 
-    def relocate(self):
-        device=torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-        if torch.cuda.device_count() > 1:
+    def relocate(self, device=None):
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu") if device is None else torch.device(device)
+        if device.type == 'cuda' and torch.cuda.device_count() > 1:
             device_ids = list(range(torch.cuda.device_count()))
-            self.fc_omic = nn.DataParallel(self.fc_omic, device_ids=device_ids).to('cuda:0')
-        else:
-            self.fc_omic = self.fc_omic.to(device)
-
-
-        self.classifier = self.classifier.to(device)
\ No newline at end of file
+            self.fc_omic = nn.DataParallel(self.fc_omic, device_ids=device_ids)
+        return self.to(device)
@@ -5,16 +5,24 @@ import torch.nn as nn
 
 import ot
 from mmsurv.models.model_utils import *
+from mmsurv.models.ot_util import sinkhorn_log
 
 
 class OT_Attn_assem(nn.Module):
-    def __init__(self,impl='pot-uot-l2',ot_reg=0.1, ot_tau=0.5) -> None:
+    def __init__(self,impl='pot-uot-l2',ot_reg=0.1, ot_tau=0.5, ot_fp32=False) -> None:
         super().__init__()
         self.impl = impl
         self.ot_reg = ot_reg
         self.ot_tau = ot_tau
+        self.ot_dtype = torch.float32 if ot_fp32 else torch.float64
+        self.reset_stats()
         print("ot impl: ", impl)
     
+    def reset_stats(self):
+        # Sinkhorn iterations and number of plans solved by the torch solver
+        self.n_iter, self.n_solve = 0, 0
+        self.last_log = None
+
     def normalize_feature(self,x):
         x = x - x.min(-1)[0].unsqueeze(-1)
         return x
@@ -52,7 +60,7 @@ class OT_Attn_assem(nn.Module):
             
             flow = ot.unbalanced.sinkhorn_knopp_unbalanced(a=a, b=b, 
                                 M=M_cost.double(), reg=self.ot_reg,reg_m=self.ot_tau)
-            flow = flow.type(torch.FloatTensor).cuda()
+            flow = flow.to(weight1.dtype)
             
             dist = self.cost_map * flow # (N, M)
             dist = torch.sum(dist) # (1,) float
@@ -61,21 +69,70 @@ class OT_Attn_assem(nn.Module):
         else:
             raise NotImplementedError
 
+    def OT_batch(self, weight1, weight2, mask=None, warmstart=None):
+        """
+        Torch solver, over a batch of bags at once
+        Parmas:
+            weight1 : (B, N, D)
+            weight2 : (B, M, D)
+            mask : (B, N), True on the padded instances
+            warmstart : (B, N) and (B, M) log-scalings to start the solver from, see SinkhornCache
         
+        Return:
+            flow : (B, N, M)
+            dist : (B, )
+        """
+        cost_map = torch.cdist(weight1, weight2)**2 # (B, N, M)
+        valid = torch.ones(weight1.shape[:2], dtype=torch.bool, device=weight1.device) if mask is None else ~mask
+        
+        cost_map_detach = cost_map.detach().masked_fill(~valid.unsqueeze(2), 0).to(self.ot_dtype)
+        M_cost = cost_map_detach / cost_map_detach.amax(dim=(1, 2), keepdim=True)
+        
+        if self.impl == "torch-sinkhorn-l2":
+            src_weight = weight1.detach().sum(dim=2).masked_fill(~valid, 0).to(self.ot_dtype)
+            a = src_weight / src_weight.sum(dim=1, keepdim=True)
+            dst_weight = weight2.detach().sum(dim=2).to(self.ot_dtype)
+            b = dst_weight / dst_weight.sum(dim=1, keepdim=True)
+            flow, log = sinkhorn_log(a, b, M_cost, reg=self.ot_reg, stopThr=1e-9, warmstart=warmstart)
+        elif self.impl == "torch-uot-l2":
+            a = valid.to(self.ot_dtype) / valid.sum(dim=1, keepdim=True)
+            b = torch.full(weight2.shape[:2], 1. / weight2.shape[1], dtype=self.ot_dtype, device=weight2.device)
+            flow, log = sinkhorn_log(a, b, M_cost, reg=self.ot_reg, reg_m=self.ot_tau, warmstart=warmstart)
+        else:
+            raise NotImplementedError
+        self.n_iter += int(log['niter'].sum())
+        self.n_solve += len(flow)
+        self.last_log = log
+        
+        flow = flow.to(weight1.dtype)
+        dist = torch.sum(cost_map * flow, dim=(1, 2)) # (B,)
+        return flow, dist
 
-    def forward(self,x,y):
+    def forward(self,x,y,mask=None,warmstart=None):
         '''
-        x: (N, 1, D)
-        y: (M, 1, D)
+        x: (N, B, D)
+        y: (M, B, D)
+        mask: (B, N), True on the padded instances of x
+        warmstart: log-scalings of a previous solve, torch solvers only
         '''
-        x = x.squeeze()
-        y = y.squeeze()
-        
-        x = self.normalize_feature(x)
-        y = self.normalize_feature(y)
-        
-        pi, dist = self.OT(x, y)
-        return pi.T.unsqueeze(0).unsqueeze(0), dist
+        # the costs and plans stay in float32 (or float64) under autocast
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            x = self.normalize_feature(x.transpose(1, 0).float())
+            y = self.normalize_feature(y.transpose(1, 0).float())
+        
+            if self.impl.startswith("torch"):
+                pi, dist = self.OT_batch(x, y, mask, warmstart)
+            else:
+                # POT solves the bags one by one
+                pi = torch.zeros(x.shape[0], x.shape[1], y.shape[1], dtype=x.dtype, device=x.device)
+                dist = []
+                for b in range(x.shape[0]):
+                    n = x.shape[1] if mask is None else int((~mask[b]).sum())
+                    pi_b, dist_b = self.OT(x[b, :n], y[b])
+                    pi[b, :n] = pi_b
+                    dist.append(dist_b)
+                dist = torch.stack(dist)
+        return pi.transpose(1, 2).unsqueeze(1), dist
 
        
 #############################
@@ -83,7 +140,7 @@ class OT_Attn_assem(nn.Module):
 #############################
 class MOTCAT_Surv(nn.Module):
     def __init__(self, path_input_dim, fusion='concat', omic_sizes=[100, 200, 300, 400, 500, 600], n_classes=4,
-                 model_size_wsi: str='small', model_size_omic: str='small', dropout=0.25,ot_reg=0.1, ot_tau=0.5, ot_impl="pot-uot-l2"):
+                 model_size_wsi: str='small', model_size_omic: str='small', dropout=0.25,ot_reg=0.1, ot_tau=0.5, ot_impl="pot-uot-l2", ot_fp32=False):
         super(MOTCAT_Surv, self).__init__()
         self.fusion = fusion
         self.omic_sizes = omic_sizes
@@ -97,18 +154,12 @@ class MOTCAT_Surv(nn.Module):
         fc.append(nn.Dropout(0.25))
         self.wsi_net = nn.Sequential(*fc)
         
-        ### Constructing Genomic SNN
+        ### Constructing Genomic SNN, one per signature
         hidden = self.size_dict_omic[model_size_omic]
-        sig_networks = []
-        for input_dim in omic_sizes:
-            fc_omic = [SNN_Block(dim1=input_dim, dim2=hidden[0])]
-            for i, _ in enumerate(hidden[1:]):
-                fc_omic.append(SNN_Block(dim1=hidden[i], dim2=hidden[i+1], dropout=0.25))
-            sig_networks.append(nn.Sequential(*fc_omic))
-        self.sig_networks = nn.ModuleList(sig_networks)
+        self.sig_networks = SNN_Signatures(omic_sizes, hidden=hidden, dropout=0.25)
 
         ### OT-based Co-attention
-        self.coattn = OT_Attn_assem(impl=ot_impl,ot_reg=ot_reg,ot_tau=ot_tau)
+        self.coattn = OT_Attn_assem(impl=ot_impl,ot_reg=ot_reg,ot_tau=ot_tau,ot_fp32=ot_fp32)
 
         ### Path Transformer + Attention Head
         path_encoder_layer = nn.TransformerEncoderLayer(d_model=256, nhead=8, dim_feedforward=512, dropout=dropout, activation='relu')
@@ -127,50 +178,59 @@ class MOTCAT_Surv(nn.Module):
             self.mm = nn.Sequential(*[nn.Linear(256*2, size[2]), nn.ReLU(), nn.Linear(size[2], size[2]), nn.ReLU()])
         elif self.fusion == 'bilinear':
             self.mm = BilinearFusion(dim1=256, dim2=256, scale_dim1=8, scale_dim2=8, mmhid=256)
+        elif self.fusion == 'lrb':
+            self.mm = LRBilinearFusion(dim1=256, dim2=256, scale_dim1=8, scale_dim2=8, mmhid=256)
         else:
             self.mm = None
         
         ### Classifier
         self.classifier = nn.Linear(size[2], n_classes)
+        self.checkpoint_blocks = ['wsi_net']  # recomputed in the backward with --checkpoint_activations, not the OT co-attention whose solves are counted and cached
 
     def forward(self, **kwargs):
         x_path = kwargs['x_path']
-        x_omic = [kwargs['x_omic%d' % i] for i in range(1,7)]   
+        x_omic = [kwargs['x_omic%d' % i] for i in range(1,len(self.omic_sizes)+1)]   
+        mask = kwargs.get('mask') # B x N, True on the padded instances of a batch of bags
+        bag_ids = kwargs.get('bag_ids') # B, patient of each bag when the bags are micro-batches of fewer patients
+        if x_path.dim() == 2:
+            x_path, x_omic = x_path.unsqueeze(0), [sig_feat.unsqueeze(0) if sig_feat.dim() == 1 else sig_feat for sig_feat in x_omic]
         
-        h_path_bag = self.wsi_net(x_path).unsqueeze(1) ### path embeddings are fed through a FC layer
+        h_path_bag = self.wsi_net(x_path) ### path embeddings are fed through a FC layer, B x N x 256
 
-        h_omic = [self.sig_networks[idx].forward(sig_feat) for idx, sig_feat in enumerate(x_omic)] ### each omic signature goes through it's own FC layer
-        h_omic_bag = torch.stack(h_omic).unsqueeze(1) ### omic embeddings are stacked (to be used in co-attention)
+        h_omic_bag = self.sig_networks(x_omic) ### each omic signature goes through it's own FC layer, S x P x 256 (to be used in co-attention), once per patient
+        h_omic_coattn = h_omic_bag if bag_ids is None else h_omic_bag[:, bag_ids] # S x B x 256
 
-        ### Coattn
-        A_coattn, _ = self.coattn(h_path_bag, h_omic_bag)
-        h_path_coattn = torch.mm(A_coattn.squeeze(), h_path_bag.squeeze()).unsqueeze(1)
+        ### Coattn, the transport plan of each bag is computed on its own instances
+        A_coattn, _ = self.coattn(h_path_bag.transpose(1, 0), h_omic_coattn, mask=mask, warmstart=kwargs.get('ot_warmstart')) # B x 1 x S x N
+        h_path_coattn = torch.bmm(A_coattn.squeeze(1), h_path_bag).transpose(1, 0) # S x B x 256
 
         ### Path
         h_path_trans = self.path_transformer(h_path_coattn)
-        A_path, h_path = self.path_attention_head(h_path_trans.squeeze(1))
-        A_path = torch.transpose(A_path, 1, 0)
-        h_path = torch.mm(F.softmax(A_path, dim=1) , h_path)
-        h_path = self.path_rho(h_path).squeeze()
+        A_path, h_path = self.path_attention_head(h_path_trans.transpose(1, 0))
+        A_path = torch.transpose(A_path, 2, 1)
+        h_path = torch.bmm(F.softmax(A_path, dim=2) , h_path).squeeze(1)
+        h_path = self.path_rho(h_path)
         
         ### Omic
         h_omic_trans = self.omic_transformer(h_omic_bag)
-        A_omic, h_omic = self.omic_attention_head(h_omic_trans.squeeze(1))
-        A_omic = torch.transpose(A_omic, 1, 0)
-        h_omic = torch.mm(F.softmax(A_omic, dim=1) , h_omic)
-        h_omic = self.omic_rho(h_omic).squeeze()
-        
-        if self.fusion == 'bilinear':
-            h = self.mm(h_path.unsqueeze(dim=0), h_omic.unsqueeze(dim=0)).squeeze()
+        A_omic, h_omic = self.omic_attention_head(h_omic_trans.transpose(1, 0))
+        A_omic = torch.transpose(A_omic, 2, 1)
+        h_omic = torch.bmm(F.softmax(A_omic, dim=2) , h_omic).squeeze(1)
+        h_omic = self.omic_rho(h_omic)
+        if bag_ids is not None:
+            h_omic = h_omic[bag_ids]
+        
+        if self.fusion in ['bilinear', 'lrb']:
+            h = self.mm(h_path, h_omic)
         elif self.fusion == 'concat':
-            h = self.mm(torch.cat([h_path, h_omic], axis=0))
+            h = self.mm(torch.cat([h_path, h_omic], axis=1))
                 
         ### Survival Layer
-        logits = self.classifier(h).unsqueeze(0)
+        logits = self.classifier(h) # B x 4
         Y_hat = torch.topk(logits, 1, dim = 1)[1]
-        hazards = torch.sigmoid(logits)
+        hazards = torch.sigmoid(logits.float())
         S = torch.cumprod(1 - hazards, dim=1)
         
         attention_scores = {'coattn': A_coattn, 'path': A_path, 'omic': A_omic}
         
-        return hazards, S, Y_hat, attention_scores
\ No newline at end of file
+        return hazards, S, Y_hat, attention_scores
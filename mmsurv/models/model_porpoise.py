@@ -1,72 +1,9 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from mmsurv.models.model_utils import attention_pool, topk_attention_pool, ragged_bags, stream_attention_pool, LRBilinearFusion, Attn_Net_Gated
 
 
-class LRBilinearFusion(nn.Module):
-    def __init__(self, skip=0, use_bilinear=0, gate1=1, gate2=1, dim1=128, dim2=128, 
-                 scale_dim1=1, scale_dim2=1, dropout_rate=0.25,
-                rank=16, output_dim=4):
-        super(LRBilinearFusion, self).__init__()
-        self.skip = skip
-        self.use_bilinear = use_bilinear
-        self.gate1 = gate1
-        self.gate2 = gate2
-        self.rank = rank
-        self.output_dim = output_dim
-
-        dim1_og, dim2_og, dim1, dim2 = dim1, dim2, dim1//scale_dim1, dim2//scale_dim2
-        skip_dim = dim1_og+dim2_og if skip else 0
-
-        self.linear_h1 = nn.Sequential(nn.Linear(dim1_og, dim1), nn.ReLU())
-        self.linear_z1 = nn.Bilinear(dim1_og, dim2_og, dim1) if use_bilinear else nn.Sequential(nn.Linear(dim1_og+dim2_og, dim1))
-        self.linear_o1 = nn.Sequential(nn.Linear(dim1, dim1), nn.ReLU(), nn.Dropout(p=dropout_rate))
-
-        self.linear_h2 = nn.Sequential(nn.Linear(dim2_og, dim2), nn.ReLU())
-        self.linear_z2 = nn.Bilinear(dim1_og, dim2_og, dim2) if use_bilinear else nn.Sequential(nn.Linear(dim1_og+dim2_og, dim2))
-        self.linear_o2 = nn.Sequential(nn.Linear(dim2, dim2), nn.ReLU(), nn.Dropout(p=dropout_rate))
-        
-        
-        self.h1_factor = nn.Parameter(torch.Tensor(self.rank, dim1 + 1, output_dim))
-        self.h2_factor = nn.Parameter(torch.Tensor(self.rank, dim2 + 1, output_dim))
-        self.fusion_weights = nn.Parameter(torch.Tensor(1, self.rank))
-        self.fusion_bias = nn.Parameter(torch.Tensor(1, self.output_dim))
-        nn.init.xavier_normal_(self.h1_factor)
-        nn.init.xavier_normal_(self.h2_factor)
-        nn.init.xavier_normal_(self.fusion_weights)
-        self.fusion_bias.data.fill_(0)
-
-        #init_max_weights(self)
-
-    def forward(self, vec1, vec2):
-        ### Gated Multimodal Units
-        if self.gate1:
-            h1 = self.linear_h1(vec1)
-            z1 = self.linear_z1(vec1, vec2) if self.use_bilinear else self.linear_z1(torch.cat((vec1, vec2), dim=1))
-            o1 = self.linear_o1(nn.Sigmoid()(z1)*h1)
-        else:
-            h1 = F.dropout(self.linear_h1(vec1), 0.25)
-            o1 = self.linear_o1(h1)
-
-        if self.gate2:
-            h2 = self.linear_h2(vec2)
-            z2 = self.linear_z2(vec1, vec2) if self.use_bilinear else self.linear_z2(torch.cat((vec1, vec2), dim=1))
-            o2 = self.linear_o2(nn.Sigmoid()(z2)*h2)
-        else:
-            h2 = F.dropout(self.linear_h2(vec2), 0.25)
-            o2 = self.linear_o2(h2)
-
-        ### Fusion
-        DTYPE = torch.cuda.FloatTensor
-        _o1 = torch.cat((nn.Parameter(torch.ones(1, 1).type(DTYPE), requires_grad=False), o1), dim=1)
-        _o2 = torch.cat((nn.Parameter(torch.ones(1, 1).type(DTYPE), requires_grad=False), o2), dim=1)
-        o1_fusion = torch.matmul(_o1, self.h1_factor)
-        o2_fusion = torch.matmul(_o2, self.h2_factor)
-        fusion_zy = o1_fusion * o2_fusion
-        output = torch.matmul(self.fusion_weights, fusion_zy.permute(1, 0, 2)).squeeze() + self.fusion_bias
-        output = output.view(-1, self.output_dim)
-        return output
-
 class BilinearFusion(nn.Module):
     def __init__(self, skip=0, use_bilinear=0, gate1=1, gate2=1, dim1=128, dim2=128, scale_dim1=1, scale_dim2=1, mmhid=256, dropout_rate=0.25):
         super(BilinearFusion, self).__init__()
@@ -110,8 +47,8 @@ class BilinearFusion(nn.Module):
             o2 = self.linear_o2(h2)
 
         ### Fusion
-        o1 = torch.cat((o1, torch.cuda.FloatTensor(o1.shape[0], 1).fill_(1)), 1)
-        o2 = torch.cat((o2, torch.cuda.FloatTensor(o2.shape[0], 1).fill_(1)), 1)
+        o1 = torch.cat((o1, o1.new_ones(o1.shape[0], 1)), 1)
+        o2 = torch.cat((o2, o2.new_ones(o2.shape[0], 1)), 1)
         o12 = torch.bmm(o1.unsqueeze(2), o2.unsqueeze(1)).flatten(start_dim=1) # BATCH_SIZE X 1024
         out = self.post_fusion_dropout(o12)
         out = self.encoder1(out)
@@ -159,49 +96,6 @@ class Attn_Net(nn.Module):
     def forward(self, x):
         return self.module(x), x # N x n_classes
 
-"""
-Attention Network with Sigmoid Gating (3 fc layers)
-args:
-    L: input feature dimension
-    D: hidden layer dimension
-    dropout: whether to use dropout (p = 0.25)
-    n_classes: number of classes (experimental usage for multiclass MIL)
-"""
-class Attn_Net_Gated(nn.Module):
-
-    def __init__(self, L = 1024, D = 256, dropout = False, n_classes = 1):
-        super(Attn_Net_Gated, self).__init__()
-        self.attention_a = [
-            nn.Linear(L, D),
-            nn.Tanh()]
-        
-        self.attention_b = [nn.Linear(L, D),
-                            nn.Sigmoid()]
-        if dropout:
-            self.attention_a.append(nn.Dropout(0.25))
-            self.attention_b.append(nn.Dropout(0.25))
-
-        self.attention_a = nn.Sequential(*self.attention_a)
-        self.attention_b = nn.Sequential(*self.attention_b)
-        
-        self.attention_c = nn.Linear(D, n_classes)
-
-    def forward(self, x):
-        a = self.attention_a(x)
-        b = self.attention_b(x)
-        A = a.mul(b)
-        A = self.attention_c(A)  # N x n_classes
-        return A, x
-
-
-
-
-
-
-
-"""
-
-"""
 
 def initialize_weights(module):
     for m in module.modules():
@@ -226,22 +120,29 @@ class PorpoiseAMIL(nn.Module):
         self.attention_net = nn.Sequential(*fc)
         
         self.classifier = nn.Linear(size[1], n_classes)
+        self.checkpoint_blocks = ['attention_net']  # recomputed in the backward with --checkpoint_activations
         initialize_weights(self)
                 
                 
-    def relocate(self):
-        device=torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        if torch.cuda.device_count() > 1:
+    def relocate(self, device=None):
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu") if device is None else torch.device(device)
+        if device.type == 'cuda' and torch.cuda.device_count() > 1:
             device_ids = list(range(torch.cuda.device_count()))
-            self.attention_net = nn.DataParallel(self.attention_net, device_ids=device_ids).to('cuda:0')
-        else:
-            self.attention_net = self.attention_net.to(device)
-
-        self.classifier = self.classifier.to(device)
+            self.attention_net = nn.DataParallel(self.attention_net, device_ids=device_ids)
+        return self.to(device)
 
 
     def forward(self, **kwargs):
+        if 'x_path_chunks' in kwargs:
+            # bags streamed from the store chunk by chunk (inference)
+            M = stream_attention_pool(self.attention_net, kwargs['x_path_chunks'])
+            h  = self.classifier(M)
+            hazards = torch.sigmoid(h.float())
+            S = torch.cumprod(1 - hazards, dim=1)
+            return hazards, S
+
         h = kwargs['x_path']
+        bag_ids, num_bags = ragged_bags(kwargs.get('bag_offsets')) # several bags concatenated in x_path
 
         A, h = self.attention_net(h)  
         A = torch.transpose(A, 1, 0)
@@ -251,10 +152,9 @@ class PorpoiseAMIL(nn.Module):
                 return A
 
         A_raw = A 
-        A = F.softmax(A, dim=1) 
-        M = torch.mm(A, h) 
+        M, A = attention_pool(A.squeeze(0), h, bag_ids, num_bags)
         h  = self.classifier(M)
-        hazards = torch.sigmoid(h)
+        hazards = torch.sigmoid(h.float())
         S = torch.cumprod(1 - hazards, dim=1)
         return hazards, S
 
@@ -290,9 +190,13 @@ class PorpoiseMMF(nn.Module):
         dropinput=0.10,
         use_mlp=False,
         size_arg = "small",
+        topk_instances=0,
+        random_instances=0,
         ):
         super(PorpoiseMMF, self).__init__()
         self.fusion = fusion
+        self.topk_instances = topk_instances # backward through the top-k and random_instances other patches only, see topk_attention_pool
+        self.random_instances = random_instances
         self.size_dict_path = {"small": [path_input_dim, 512, 256], "big": [path_input_dim, 512, 384]}
         self.size_dict_omic = {'small': [256, 256]}
         self.n_classes = n_classes
@@ -326,49 +230,54 @@ class PorpoiseMMF(nn.Module):
             elif self.fusion == 'bilinear':
                 self.mm = BilinearFusion(dim1=256, dim2=256, scale_dim1=scale_dim1, gate1=gate_path, scale_dim2=scale_dim2, gate2=gate_omic, skip=skip, mmhid=256)
             elif self.fusion == 'lrb':
-                self.mm = LRBilinearFusion(dim1=256, dim2=256, scale_dim1=scale_dim1, gate1=gate_path, scale_dim2=scale_dim2, gate2=gate_omic)
+                self.mm = LRBilinearFusion(dim1=256, dim2=256, scale_dim1=scale_dim1, gate1=gate_path, scale_dim2=scale_dim2, gate2=gate_omic, mmhid=256)
             else:
                 self.mm = None
 
         self.classifier_mm = nn.Linear(size[2], n_classes)
+        self.checkpoint_blocks = ['attention_net']  # recomputed in the backward with --checkpoint_activations
 
 
-    def relocate(self):
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        if torch.cuda.device_count() >= 1:
+    def relocate(self, device=None):
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu") if device is None else torch.device(device)
+        if device.type == 'cuda' and torch.cuda.device_count() > 1:
             device_ids = list(range(torch.cuda.device_count()))
-            self.attention_net = nn.DataParallel(self.attention_net, device_ids=device_ids).to('cuda:0')
-
-        if self.fusion is not None:
-            self.fc_omic = self.fc_omic.to(device)
-            self.mm = self.mm.to(device)
-
-        self.rho = self.rho.to(device)
-        self.classifier_mm = self.classifier_mm.to(device)
+            self.attention_net = nn.DataParallel(self.attention_net, device_ids=device_ids)
+        return self.to(device)
 
     def forward(self, **kwargs):
-        x_path = kwargs['x_path']
-        A, h_path = self.attention_net(x_path)  
-        A = torch.transpose(A, 1, 0)
-        A_raw = A 
-        A = F.softmax(A, dim=1) 
-        h_path = torch.mm(A, h_path)
+        if 'x_path_chunks' in kwargs:
+            # bags streamed from the store chunk by chunk (inference)
+            h_path = stream_attention_pool(self.attention_net, kwargs['x_path_chunks'])
+        else:
+            x_path = kwargs['x_path']
+            x_weight = kwargs.get('x_weight') # number of patches each instance represents (coreset bags)
+            bag_ids, num_bags = ragged_bags(kwargs.get('bag_offsets')) # several bags concatenated in x_path
+            if self.topk_instances and self.training and torch.is_grad_enabled():
+                h_path, A_raw = topk_attention_pool(self.attention_net, x_path, x_weight, bag_ids, num_bags, self.topk_instances, self.random_instances)
+            else:
+                A, h_path = self.attention_net(x_path)  
+                A = A.squeeze(1)
+                A_raw = A 
+                if x_weight is not None:
+                    A = A + torch.log(x_weight)
+                h_path, A = attention_pool(A, h_path, bag_ids, num_bags)
+            self.last_attention = A_raw # attention logit of each instance, for the patch sampler and the attention distillation
         h_path = self.rho(h_path)
 
-        x_omic = kwargs['x_omic'].unsqueeze(0)
+        x_omic = kwargs['x_omic']
+        if x_omic.dim() == 1:
+            x_omic = x_omic.unsqueeze(0)
         h_omic = self.fc_omic(x_omic)
-        if self.fusion == 'bilinear':
+        if self.fusion in ['bilinear', 'lrb']:
             h_mm = self.mm(h_path, h_omic)
         elif self.fusion == 'concat':
             h_mm = self.mm(torch.cat([h_path, h_omic], axis=1))
-        elif self.fusion == 'lrb':
-            h_mm  = self.mm(h_path, h_omic) # logits needs to be a [1 x 4] vector 
-            return h_mm
 
         h_mm  = self.classifier_mm(h_mm) # logits needs to be a [B x 4] vector      
         assert len(h_mm.shape) == 2 and h_mm.shape[1] == self.n_classes
 
-        hazards = torch.sigmoid(h_mm)
+        hazards = torch.sigmoid(h_mm.float())
         S = torch.cumprod(1 - hazards, dim=1)
 
         return hazards, S
@@ -382,13 +291,13 @@ class PorpoiseMMF(nn.Module):
         M = self.rho(M)
         O = self.fc_omic(X)
 
-        if self.fusion == 'bilinear':
+        if self.fusion in ['bilinear', 'lrb']:
             MM = self.mm(M, O)
         elif self.fusion == 'concat':
             MM = self.mm(torch.cat([M, O], axis=1))
             
         logits  = self.classifier(MM)
-        hazards = torch.sigmoid(logits)
+        hazards = torch.sigmoid(logits.float())
         S = torch.cumprod(1 - hazards, dim=1)
 
         risk = -torch.sum(S, dim=1)
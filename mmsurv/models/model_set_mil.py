@@ -7,6 +7,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from mmsurv.models.model_utils import *
 
 ################################
@@ -46,45 +47,53 @@ class MIL_Sum_FC_surv(nn.Module):
                 self.mm = nn.Sequential(*[nn.Linear(256*2, size[2]), nn.ReLU(), nn.Linear(size[2], size[2]), nn.ReLU()])
             elif self.fusion == 'bilinear':
                 self.mm = BilinearFusion(dim1=256, dim2=256, scale_dim1=8, scale_dim2=8, mmhid=256)
+            elif self.fusion == 'lrb':
+                self.mm = LRBilinearFusion(dim1=256, dim2=256, scale_dim1=8, scale_dim2=8, mmhid=256)
             else:
                 self.mm = None
 
         self.classifier = nn.Linear(size[2], n_classes)
+        self.checkpoint_blocks = ['phi']  # recomputed in the backward with --checkpoint_activations
 
 
-    def relocate(self):
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        if torch.cuda.device_count() >= 1:
+    def relocate(self, device=None):
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu") if device is None else torch.device(device)
+        if device.type == 'cuda' and torch.cuda.device_count() > 1:
             device_ids = list(range(torch.cuda.device_count()))
-            self.phi = nn.DataParallel(self.phi, device_ids=device_ids).to('cuda:0')
-        
-        if self.fusion is not None:
-            self.fc_omic = self.fc_omic.to(device)
-            self.mm = self.mm.to(device)
-
-        self.rho = self.rho.to(device)
-        self.classifier = self.classifier.to(device)
+            self.phi = nn.DataParallel(self.phi, device_ids=device_ids)
+        return self.to(device)
 
 
     def forward(self, **kwargs):
-        x_path = kwargs['x_path']
-
-        h_path = self.phi(x_path).sum(axis=0)
+        if 'x_path_chunks' in kwargs:
+            # bags streamed from the store chunk by chunk (inference)
+            h_path = stream_sum_pool(self.phi, kwargs['x_path_chunks'])
+        else:
+            x_path = kwargs['x_path']
+            x_weight = kwargs.get('x_weight') # number of patches each instance represents (coreset bags)
+            bag_ids, num_bags = ragged_bags(kwargs.get('bag_offsets')) # several bags concatenated in x_path
+
+            h_path = self.phi(x_path)
+            if x_weight is not None:
+                h_path = h_path * x_weight.unsqueeze(1)
+            h_path = sum_pool(h_path, bag_ids, num_bags)
         h_path = self.rho(h_path)
 
         if self.fusion is not None:
             x_omic = kwargs['x_omic']
-            h_omic = self.fc_omic(x_omic).squeeze(dim=0)
-            if self.fusion == 'bilinear':
-                h = self.mm(h_path.unsqueeze(dim=0), h_omic.unsqueeze(dim=0)).squeeze()
+            if x_omic.dim() == 1:
+                x_omic = x_omic.unsqueeze(0)
+            h_omic = self.fc_omic(x_omic)
+            if self.fusion in ['bilinear', 'lrb']:
+                h = self.mm(h_path, h_omic)
             elif self.fusion == 'concat':
-                h = self.mm(torch.cat([h_path, h_omic], axis=0))
+                h = self.mm(torch.cat([h_path, h_omic], axis=1))
         else:
-            h = h_path # [256] vector
+            h = h_path # [B x 256] vector
 
-        logits  = self.classifier(h).unsqueeze(0) # logits needs to be a [1 x 4] vector 
+        logits  = self.classifier(h) # logits needs to be a [B x 4] vector 
         # Y_hat = torch.topk(logits, 1, dim = 1)[1]
-        hazards = torch.sigmoid(logits)
+        hazards = torch.sigmoid(logits.float())
         S = torch.cumprod(1 - hazards, dim=1)
         
         return hazards, S
@@ -95,7 +104,7 @@ class MIL_Sum_FC_surv(nn.Module):
 # Attention MIL Implementation #
 ################################
 class MIL_Attention_FC_surv(nn.Module):
-    def __init__(self, path_input_dim, omic_input_dim=None, fusion=None, size_arg = "small", dropout=0.25, n_classes=4):
+    def __init__(self, path_input_dim, omic_input_dim=None, fusion=None, size_arg = "small", dropout=0.25, n_classes=4, topk_instances=0, random_instances=0):
         r"""
         Attention MIL Implementation
 
@@ -105,9 +114,13 @@ class MIL_Attention_FC_surv(nn.Module):
             size_arg (str): Size of NN architecture (Choices: small or large)
             dropout (float): Dropout rate
             n_classes (int): Output shape of NN
+            topk_instances (int): In training, backpropagate only through the topk_instances patches of highest attention and random_instances others of each bag (0: all patches)
+            random_instances (int): Patches drawn at random besides the top-k
         """
         super(MIL_Attention_FC_surv, self).__init__()
         self.fusion = fusion
+        self.topk_instances = topk_instances
+        self.random_instances = random_instances
         self.size_dict_path = {"small": [path_input_dim, 512, 256], "big": [path_input_dim, 512, 384]}
         self.size_dict_omic = {'small': [256, 256]}
 
@@ -131,50 +144,58 @@ class MIL_Attention_FC_surv(nn.Module):
                 self.mm = nn.Sequential(*[nn.Linear(256*2, size[2]), nn.ReLU(), nn.Linear(size[2], size[2]), nn.ReLU()])
             elif self.fusion == 'bilinear':
                 self.mm = BilinearFusion(dim1=256, dim2=256, scale_dim1=8, scale_dim2=8, mmhid=256)
+            elif self.fusion == 'lrb':
+                self.mm = LRBilinearFusion(dim1=256, dim2=256, scale_dim1=8, scale_dim2=8, mmhid=256)
             else:
                 self.mm = None
 
         self.classifier = nn.Linear(size[2], n_classes)
+        self.checkpoint_blocks = ['attention_net']  # recomputed in the backward with --checkpoint_activations
 
-    def relocate(self):
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        if torch.cuda.device_count() >= 1:
+    def relocate(self, device=None):
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu") if device is None else torch.device(device)
+        if device.type == 'cuda' and torch.cuda.device_count() > 1:
             device_ids = list(range(torch.cuda.device_count()))
-            self.attention_net = nn.DataParallel(self.attention_net, device_ids=device_ids).to('cuda:0')
-        else:
-            self.attention_net = self.attention_net.to(device)
-            
-        if self.fusion is not None:
-            self.fc_omic = self.fc_omic.to(device)
-            self.mm = self.mm.to(device)
-
-        self.rho = self.rho.to(device)
-        self.classifier = self.classifier.to(device)
+            self.attention_net = nn.DataParallel(self.attention_net, device_ids=device_ids)
+        return self.to(device)
 
 
     def forward(self, **kwargs):
-        x_path = kwargs['x_path']
+        if 'x_path_chunks' in kwargs:
+            # bags streamed from the store chunk by chunk (inference)
+            h_path = stream_attention_pool(self.attention_net, kwargs['x_path_chunks'])
+        else:
+            x_path = kwargs['x_path']
+            x_weight = kwargs.get('x_weight') # number of patches each instance represents (coreset bags)
+            bag_ids, num_bags = ragged_bags(kwargs.get('bag_offsets')) # several bags concatenated in x_path
 
-        A, h_path = self.attention_net(x_path)  
-        A = torch.transpose(A, 1, 0)
-        A_raw = A 
-        A = F.softmax(A, dim=1) 
-        h_path = torch.mm(A, h_path)
-        h_path = self.rho(h_path).squeeze()
+            if self.topk_instances and self.training and torch.is_grad_enabled():
+                h_path, A_raw = topk_attention_pool(self.attention_net, x_path, x_weight, bag_ids, num_bags, self.topk_instances, self.random_instances)
+            else:
+                A, h_path = self.attention_net(x_path)  
+                A = A.squeeze(1)
+                A_raw = A 
+                if x_weight is not None:
+                    A = A + torch.log(x_weight)
+                h_path, A = attention_pool(A, h_path, bag_ids, num_bags)
+            self.last_attention = A_raw # attention logit of each instance, for the patch sampler and the attention distillation
+        h_path = self.rho(h_path)
 
         if self.fusion is not None:
             x_omic = kwargs['x_omic']
+            if x_omic.dim() == 1:
+                x_omic = x_omic.unsqueeze(0)
             h_omic = self.fc_omic(x_omic)
-            if self.fusion == 'bilinear':
-                h = self.mm(h_path.unsqueeze(dim=0), h_omic.unsqueeze(dim=0)).squeeze()
+            if self.fusion in ['bilinear', 'lrb']:
+                h = self.mm(h_path, h_omic)
             elif self.fusion == 'concat':
-                h = self.mm(torch.cat([h_path, h_omic], axis=0))
+                h = self.mm(torch.cat([h_path, h_omic], axis=1))
         else:
-            h = h_path # [256] vector
+            h = h_path # [B x 256] vector
 
-        logits  = self.classifier(h).unsqueeze(0) # logits needs to be a [1 x 4] vector 
+        logits  = self.classifier(h) # logits needs to be a [B x 4] vector 
         # Y_hat = torch.topk(logits, 1, dim = 1)[1]
-        hazards = torch.sigmoid(logits)
+        hazards = torch.sigmoid(logits.float())
         S = torch.cumprod(1 - hazards, dim=1)
         
         return hazards, S
@@ -183,7 +204,7 @@ class MIL_Attention_FC_surv(nn.Module):
 # Deep Attention MISL Implementation #
 ######################################
 class MIL_Cluster_FC_surv(nn.Module):
-    def __init__(self, path_input_dim, omic_input_dim=None, fusion=None, num_clusters=10, size_arg = "small", dropout=0.25, n_classes=4):
+    def __init__(self, path_input_dim, omic_input_dim=None, fusion=None, num_clusters=10, size_arg = "small", dropout=0.25, n_classes=4, chunk_size=16384, piece_len=1024, topk_instances=0, random_instances=0):
         r"""
         Attention MIL Implementation
 
@@ -193,12 +214,21 @@ class MIL_Cluster_FC_surv(nn.Module):
             size_arg (str): Size of NN architecture (Choices: small or large)
             dropout (float): Dropout rate
             n_classes (int): Output shape of NN
+            chunk_size (int): Maximum number of instances encoded at once by the cluster layers
+            piece_len (int): Instances of a cluster per batched matmul, the padding of a cluster is less than piece_len
+            topk_instances (int): With random_instances, number of patches per bag the training backpropagates through, spread over the clusters (0: all patches)
+            random_instances (int): See topk_instances
         """
         super(MIL_Cluster_FC_surv, self).__init__()
         self.size_dict_path = {"small": [path_input_dim, 512, 256], "big": [path_input_dim, 512, 384]}
         self.size_dict_omic = {'small': [256, 256]}
         self.num_clusters = num_clusters
         self.fusion = fusion
+        self.dropout = dropout
+        self.chunk_size = chunk_size
+        self.piece_len = min(piece_len, chunk_size)
+        self.topk_instances = topk_instances
+        self.random_instances = random_instances
         
         ### FC Cluster layers + Pooling
         size = self.size_dict_path[size_arg]
@@ -229,42 +259,124 @@ class MIL_Cluster_FC_surv(nn.Module):
                 self.mm = nn.Sequential(*[nn.Linear(size[2]*2, size[2]), nn.ReLU(), nn.Linear(size[2], size[2]), nn.ReLU()])
             elif self.fusion == 'bilinear':
                 self.mm = BilinearFusion(dim1=256, dim2=256, scale_dim1=8, scale_dim2=8, mmhid=256)
+            elif self.fusion == 'lrb':
+                self.mm = LRBilinearFusion(dim1=256, dim2=256, scale_dim1=8, scale_dim2=8, mmhid=256)
             else:
                 self.mm = None
 
         self.classifier = nn.Linear(size[2], n_classes)
+        self.checkpoint_blocks = ['attention_net']  # recomputed in the backward with --checkpoint_activations, the cluster layers checkpoint their chunks anyway
 
 
-    def relocate(self):
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        if torch.cuda.device_count() >= 1:
+    def relocate(self, device=None):
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu") if device is None else torch.device(device)
+        if device.type == 'cuda' and torch.cuda.device_count() > 1:
             device_ids = list(range(torch.cuda.device_count()))
-            self.attention_net = nn.DataParallel(self.attention_net, device_ids=device_ids).to('cuda:0')
-        else:
-            self.attention_net = self.attention_net.to(device)
+            self.attention_net = nn.DataParallel(self.attention_net, device_ids=device_ids)
+        return self.to(device)
 
-        if self.fusion is not None:
-            self.fc_omic = self.fc_omic.to(device)
-            self.mm = self.mm.to(device)
 
-        self.phis = self.phis.to(device)
-        self.pool1d = self.pool1d.to(device)
-        self.rho = self.rho.to(device)
-        self.classifier = self.classifier.to(device)
+    def _encode_pieces(self, x, pieces_cluster, valid, weights):
+        r"""
+        Runs pieces of instances (P x L x D) through the FC layers of their cluster as batched matmuls, and sums the
+        valid instances of each piece.
+        """
+        for weight, bias in weights:
+            x = torch.baddbmm(bias[pieces_cluster].unsqueeze(1), x, weight[pieces_cluster].transpose(1, 2))
+            x = F.dropout(F.relu(x, inplace=True), p=self.dropout, training=self.training)
+        return x.masked_fill(~valid.unsqueeze(2), 0).sum(1)
+
+    def _encode_segments(self, x, segments_cluster, segments_len):
+        r"""
+        Runs contiguous segments of instances of the same cluster through the FC layers of their cluster, and sums
+        each segment.
+        """
+        return torch.stack([self.phis[c](x_c).sum(0) for c, x_c in zip(segments_cluster, x.split(segments_len))])
+
+    def cluster_pool(self, x_path, cluster_id):
+        r"""
+        Mean embedding of each cluster (zeros for empty clusters).
 
+        The bag is ordered by cluster once and encoded chunk_size instances at a time. On accelerators, it is cut
+        into pieces of piece_len instances of the same cluster, the last piece of each cluster padded, which run
+        through the stacked weights of their cluster's FC layers as one batched matmul. On CPU, where a batched
+        matmul is slower than one matmul per cluster, each chunk runs its contiguous segment of every cluster
+        through the FC layers of that cluster, without padding. The sums are pooled with a segment mean.
+
+        Args:
+            x_path (torch.Tensor): N x D instances
+            cluster_id (torch.Tensor): N cluster ids
+
+        Returns:
+            h_cluster (torch.Tensor): num_clusters x 512
+        """
+        order = torch.argsort(cluster_id, stable=True)
+        counts = torch.bincount(cluster_id, minlength=self.num_clusters)
+        # the sums are accumulated in the dtype of the bag, also under autocast
+        h_cluster = torch.zeros(self.num_clusters, self.phis[0][3].out_features, dtype=x_path.dtype, device=x_path.device)
+        # only the pooled sums are kept for backward when the bag spans several chunks, each chunk is recomputed
+        recompute = self.training and torch.is_grad_enabled() and len(x_path) > self.chunk_size
+
+        if x_path.device.type == 'cpu':
+            sorted_cluster = cluster_id[order]
+            for start in range(0, len(x_path), self.chunk_size):
+                chunk = slice(start, start + self.chunk_size)
+                segments_cluster, segments_len = torch.unique_consecutive(sorted_cluster[chunk], return_counts=True)
+                segments_cluster, segments_len = segments_cluster.tolist(), segments_len.tolist()
+                x = x_path.index_select(0, order[chunk])
+                if recompute:
+                    h = checkpoint(self._encode_segments, x, segments_cluster, segments_len, use_reentrant=False)
+                else:
+                    h = self._encode_segments(x, segments_cluster, segments_len)
+                h_cluster = h_cluster.index_add(0, torch.tensor(segments_cluster, device=x_path.device), h.to(h_cluster.dtype))
+            return h_cluster / counts.clamp(min=1).unsqueeze(1)
+
+        # pieces of piece_len instances, shorter if no cluster is that large, so the padding is less than piece_len per cluster
+        weights = [(torch.stack([phi[i].weight for phi in self.phis]), torch.stack([phi[i].bias for phi in self.phis])) for i in (0, 3)]
+        piece_len = int(min(self.piece_len, max(1, counts.max().item())))
+        n_pieces = -(-counts // piece_len)
+        pieces_cluster = torch.repeat_interleave(torch.arange(self.num_clusters, device=x_path.device), n_pieces)
+        first_piece = torch.cumsum(n_pieces, 0) - n_pieces
+        cluster_start = torch.cumsum(counts, 0) - counts
+        pieces_start = cluster_start[pieces_cluster] + (torch.arange(len(pieces_cluster), device=x_path.device) - first_piece[pieces_cluster]) * piece_len
+        pieces_len = torch.minimum(cluster_start[pieces_cluster] + counts[pieces_cluster] - pieces_start, torch.full_like(pieces_start, piece_len))
+
+        pieces_per_chunk = max(1, self.chunk_size // piece_len)
+        for start in range(0, len(pieces_cluster), pieces_per_chunk):
+            chunk = slice(start, start + pieces_per_chunk)
+            valid = torch.arange(piece_len, device=x_path.device).unsqueeze(0) < pieces_len[chunk].unsqueeze(1)
+            index = order[(pieces_start[chunk].unsqueeze(1) + torch.arange(piece_len, device=x_path.device)).clamp(max=len(x_path) - 1)]
+            x = x_path.index_select(0, index.flatten()).view(*index.shape, -1)
+            if recompute:
+                h = checkpoint(self._encode_pieces, x, pieces_cluster[chunk], valid, weights, use_reentrant=False)
+            else:
+                h = self._encode_pieces(x, pieces_cluster[chunk], valid, weights)
+            h_cluster = h_cluster.index_add(0, pieces_cluster[chunk], h.to(h_cluster.dtype))
+        return h_cluster / counts.clamp(min=1).unsqueeze(1)
+
+    def sampled_cluster_pool(self, x_path, cluster_id, n_instances):
+        r"""
+        cluster_pool whose backward pass only goes through n_instances patches, drawn at random evenly from the clusters.
+
+        The attention is over the cluster means, so the patches are not ranked: the mean of the drawn patches of each
+        cluster is shifted onto the mean of the whole cluster, encoded without gradients.
+        """
+        with torch.no_grad():
+            h_cluster = self.cluster_pool(x_path, cluster_id)
+        rank = rank_in_bag(torch.rand(len(x_path), device=x_path.device), cluster_id, self.num_clusters)
+        selected = torch.nonzero(rank < max(1, n_instances // self.num_clusters)).squeeze(1)
+        h_sampled = self.cluster_pool(x_path[selected], cluster_id[selected])
+        return h_sampled + (h_cluster - h_sampled).detach()
 
     def forward(self, **kwargs):
         x_path = kwargs['x_path']
-        cluster_id = kwargs['cluster_id'].detach().cpu().numpy()
+        cluster_id = kwargs['cluster_id'].to(x_path.device).long()
 
         ### FC Cluster layers + Pooling
-        h_cluster = []
-        for i in range(self.num_clusters):
-            h_cluster_i = self.phis[i](x_path[cluster_id==i])
-            if h_cluster_i.shape[0] == 0:
-                h_cluster_i = torch.zeros((1,512)).to(torch.device('cuda'))
-            h_cluster.append(self.pool1d(h_cluster_i.T.unsqueeze(0)).squeeze(2))
-        h_cluster = torch.stack(h_cluster, dim=1).squeeze(0)
+        if self.topk_instances and self.training and torch.is_grad_enabled():
+            h_cluster = self.sampled_cluster_pool(x_path, cluster_id, self.topk_instances + self.random_instances)
+        else:
+            h_cluster = self.cluster_pool(x_path, cluster_id)
 
         ### Attention MIL
         A, h_path = self.attention_net(h_cluster)  
@@ -278,7 +390,7 @@ class MIL_Cluster_FC_surv(nn.Module):
         if self.fusion is not None:
             x_omic = kwargs['x_omic']
             h_omic = self.fc_omic(x_omic)
-            if self.fusion == 'bilinear':
+            if self.fusion in ['bilinear', 'lrb']:
                 h = self.mm(h_path.unsqueeze(dim=0), h_omic.unsqueeze(dim=0)).squeeze()
             elif self.fusion == 'concat':
                 h = self.mm(torch.cat([h_path, h_omic], axis=0))
@@ -287,7 +399,7 @@ class MIL_Cluster_FC_surv(nn.Module):
 
         logits  = self.classifier(h).unsqueeze(0)
         Y_hat = torch.topk(logits, 1, dim = 1)[1]
-        hazards = torch.sigmoid(logits)
+        hazards = torch.sigmoid(logits.float())
         S = torch.cumprod(1 - hazards, dim=1)
         
         return hazards, S, Y_hat
\ No newline at end of file
@@ -2,12 +2,20 @@ from collections import OrderedDict
 from os.path import join
 import math
 import pdb
+from typing import Optional
+import warnings
 
 import numpy as np
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch import Tensor
+from torch.nn import Module
+from torch.nn.init import xavier_uniform_, constant_, xavier_normal_
+from torch.nn.parameter import Parameter
+from torch.overrides import has_torch_function, handle_torch_function
+from torch.utils.checkpoint import checkpoint
 
 
 
@@ -68,8 +76,8 @@ class BilinearFusion(nn.Module):
             o2 = self.linear_o2(h2)
 
         ### Fusion
-        o1 = torch.cat((o1, torch.cuda.FloatTensor(o1.shape[0], 1).fill_(1)), 1)
-        o2 = torch.cat((o2, torch.cuda.FloatTensor(o2.shape[0], 1).fill_(1)), 1)
+        o1 = torch.cat((o1, o1.new_ones(o1.shape[0], 1)), 1)
+        o2 = torch.cat((o2, o2.new_ones(o2.shape[0], 1)), 1)
         o12 = torch.bmm(o1.unsqueeze(2), o2.unsqueeze(1)).flatten(start_dim=1) # BATCH_SIZE X 1024
         out = self.post_fusion_dropout(o12)
         out = self.encoder1(out)
@@ -78,6 +86,78 @@ class BilinearFusion(nn.Module):
         return out
 
 
+class LRBilinearFusion(nn.Module):
+    r"""
+    Late Fusion Block using Low-rank Bilinear Pooling (Tucker-style, as in LMF)
+
+    The outer product of BilinearFusion followed by its dense encoder is replaced by rank modality-specific
+    factors, so that the fusion costs (dim1 + dim2) x rank x mmhid parameters instead of (dim1+1)(dim2+1) x 256.
+
+    args:
+        gate1 (bool): Whether to apply gating to modality 1
+        gate2 (bool): Whether to apply gating to modality 2
+        dim1 (int): Feature mapping dimension for modality 1
+        dim2 (int): Feature mapping dimension for modality 2
+        scale_dim1 (int): Scalar value to reduce modality 1 before the fusion
+        scale_dim2 (int): Scalar value to reduce modality 2 before the fusion
+        mmhid (int): Feature mapping dimension after multimodal fusion
+        dropout_rate (float): Dropout rate
+        rank (int): Rank of the factorized bilinear map
+    """
+    def __init__(self, skip=0, use_bilinear=0, gate1=1, gate2=1, dim1=128, dim2=128, scale_dim1=1, scale_dim2=1, mmhid=256, dropout_rate=0.25, rank=16):
+        super(LRBilinearFusion, self).__init__()
+        self.use_bilinear = use_bilinear
+        self.gate1 = gate1
+        self.gate2 = gate2
+        self.rank = rank
+        self.mmhid = mmhid
+
+        dim1_og, dim2_og, dim1, dim2 = dim1, dim2, dim1//scale_dim1, dim2//scale_dim2
+
+        self.linear_h1 = nn.Sequential(nn.Linear(dim1_og, dim1), nn.ReLU())
+        self.linear_z1 = nn.Bilinear(dim1_og, dim2_og, dim1) if use_bilinear else nn.Sequential(nn.Linear(dim1_og+dim2_og, dim1))
+        self.linear_o1 = nn.Sequential(nn.Linear(dim1, dim1), nn.ReLU(), nn.Dropout(p=dropout_rate))
+
+        self.linear_h2 = nn.Sequential(nn.Linear(dim2_og, dim2), nn.ReLU())
+        self.linear_z2 = nn.Bilinear(dim1_og, dim2_og, dim2) if use_bilinear else nn.Sequential(nn.Linear(dim1_og+dim2_og, dim2))
+        self.linear_o2 = nn.Sequential(nn.Linear(dim2, dim2), nn.ReLU(), nn.Dropout(p=dropout_rate))
+
+        self.h1_factor = nn.Parameter(torch.empty(rank, dim1 + 1, mmhid))
+        self.h2_factor = nn.Parameter(torch.empty(rank, dim2 + 1, mmhid))
+        self.fusion_weights = nn.Parameter(torch.empty(1, rank))
+        self.fusion_bias = nn.Parameter(torch.zeros(1, mmhid))
+        nn.init.xavier_normal_(self.h1_factor)
+        nn.init.xavier_normal_(self.h2_factor)
+        nn.init.xavier_normal_(self.fusion_weights)
+        self.post_fusion_dropout = nn.Dropout(p=dropout_rate)
+
+    def forward(self, vec1, vec2):
+        ### Gated Multimodal Units
+        if self.gate1:
+            h1 = self.linear_h1(vec1)
+            z1 = self.linear_z1(vec1, vec2) if self.use_bilinear else self.linear_z1(torch.cat((vec1, vec2), dim=1))
+            o1 = self.linear_o1(nn.Sigmoid()(z1)*h1)
+        else:
+            h1 = self.linear_h1(vec1)
+            o1 = self.linear_o1(h1)
+
+        if self.gate2:
+            h2 = self.linear_h2(vec2)
+            z2 = self.linear_z2(vec1, vec2) if self.use_bilinear else self.linear_z2(torch.cat((vec1, vec2), dim=1))
+            o2 = self.linear_o2(nn.Sigmoid()(z2)*h2)
+        else:
+            h2 = self.linear_h2(vec2)
+            o2 = self.linear_o2(h2)
+
+        ### Fusion, rank x B x mmhid projections of each modality, multiplied and summed over the rank
+        o1 = torch.cat((o1, o1.new_ones(o1.shape[0], 1)), 1)
+        o2 = torch.cat((o2, o2.new_ones(o2.shape[0], 1)), 1)
+        o12 = torch.matmul(o1, self.h1_factor) * torch.matmul(o2, self.h2_factor)
+        out = torch.matmul(self.fusion_weights, o12.transpose(0, 1)).squeeze(1) + self.fusion_bias # B x mmhid
+        out = self.post_fusion_dropout(F.relu(out))
+        return out
+
+
 def SNN_Block(dim1, dim2, dropout=0.25):
     r"""
     Multilayer Reception Block w/ Self-Normalization (Linear + ELU + Alpha Dropout)
@@ -95,6 +175,66 @@ def SNN_Block(dim1, dim2, dropout=0.25):
             nn.AlphaDropout(p=dropout, inplace=False))
 
 
+class SNN_Signatures(nn.Module):
+    r"""
+    SNN_Block stacks of several omic signatures, fused into batched matmuls
+
+    The weights of the first layer are zero-padded to the largest signature, so that every layer
+    runs as a single bmm over the signatures. Equivalent to a ModuleList of per-signature
+    nn.Sequential(SNN_Block, ...), whose state dict it also loads.
+
+    args:
+        omic_sizes (list): Dimension of each signature
+        hidden (list): Dimensions of the layers, shared by the signatures
+        dropout (float): Dropout rate
+        init_fn (function): Initialization of the per-signature nn.Linear layers before they are fused
+    """
+    def __init__(self, omic_sizes, hidden=[256, 256], dropout=0.25, init_fn=None):
+        super(SNN_Signatures, self).__init__()
+        self.omic_sizes = list(omic_sizes)
+        self.hidden = list(hidden)
+        dims = [max(self.omic_sizes)] + self.hidden
+
+        # the layers are created signature by signature, as the unfused stacks were
+        linears = [[nn.Linear(dim1, dim2) for dim1, dim2 in zip([size] + self.hidden[:-1], self.hidden)] for size in self.omic_sizes]
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        for i in range(len(self.hidden)):
+            weight = torch.zeros(len(self.omic_sizes), dims[i+1], dims[i])
+            for s, layers in enumerate(linears):
+                if init_fn is not None:
+                    init_fn(layers[i])
+                weight[s, :, :layers[i].in_features] = layers[i].weight.data
+            self.weights.append(nn.Parameter(weight))
+            self.biases.append(nn.Parameter(torch.stack([layers[i].bias.data for layers in linears])))
+        self.dropout = nn.AlphaDropout(p=dropout, inplace=False)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints of the unfused ModuleList: {s}.{layer}.0.weight / bias
+        if prefix + '0.0.0.weight' in state_dict:
+            for i in range(len(self.hidden)):
+                weight = torch.zeros_like(self.weights[i].data)
+                for s in range(len(self.omic_sizes)):
+                    w = state_dict.pop('{}{}.{}.0.weight'.format(prefix, s, i))
+                    weight[s, :, :w.shape[1]] = w
+                state_dict[prefix + 'weights.{}'.format(i)] = weight
+                state_dict[prefix + 'biases.{}'.format(i)] = torch.stack([state_dict.pop('{}{}.{}.0.bias'.format(prefix, s, i)) for s in range(len(self.omic_sizes))])
+        super(SNN_Signatures, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x_omic):
+        r"""
+        args:
+            x_omic (list): B x omic_sizes[s] features of each signature
+
+        returns:
+            h_omic (torch.Tensor): S x B x hidden[-1] embeddings of the signatures
+        """
+        x = torch.stack([F.pad(x, (0, self.weights[0].shape[2] - x.shape[-1])) for x in x_omic])
+        for weight, bias in zip(self.weights, self.biases):
+            x = self.dropout(F.elu(torch.baddbmm(bias.unsqueeze(1), x, weight.transpose(1, 2))))
+        return x
+
+
 def Reg_Block(dim1, dim2, dropout=0.25):
     r"""
     Multilayer Reception Block (Linear + ReLU + Dropout)
@@ -117,6 +257,8 @@ class Attn_Net_Gated(nn.Module):
         r"""
         Attention Network with Sigmoid Gating (3 fc layers)
 
+        The tanh and sigmoid branches are computed by a single Linear(L, 2D), split in halves.
+
         args:
             L (int): input feature dimension
             D (int): hidden layer dimension
@@ -124,27 +266,237 @@ class Attn_Net_Gated(nn.Module):
             n_classes (int): number of classes
         """
         super(Attn_Net_Gated, self).__init__()
-        self.attention_a = [
-            nn.Linear(L, D),
-            nn.Tanh()]
-        
-        self.attention_b = [nn.Linear(L, D), nn.Sigmoid()]
-        if dropout:
-            self.attention_a.append(nn.Dropout(0.25))
-            self.attention_b.append(nn.Dropout(0.25))
-
-        self.attention_a = nn.Sequential(*self.attention_a)
-        self.attention_b = nn.Sequential(*self.attention_b)
+        self.D = D
+        # initialized as the two Linear(L, D) of the tanh and sigmoid branches, in the same order, so that seeded runs
+        # draw the same weights; the fused layer is built on the meta device and draws nothing
+        attention_a, attention_b = nn.Linear(L, D), nn.Linear(L, D)
+        self.attention_ab = nn.Linear(L, 2 * D, device='meta')
+        self.attention_ab.weight = nn.Parameter(torch.cat([attention_a.weight.data, attention_b.weight.data]))
+        self.attention_ab.bias = nn.Parameter(torch.cat([attention_a.bias.data, attention_b.bias.data]))
+        self.dropout = nn.Dropout(0.25) if dropout else nn.Identity()
         self.attention_c = nn.Linear(D, n_classes)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints of the two branches: attention_a.0 / attention_b.0
+        if prefix + 'attention_a.0.weight' in state_dict:
+            for name in ['weight', 'bias']:
+                state_dict[prefix + 'attention_ab.' + name] = torch.cat([state_dict.pop(prefix + 'attention_a.0.' + name), state_dict.pop(prefix + 'attention_b.0.' + name)])
+        super(Attn_Net_Gated, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, x):
-        a = self.attention_a(x)
-        b = self.attention_b(x)
-        A = a.mul(b)
+        a, b = self.attention_ab(x).split(self.D, dim=-1)
+        A = self.dropout(torch.tanh(a)).mul(self.dropout(torch.sigmoid(b)))
         A = self.attention_c(A)  # N x n_classes
         return A, x
 
 
+def ragged_bags(bag_offsets=None):
+    r"""
+    Bag-id vector of a ragged batch (concatenated instances of several bags)
+
+    args:
+        bag_offsets (torch.Tensor): (B+1) start offsets of each bag in the concatenated instances
+
+    returns:
+        (bag_ids, num_bags): bag of each instance, or None for a single bag
+    """
+    if bag_offsets is None or len(bag_offsets) <= 2:
+        return None, 1
+    num_bags = len(bag_offsets) - 1
+    bag_ids = torch.repeat_interleave(torch.arange(num_bags, device=bag_offsets.device), torch.diff(bag_offsets))
+    return bag_ids, num_bags
+
+
+def segment_sum(x, bag_ids, num_bags):
+    r"""
+    Sum of the instances x (N x D) of each bag -> (num_bags x D)
+    """
+    return torch.zeros((num_bags,) + x.shape[1:], dtype=x.dtype, device=x.device).index_add(0, bag_ids, x)
+
+
+def segment_softmax(x, bag_ids, num_bags):
+    r"""
+    Softmax of the logits x (N) within each bag
+    """
+    x_max = torch.full((num_bags,), -float('inf'), dtype=x.dtype, device=x.device)
+    x_max = x_max.scatter_reduce(0, bag_ids, x.detach(), reduce='amax')
+    x = torch.exp(x - x_max[bag_ids])
+    return x / segment_sum(x, bag_ids, num_bags)[bag_ids]
+
+
+def attention_pool(A, h, bag_ids=None, num_bags=1):
+    r"""
+    Attention pooling of the instance embeddings h (N x D) with logits A (N), over a single bag or a ragged batch
+
+    returns:
+        (M, A): pooled embeddings (num_bags x D) and normalized attention
+    """
+    if bag_ids is None:
+        A = F.softmax(A.unsqueeze(0), dim=1)
+        return torch.mm(A, h), A
+    A = segment_softmax(A, bag_ids, num_bags)
+    return segment_sum(A.unsqueeze(1) * h, bag_ids, num_bags), A
+
+
+def sum_pool(h, bag_ids=None, num_bags=1):
+    r"""
+    Sum pooling of the instance embeddings h (N x D), over a single bag or a ragged batch -> (num_bags x D)
+    """
+    if bag_ids is None:
+        return h.sum(dim=0, keepdim=True)
+    return segment_sum(h, bag_ids, num_bags)
+
+
+def rank_in_bag(score, bag_ids, num_bags):
+    r"""
+    Rank of each instance by decreasing score within its bag (0 for the highest)
+    """
+    order = torch.argsort(score, descending=True)
+    order = order[torch.argsort(bag_ids[order], stable=True)]
+    counts = torch.bincount(bag_ids, minlength=num_bags)
+    bag_start = torch.cumsum(counts, 0) - counts
+    rank = torch.empty_like(order)
+    rank[order] = torch.arange(len(order), device=order.device) - bag_start[bag_ids[order]]
+    return rank
+
+
+def topk_attention_pool(attention_net, x, x_weight=None, bag_ids=None, num_bags=1, k=64, n_random=64):
+    r"""
+    Attention pooling whose backward pass only goes through k + n_random instances of each bag
+
+    The full bag is encoded without gradients. The top-k instances by attention and n_random instances drawn
+    uniformly from the others are then encoded again with gradients, the random ones weighted by the number of
+    instances they stand for, and their pooling is shifted onto the pooling of the full bag. The output is the
+    exact attention pooling, its gradient is estimated from the selected instances.
+
+    args:
+        attention_net (nn.Module): instances (n x D) -> (logits n x 1, embeddings n x H)
+        x (torch.Tensor): N x D instances
+        x_weight (torch.Tensor): N instance weights, or None
+        bag_ids (torch.Tensor): N bag of each instance, or None for a single bag
+        k (int): instances of highest attention selected per bag
+        n_random (int): other instances drawn per bag
+
+    returns:
+        (M, A_raw): pooled embeddings (num_bags x H) and attention logits of the instances (N), without gradients
+    """
+    log_weight = torch.log(x_weight) if x_weight is not None else torch.zeros(len(x), device=x.device)
+    with torch.no_grad():
+        A_raw, h = attention_net(x)
+        A_raw = A_raw.squeeze(1)
+        A = A_raw + log_weight
+        M, _ = attention_pool(A, h, bag_ids, num_bags)
+
+    ids = bag_ids if bag_ids is not None else torch.zeros(len(x), dtype=torch.long, device=x.device)
+    top = rank_in_bag(A.float(), ids, num_bags) < k
+    rand = ~top & (rank_in_bag(torch.rand(len(x), device=x.device).masked_fill(top, -1), ids, num_bags) < n_random)
+    # each random instance stands for n_rest / n_rand instances of its bag
+    n_rest = torch.bincount(ids, weights=(~top).float(), minlength=num_bags)
+    n_rand = torch.bincount(ids, weights=rand.float(), minlength=num_bags)
+    log_scale = torch.where(rand, torch.log(n_rest / n_rand.clamp(min=1))[ids], torch.zeros_like(log_weight))
+
+    selected = torch.nonzero(top | rand).squeeze(1)
+    A_sel, h_sel = attention_net(x[selected])
+    A_sel = A_sel.squeeze(1) + (log_weight + log_scale)[selected]
+    M_sel, _ = attention_pool(A_sel, h_sel, bag_ids[selected] if bag_ids is not None else None, num_bags)
+    return M_sel + (M - M_sel).detach(), A_raw
+
+
+def stream_attention_pool(attention_net, bags):
+    r"""
+    Attention pooling of bags read chunk by chunk, for inference on bags too large to encode at once
+
+    A running max, sum of exponentials and weighted sum of the embeddings are kept per bag (online
+    softmax), so only one chunk of activations is live whatever the bag size.
+
+    args:
+        attention_net (nn.Module): instances (n x D) -> (logits n x 1, embeddings n x H)
+        bags (list): one iterable of (x, w) chunks per bag, w the instance weights or None
+
+    returns:
+        M (torch.Tensor): pooled embeddings (num_bags x H)
+    """
+    pooled = []
+    for chunks in bags:
+        m, l, acc = None, None, None
+        for x, w in chunks:
+            A, h = attention_net(x)
+            A = A.squeeze(1)
+            if w is not None:
+                A = A + torch.log(w)
+            m_new = A.max() if m is None else torch.maximum(m, A.max())
+            p = torch.exp(A - m_new)
+            if m is None:
+                l, acc = p.sum(), p @ h
+            else:
+                scale = torch.exp(m - m_new)
+                l, acc = l * scale + p.sum(), acc * scale + p @ h
+            m = m_new
+        pooled.append(acc / l)
+    return torch.stack(pooled)
+
+
+def stream_sum_pool(phi, bags):
+    r"""
+    Sum pooling of bags read chunk by chunk, see stream_attention_pool
+
+    args:
+        phi (nn.Module): instances (n x D) -> embeddings (n x H)
+        bags (list): one iterable of (x, w) chunks per bag, w the instance weights or None
+
+    returns:
+        M (torch.Tensor): pooled embeddings (num_bags x H)
+    """
+    pooled = []
+    for chunks in bags:
+        acc = None
+        for x, w in chunks:
+            h = phi(x)
+            if w is not None:
+                h = h * w.unsqueeze(1)
+            acc = h.sum(dim=0) if acc is None else acc + h.sum(dim=0)
+        pooled.append(acc)
+    return torch.stack(pooled)
+
+
+_checkpointed_classes = {}
+
+
+def _checkpointed(cls):
+    # subclass of cls whose forward is checkpointed, kept on the replicas of DataParallel
+    if cls not in _checkpointed_classes:
+        def forward(self, *args, **kwargs):
+            if torch.is_grad_enabled():
+                return checkpoint(cls.forward, self, *args, use_reentrant=False, **kwargs)
+            return cls.forward(self, *args, **kwargs)
+        _checkpointed_classes[cls] = type(cls.__name__, (cls,), {'forward': forward, '__module__': cls.__module__})
+    return _checkpointed_classes[cls]
+
+
+def checkpoint_activations(model, blocks):
+    r"""
+    Activation checkpointing of submodules of a model
+
+    The activations inside each block are not kept for the backward pass but recomputed from the
+    block inputs, for a second forward of the block. The parameters and the state dict are unchanged
+    and the blocks run as usual without gradients.
+
+    args:
+        model (torch.nn.Module): model
+        blocks (list): names of the submodules to checkpoint, as in model.named_modules() (e.g. 'path_transformer', 'pathomics_encoder.layer1')
+
+    returns:
+        model
+    """
+    modules = dict(model.named_modules())
+    for name in blocks:
+        if name not in modules:
+            raise ValueError("{} has no submodule {} to checkpoint".format(type(model).__name__, name))
+        if type(modules[name]) not in _checkpointed_classes.values():
+            modules[name].__class__ = _checkpointed(type(modules[name]))
+    return model
+
+
 def init_max_weights(module):
     r"""
     Initialize Weights function.
@@ -159,4 +511,610 @@ def init_max_weights(module):
         if type(m) == nn.Linear:
             stdv = 1. / math.sqrt(m.weight.size(1))
             m.weight.data.normal_(0, stdv)
-            m.bias.data.zero_()
\ No newline at end of file
+            m.bias.data.zero_()
+
+
+def _same_tensor(a, b):
+    return a is b or (a is not None and b is not None and a.data_ptr() == b.data_ptr() and a.shape == b.shape and a.stride() == b.stride())
+
+
+def multi_head_attention_forward(
+    query: Tensor,
+    key: Tensor,
+    value: Tensor,
+    embed_dim_to_check: int,
+    num_heads: int,
+    in_proj_weight: Tensor,
+    in_proj_bias: Tensor,
+    bias_k: Optional[Tensor],
+    bias_v: Optional[Tensor],
+    add_zero_attn: bool,
+    dropout_p: float,
+    out_proj_weight: Tensor,
+    out_proj_bias: Tensor,
+    training: bool = True,
+    key_padding_mask: Optional[Tensor] = None,
+    need_weights: bool = True,
+    need_raw: bool = True,
+    attn_mask: Optional[Tensor] = None,
+    use_separate_proj_weight: bool = False,
+    q_proj_weight: Optional[Tensor] = None,
+    k_proj_weight: Optional[Tensor] = None,
+    v_proj_weight: Optional[Tensor] = None,
+    static_k: Optional[Tensor] = None,
+    static_v: Optional[Tensor] = None,
+):
+    r"""
+    Args:
+        query, key, value: map a query and a set of key-value pairs to an output.
+            See "Attention Is All You Need" for more details.
+        embed_dim_to_check: total dimension of the model.
+        num_heads: parallel attention heads.
+        in_proj_weight, in_proj_bias: input projection weight and bias.
+        bias_k, bias_v: bias of the key and value sequences to be added at dim=0.
+        add_zero_attn: add a new batch of zeros to the key and
+                       value sequences at dim=1.
+        dropout_p: probability of an element to be zeroed.
+        out_proj_weight, out_proj_bias: the output projection weight and bias.
+        training: apply dropout if is ``True``.
+        key_padding_mask: if provided, specified padding elements in the key will
+            be ignored by the attention. This is an binary mask. When the value is True,
+            the corresponding value on the attention layer will be filled with -inf.
+        need_weights: output attn_output_weights, else the fused scaled_dot_product_attention is used and they are never materialized.
+        attn_mask: 2D or 3D mask that prevents attention to certain positions. A 2D mask will be broadcasted for all
+            the batches while a 3D mask allows to specify a different mask for the entries of each batch.
+        use_separate_proj_weight: the function accept the proj. weights for query, key,
+            and value in different forms. If false, in_proj_weight will be used, which is
+            a combination of q_proj_weight, k_proj_weight, v_proj_weight.
+        q_proj_weight, k_proj_weight, v_proj_weight, in_proj_bias: input projection weight and bias.
+        static_k, static_v: static key and value used for attention operators.
+    Shape:
+        Inputs:
+        - query: :math:`(L, N, E)` where L is the target sequence length, N is the batch size, E is
+          the embedding dimension.
+        - key: :math:`(S, N, E)`, where S is the source sequence length, N is the batch size, E is
+          the embedding dimension.
+        - value: :math:`(S, N, E)` where S is the source sequence length, N is the batch size, E is
+          the embedding dimension.
+        - key_padding_mask: :math:`(N, S)` where N is the batch size, S is the source sequence length.
+          If a ByteTensor is provided, the non-zero positions will be ignored while the zero positions
+          will be unchanged. If a BoolTensor is provided, the positions with the
+          value of ``True`` will be ignored while the position with the value of ``False`` will be unchanged.
+        - attn_mask: 2D mask :math:`(L, S)` where L is the target sequence length, S is the source sequence length.
+          3D mask :math:`(N*num_heads, L, S)` where N is the batch size, L is the target sequence length,
+          S is the source sequence length. attn_mask ensures that position i is allowed to attend the unmasked
+          positions. If a ByteTensor is provided, the non-zero positions are not allowed to attend
+          while the zero positions will be unchanged. If a BoolTensor is provided, positions with ``True``
+          are not allowed to attend while ``False`` values will be unchanged. If a FloatTensor
+          is provided, it will be added to the attention weight.
+        - static_k: :math:`(N*num_heads, S, E/num_heads)`, where S is the source sequence length,
+          N is the batch size, E is the embedding dimension. E/num_heads is the head dimension.
+        - static_v: :math:`(N*num_heads, S, E/num_heads)`, where S is the source sequence length,
+          N is the batch size, E is the embedding dimension. E/num_heads is the head dimension.
+        Outputs:
+        - attn_output: :math:`(L, N, E)` where L is the target sequence length, N is the batch size,
+          E is the embedding dimension.
+        - attn_output_weights: :math:`(N, L, S)` where N is the batch size,
+          L is the target sequence length, S is the source sequence length.
+    """
+    tens_ops = (query, key, value, in_proj_weight, in_proj_bias, bias_k, bias_v, out_proj_weight, out_proj_bias)
+    if has_torch_function(tens_ops):
+        return handle_torch_function(
+            multi_head_attention_forward,
+            tens_ops,
+            query,
+            key,
+            value,
+            embed_dim_to_check,
+            num_heads,
+            in_proj_weight,
+            in_proj_bias,
+            bias_k,
+            bias_v,
+            add_zero_attn,
+            dropout_p,
+            out_proj_weight,
+            out_proj_bias,
+            training=training,
+            key_padding_mask=key_padding_mask,
+            need_weights=need_weights,
+            need_raw=need_raw,
+            attn_mask=attn_mask,
+            use_separate_proj_weight=use_separate_proj_weight,
+            q_proj_weight=q_proj_weight,
+            k_proj_weight=k_proj_weight,
+            v_proj_weight=v_proj_weight,
+            static_k=static_k,
+            static_v=static_v,
+        )
+    tgt_len, bsz, embed_dim = query.size()
+    assert embed_dim == embed_dim_to_check
+    # allow MHA to have different sizes for the feature dimension
+    assert key.size(0) == value.size(0) and key.size(1) == value.size(1)
+
+    head_dim = embed_dim // num_heads
+    assert head_dim * num_heads == embed_dim, "embed_dim must be divisible by num_heads"
+    scaling = float(head_dim) ** -0.5
+
+    # self / encoder-decoder attention are recognized by identity, comparing the values would cost a pass over the bag
+    # (or by storage, the inputs of a checkpointed module may be recomputed as new views of the same tensor)
+    if not use_separate_proj_weight:
+        if _same_tensor(query, key) and _same_tensor(key, value):
+            # self-attention
+            q, k, v = F.linear(query, in_proj_weight, in_proj_bias).chunk(3, dim=-1)
+
+        elif _same_tensor(key, value):
+            # encoder-decoder attention
+            # This is inline in_proj function with in_proj_weight and in_proj_bias
+            _b = in_proj_bias
+            _start = 0
+            _end = embed_dim
+            _w = in_proj_weight[_start:_end, :]
+            if _b is not None:
+                _b = _b[_start:_end]
+            q = F.linear(query, _w, _b)
+
+            if key is None:
+                assert value is None
+                k = None
+                v = None
+            else:
+                # This is inline in_proj function with in_proj_weight and in_proj_bias
+                _b = in_proj_bias
+                _start = embed_dim
+                _end = None
+                _w = in_proj_weight[_start:, :]
+                if _b is not None:
+                    _b = _b[_start:]
+                k, v = F.linear(key, _w, _b).chunk(2, dim=-1)
+
+        else:
+            # This is inline in_proj function with in_proj_weight and in_proj_bias
+            _b = in_proj_bias
+            _start = 0
+            _end = embed_dim
+            _w = in_proj_weight[_start:_end, :]
+            if _b is not None:
+                _b = _b[_start:_end]
+            q = F.linear(query, _w, _b)
+
+            # This is inline in_proj function with in_proj_weight and in_proj_bias
+            _b = in_proj_bias
+            _start = embed_dim
+            _end = embed_dim * 2
+            _w = in_proj_weight[_start:_end, :]
+            if _b is not None:
+                _b = _b[_start:_end]
+            k = F.linear(key, _w, _b)
+
+            # This is inline in_proj function with in_proj_weight and in_proj_bias
+            _b = in_proj_bias
+            _start = embed_dim * 2
+            _end = None
+            _w = in_proj_weight[_start:, :]
+            if _b is not None:
+                _b = _b[_start:]
+            v = F.linear(value, _w, _b)
+    else:
+        q_proj_weight_non_opt = torch.jit._unwrap_optional(q_proj_weight)
+        len1, len2 = q_proj_weight_non_opt.size()
+        assert len1 == embed_dim and len2 == query.size(-1)
+
+        k_proj_weight_non_opt = torch.jit._unwrap_optional(k_proj_weight)
+        len1, len2 = k_proj_weight_non_opt.size()
+        assert len1 == embed_dim and len2 == key.size(-1)
+
+        v_proj_weight_non_opt = torch.jit._unwrap_optional(v_proj_weight)
+        len1, len2 = v_proj_weight_non_opt.size()
+        assert len1 == embed_dim and len2 == value.size(-1)
+
+        if in_proj_bias is not None:
+            q = F.linear(query, q_proj_weight_non_opt, in_proj_bias[0:embed_dim])
+            k = F.linear(key, k_proj_weight_non_opt, in_proj_bias[embed_dim : (embed_dim * 2)])
+            v = F.linear(value, v_proj_weight_non_opt, in_proj_bias[(embed_dim * 2) :])
+        else:
+            q = F.linear(query, q_proj_weight_non_opt, in_proj_bias)
+            k = F.linear(key, k_proj_weight_non_opt, in_proj_bias)
+            v = F.linear(value, v_proj_weight_non_opt, in_proj_bias)
+
+    if attn_mask is not None:
+        assert (
+            attn_mask.dtype == torch.float32
+            or attn_mask.dtype == torch.float64
+            or attn_mask.dtype == torch.float16
+            or attn_mask.dtype == torch.uint8
+            or attn_mask.dtype == torch.bool
+        ), "Only float, byte, and bool types are supported for attn_mask, not {}".format(attn_mask.dtype)
+        if attn_mask.dtype == torch.uint8:
+            warnings.warn("Byte tensor for attn_mask in nn.MultiheadAttention is deprecated. Use bool tensor instead.")
+            attn_mask = attn_mask.to(torch.bool)
+
+        if attn_mask.dim() == 2:
+            attn_mask = attn_mask.unsqueeze(0)
+            if list(attn_mask.size()) != [1, query.size(0), key.size(0)]:
+                raise RuntimeError("The size of the 2D attn_mask is not correct.")
+        elif attn_mask.dim() == 3:
+            if list(attn_mask.size()) != [bsz * num_heads, query.size(0), key.size(0)]:
+                raise RuntimeError("The size of the 3D attn_mask is not correct.")
+        else:
+            raise RuntimeError("attn_mask's dimension {} is not supported".format(attn_mask.dim()))
+        # attn_mask's dim is 3 now.
+
+    # convert ByteTensor key_padding_mask to bool
+    if key_padding_mask is not None and key_padding_mask.dtype == torch.uint8:
+        warnings.warn("Byte tensor for key_padding_mask in nn.MultiheadAttention is deprecated. Use bool tensor instead.")
+        key_padding_mask = key_padding_mask.to(torch.bool)
+
+    if bias_k is not None and bias_v is not None:
+        if static_k is None and static_v is None:
+            k = torch.cat([k, bias_k.repeat(1, bsz, 1)])
+            v = torch.cat([v, bias_v.repeat(1, bsz, 1)])
+            if attn_mask is not None:
+                attn_mask = F.pad(attn_mask, (0, 1))
+            if key_padding_mask is not None:
+                key_padding_mask = F.pad(key_padding_mask, (0, 1))
+        else:
+            assert static_k is None, "bias cannot be added to static key."
+            assert static_v is None, "bias cannot be added to static value."
+    else:
+        assert bias_k is None
+        assert bias_v is None
+
+    q = q.contiguous().view(tgt_len, bsz * num_heads, head_dim).transpose(0, 1)
+    if k is not None:
+        k = k.contiguous().view(-1, bsz * num_heads, head_dim).transpose(0, 1)
+    if v is not None:
+        v = v.contiguous().view(-1, bsz * num_heads, head_dim).transpose(0, 1)
+
+    if static_k is not None:
+        assert static_k.size(0) == bsz * num_heads
+        assert static_k.size(2) == head_dim
+        k = static_k
+
+    if static_v is not None:
+        assert static_v.size(0) == bsz * num_heads
+        assert static_v.size(2) == head_dim
+        v = static_v
+
+    src_len = k.size(1)
+
+    if key_padding_mask is not None:
+        assert key_padding_mask.size(0) == bsz
+        assert key_padding_mask.size(1) == src_len
+
+    if add_zero_attn:
+        src_len += 1
+        k = torch.cat([k, torch.zeros((k.size(0), 1) + k.size()[2:], dtype=k.dtype, device=k.device)], dim=1)
+        v = torch.cat([v, torch.zeros((v.size(0), 1) + v.size()[2:], dtype=v.dtype, device=v.device)], dim=1)
+        if attn_mask is not None:
+            attn_mask = F.pad(attn_mask, (0, 1))
+        if key_padding_mask is not None:
+            key_padding_mask = F.pad(key_padding_mask, (0, 1))
+
+    if not need_weights:
+        # fused kernel, the attention weights are never materialized
+        sdpa_mask = None
+        if attn_mask is not None:
+            sdpa_mask = ~attn_mask if attn_mask.dtype == torch.bool else attn_mask
+            sdpa_mask = sdpa_mask.view(-1, num_heads, tgt_len, src_len) if sdpa_mask.size(0) > 1 else sdpa_mask.unsqueeze(0)
+        if key_padding_mask is not None:
+            kpm = ~key_padding_mask.view(bsz, 1, 1, src_len)
+            if sdpa_mask is None:
+                sdpa_mask = kpm
+            elif sdpa_mask.dtype == torch.bool:
+                sdpa_mask = sdpa_mask & kpm
+            else:
+                sdpa_mask = sdpa_mask.masked_fill(~kpm, float("-inf"))
+        attn_output = F.scaled_dot_product_attention(
+            q.view(bsz, num_heads, tgt_len, head_dim),
+            k.view(bsz, num_heads, src_len, head_dim),
+            v.view(bsz, num_heads, src_len, head_dim),
+            attn_mask=sdpa_mask,
+            dropout_p=dropout_p if training else 0.0,
+        )
+        attn_output = attn_output.permute(2, 0, 1, 3).reshape(tgt_len, bsz, embed_dim)
+        attn_output = F.linear(attn_output, out_proj_weight, out_proj_bias)
+        return attn_output, None
+
+    attn_output_weights = torch.bmm(q * scaling, k.transpose(1, 2))
+    assert list(attn_output_weights.size()) == [bsz * num_heads, tgt_len, src_len]
+
+    if attn_mask is not None:
+        if attn_mask.dtype == torch.bool:
+            attn_output_weights.masked_fill_(attn_mask, float("-inf"))
+        else:
+            attn_output_weights += attn_mask
+
+    if key_padding_mask is not None:
+        attn_output_weights = attn_output_weights.view(bsz, num_heads, tgt_len, src_len)
+        attn_output_weights = attn_output_weights.masked_fill(
+            key_padding_mask.unsqueeze(1).unsqueeze(2),
+            float("-inf"),
+        )
+        attn_output_weights = attn_output_weights.view(bsz * num_heads, tgt_len, src_len)
+
+    attn_output_weights_raw = attn_output_weights
+    attn_output_weights = F.softmax(attn_output_weights, dim=-1)
+    attn_output_weights = F.dropout(attn_output_weights, p=dropout_p, training=training)
+
+    attn_output = torch.bmm(attn_output_weights, v)
+    assert list(attn_output.size()) == [bsz * num_heads, tgt_len, head_dim]
+    attn_output = attn_output.transpose(0, 1).contiguous().view(tgt_len, bsz, embed_dim)
+    attn_output = F.linear(attn_output, out_proj_weight, out_proj_bias)
+
+    if need_weights:
+        if need_raw:
+            attn_output_weights_raw = attn_output_weights_raw.view(bsz, num_heads, tgt_len, src_len)
+            return attn_output, attn_output_weights_raw
+
+            # attn_output_weights = attn_output_weights.view(bsz, num_heads, tgt_len, src_len)
+            # return attn_output, attn_output_weights.sum(dim=1) / num_heads, attn_output_weights_raw, attn_output_weights_raw.sum(dim=1) / num_heads
+        else:
+            # average attention weights over heads
+            attn_output_weights = attn_output_weights.view(bsz, num_heads, tgt_len, src_len)
+            return attn_output, attn_output_weights.sum(dim=1) / num_heads
+    else:
+        return attn_output, None
+
+
+def _attention_chunk(q, key, value, m, l, acc, k_weight, k_bias, v_weight, v_bias, key_padding_mask, num_heads, dropout_p, training):
+    r"""
+    Folds one chunk of keys / values into the running max (m), denominator (l) and weighted sum (acc) of an online softmax
+    """
+    bsz_heads, tgt_len, head_dim = q.shape
+    k = F.linear(key, k_weight, k_bias).contiguous().view(-1, bsz_heads, head_dim).transpose(0, 1)
+    v = F.linear(value, v_weight, v_bias).contiguous().view(-1, bsz_heads, head_dim).transpose(0, 1)
+    scores = torch.bmm(q, k.transpose(1, 2))
+    if key_padding_mask is not None:
+        scores = scores.view(-1, num_heads, tgt_len, k.size(1)).masked_fill(key_padding_mask.unsqueeze(1).unsqueeze(2), float("-inf"))
+        scores = scores.view(bsz_heads, tgt_len, k.size(1))
+
+    m_new = torch.maximum(m, scores.amax(dim=-1, keepdim=True))
+    m_safe = m_new.masked_fill(torch.isinf(m_new), 0.0) # rows without any key yet
+    p = torch.exp(scores - m_safe)
+    correction = torch.exp(m - m_safe)
+    l = l * correction + p.sum(dim=-1, keepdim=True)
+    acc = acc * correction + torch.bmm(F.dropout(p, p=dropout_p, training=training), v)
+    return m_new, l, acc
+
+
+def chunked_multi_head_attention_forward(
+    query, key, value, num_heads, in_proj_weight, in_proj_bias, out_proj_weight, out_proj_bias, chunk_size,
+    key_padding_mask=None, dropout_p=0.0, training=True,
+):
+    r"""
+    Multi-head attention with an online softmax over chunks of the keys / values, same output as multi_head_attention_forward.
+
+    Only a chunk of the key / value projections and of the scores is allocated at once. Under autograd every chunk is
+    checkpointed and recomputed in the backward, so the memory beyond the inputs does not grow with the key length but for
+    the L x E running state kept per chunk.
+
+    Shape:
+        - query: (L, N, E), key / value: (S, N, E), key_padding_mask: (N, S)
+        - attn_output: (L, N, E)
+    """
+    tgt_len, bsz, embed_dim = query.size()
+    head_dim = embed_dim // num_heads
+    q_weight, k_weight, v_weight = in_proj_weight.chunk(3)
+    q_bias, k_bias, v_bias = in_proj_bias.chunk(3) if in_proj_bias is not None else (None, None, None)
+
+    q = F.linear(query, q_weight, q_bias) * float(head_dim) ** -0.5
+    q = q.contiguous().view(tgt_len, bsz * num_heads, head_dim).transpose(0, 1)
+    m = torch.full((bsz * num_heads, tgt_len, 1), float("-inf"), dtype=q.dtype, device=q.device)
+    l = torch.zeros_like(m)
+    acc = torch.zeros_like(q)
+    for start in range(0, key.size(0), chunk_size):
+        chunk_mask = key_padding_mask[:, start : start + chunk_size] if key_padding_mask is not None else None
+        args = (q, key[start : start + chunk_size], value[start : start + chunk_size], m, l, acc, k_weight, k_bias, v_weight, v_bias, chunk_mask, num_heads, dropout_p, training)
+        if torch.is_grad_enabled():
+            m, l, acc = checkpoint(_attention_chunk, *args, use_reentrant=False)
+        else:
+            m, l, acc = _attention_chunk(*args)
+
+    attn_output = (acc / l).transpose(0, 1).contiguous().view(tgt_len, bsz, embed_dim)
+    return F.linear(attn_output, out_proj_weight, out_proj_bias)
+
+
+class MultiheadAttention(Module):
+    r"""Allows the model to jointly attend to information
+    from different representation subspaces.
+    See reference: Attention Is All You Need
+
+    .. math::
+        \text{MultiHead}(Q, K, V) = \text{Concat}(head_1,\dots,head_h)W^O
+        \text{where} head_i = \text{Attention}(QW_i^Q, KW_i^K, VW_i^V)
+
+    Args:
+        embed_dim: total dimension of the model.
+        num_heads: parallel attention heads.
+        dropout: a Dropout layer on attn_output_weights. Default: 0.0.
+        bias: add bias as module parameter. Default: True.
+        add_bias_kv: add bias to the key and value sequences at dim=0.
+        add_zero_attn: add a new batch of zeros to the key and
+                       value sequences at dim=1.
+        kdim: total number of features in key. Default: None.
+        vdim: total number of features in value. Default: None.
+        kv_chunk_size: if set, keys and values longer than it are projected and attended chunk by chunk
+            with an online softmax, when the weights are not needed. Default: None.
+
+        Note: if kdim and vdim are None, they will be set to embed_dim such that
+        query, key, and value have the same number of features.
+
+    Examples::
+
+        >>> multihead_attn = nn.MultiheadAttention(embed_dim, num_heads)
+        >>> attn_output, attn_output_weights = multihead_attn(query, key, value)
+    """
+    bias_k: Optional[torch.Tensor]
+    bias_v: Optional[torch.Tensor]
+
+    def __init__(
+        self, embed_dim, num_heads, dropout=0.0, bias=True, add_bias_kv=False, add_zero_attn=False, kdim=None, vdim=None,
+        kv_chunk_size=None,
+    ):
+        super(MultiheadAttention, self).__init__()
+        self.embed_dim = embed_dim
+        self.kdim = kdim if kdim is not None else embed_dim
+        self.vdim = vdim if vdim is not None else embed_dim
+        self._qkv_same_embed_dim = self.kdim == embed_dim and self.vdim == embed_dim
+
+        self.num_heads = num_heads
+        self.dropout = dropout
+        self.head_dim = embed_dim // num_heads
+        assert self.head_dim * num_heads == self.embed_dim, "embed_dim must be divisible by num_heads"
+
+        if self._qkv_same_embed_dim is False:
+            self.q_proj_weight = Parameter(torch.Tensor(embed_dim, embed_dim))
+            self.k_proj_weight = Parameter(torch.Tensor(embed_dim, self.kdim))
+            self.v_proj_weight = Parameter(torch.Tensor(embed_dim, self.vdim))
+            self.register_parameter("in_proj_weight", None)
+        else:
+            self.in_proj_weight = Parameter(torch.empty(3 * embed_dim, embed_dim))
+            self.register_parameter("q_proj_weight", None)
+            self.register_parameter("k_proj_weight", None)
+            self.register_parameter("v_proj_weight", None)
+
+        if bias:
+            self.in_proj_bias = Parameter(torch.empty(3 * embed_dim))
+        else:
+            self.register_parameter("in_proj_bias", None)
+        self.out_proj = nn.Linear(embed_dim, embed_dim)
+
+        if add_bias_kv:
+            self.bias_k = Parameter(torch.empty(1, 1, embed_dim))
+            self.bias_v = Parameter(torch.empty(1, 1, embed_dim))
+        else:
+            self.bias_k = self.bias_v = None
+
+        self.add_zero_attn = add_zero_attn
+        self.kv_chunk_size = kv_chunk_size
+
+        self._reset_parameters()
+
+    def _reset_parameters(self):
+        if self._qkv_same_embed_dim:
+            xavier_uniform_(self.in_proj_weight)
+        else:
+            xavier_uniform_(self.q_proj_weight)
+            xavier_uniform_(self.k_proj_weight)
+            xavier_uniform_(self.v_proj_weight)
+
+        if self.in_proj_bias is not None:
+            constant_(self.in_proj_bias, 0.0)
+            constant_(self.out_proj.bias, 0.0)
+        if self.bias_k is not None:
+            xavier_normal_(self.bias_k)
+        if self.bias_v is not None:
+            xavier_normal_(self.bias_v)
+
+    def __setstate__(self, state):
+        # Support loading old MultiheadAttention checkpoints generated by v1.1.0
+        if "_qkv_same_embed_dim" not in state:
+            state["_qkv_same_embed_dim"] = True
+
+        super(MultiheadAttention, self).__setstate__(state)
+
+    def forward(self, query, key, value, key_padding_mask=None, need_weights=True, need_raw=True, attn_mask=None):
+        r"""
+        Args:
+            query, key, value: map a query and a set of key-value pairs to an output.
+                See "Attention Is All You Need" for more details.
+            key_padding_mask: if provided, specified padding elements in the key will
+                be ignored by the attention. When given a binary mask and a value is True,
+                the corresponding value on the attention layer will be ignored. When given
+                a byte mask and a value is non-zero, the corresponding value on the attention
+                layer will be ignored
+            need_weights: output attn_output_weights, else the fused scaled_dot_product_attention is used and they are never materialized.
+            attn_mask: 2D or 3D mask that prevents attention to certain positions. A 2D mask will be broadcasted for all
+                the batches while a 3D mask allows to specify a different mask for the entries of each batch.
+
+        Shape:
+            - Inputs:
+            - query: :math:`(L, N, E)` where L is the target sequence length, N is the batch size, E is
+              the embedding dimension.
+            - key: :math:`(S, N, E)`, where S is the source sequence length, N is the batch size, E is
+              the embedding dimension.
+            - value: :math:`(S, N, E)` where S is the source sequence length, N is the batch size, E is
+              the embedding dimension.
+            - key_padding_mask: :math:`(N, S)` where N is the batch size, S is the source sequence length.
+              If a ByteTensor is provided, the non-zero positions will be ignored while the position
+              with the zero positions will be unchanged. If a BoolTensor is provided, the positions with the
+              value of ``True`` will be ignored while the position with the value of ``False`` will be unchanged.
+            - attn_mask: 2D mask :math:`(L, S)` where L is the target sequence length, S is the source sequence length.
+              3D mask :math:`(N*num_heads, L, S)` where N is the batch size, L is the target sequence length,
+              S is the source sequence length. attn_mask ensure that position i is allowed to attend the unmasked
+              positions. If a ByteTensor is provided, the non-zero positions are not allowed to attend
+              while the zero positions will be unchanged. If a BoolTensor is provided, positions with ``True``
+              is not allowed to attend while ``False`` values will be unchanged. If a FloatTensor
+              is provided, it will be added to the attention weight.
+
+            - Outputs:
+            - attn_output: :math:`(L, N, E)` where L is the target sequence length, N is the batch size,
+              E is the embedding dimension.
+            - attn_output_weights: :math:`(N, L, S)` where N is the batch size,
+              L is the target sequence length, S is the source sequence length.
+        """
+        if (
+            self.kv_chunk_size and key.size(0) > self.kv_chunk_size and not need_weights and attn_mask is None
+            and self._qkv_same_embed_dim and self.bias_k is None and not self.add_zero_attn
+        ):
+            return chunked_multi_head_attention_forward(
+                query,
+                key,
+                value,
+                self.num_heads,
+                self.in_proj_weight,
+                self.in_proj_bias,
+                self.out_proj.weight,
+                self.out_proj.bias,
+                self.kv_chunk_size,
+                key_padding_mask=key_padding_mask,
+                dropout_p=self.dropout,
+                training=self.training,
+            ), None
+        if not self._qkv_same_embed_dim:
+            return multi_head_attention_forward(
+                query,
+                key,
+                value,
+                self.embed_dim,
+                self.num_heads,
+                self.in_proj_weight,
+                self.in_proj_bias,
+                self.bias_k,
+                self.bias_v,
+                self.add_zero_attn,
+                self.dropout,
+                self.out_proj.weight,
+                self.out_proj.bias,
+                training=self.training,
+                key_padding_mask=key_padding_mask,
+                need_weights=need_weights,
+                need_raw=need_raw,
+                attn_mask=attn_mask,
+                use_separate_proj_weight=True,
+                q_proj_weight=self.q_proj_weight,
+                k_proj_weight=self.k_proj_weight,
+                v_proj_weight=self.v_proj_weight,
+            )
+        else:
+            return multi_head_attention_forward(
+                query,
+                key,
+                value,
+                self.embed_dim,
+                self.num_heads,
+                self.in_proj_weight,
+                self.in_proj_bias,
+                self.bias_k,
+                self.bias_v,
+                self.add_zero_attn,
+                self.dropout,
+                self.out_proj.weight,
+                self.out_proj.bias,
+                training=self.training,
+                key_padding_mask=key_padding_mask,
+                need_weights=need_weights,
+                need_raw=need_raw,
+                attn_mask=attn_mask,
+            )
@@ -0,0 +1,153 @@
+from collections import OrderedDict
+
+import torch
+
+
+def sinkhorn_log(a, b, M, reg, reg_m=float('inf'), numItermax=1000, stopThr=1e-6, warmstart=None):
+    r"""
+    Batched Sinkhorn-Knopp in the log domain, balanced (reg_m = inf) or unbalanced with KL marginal penalties.
+
+    Follows ot.sinkhorn (balanced) and ot.unbalanced.sinkhorn_knopp_unbalanced (reg_type='kl') of POT,
+    on B problems at once. Entries of a / b that are 0 (e.g. padded instances) get no mass. Converged
+    problems are frozen, the loop exits once all of them are below stopThr.
+
+    args:
+        a (torch.Tensor): B x N source histograms
+        b (torch.Tensor): B x M target histograms
+        M (torch.Tensor): B x N x M cost matrices
+        reg (float): Entropic regularization
+        reg_m (float): Marginal relaxation of the unbalanced problem, inf for the balanced one
+        numItermax (int): Maximum number of iterations
+        stopThr (float): Stopping threshold, on the column marginal violation (balanced) or on the relative change of the scalings (unbalanced)
+        warmstart (tuple): B x N and B x M log-scalings to start from, as returned in the log, NaN where unknown
+
+    returns:
+        plan (torch.Tensor): B x N x M transport plans
+        log (dict): 'niter' iterations of each problem, 'logu' / 'logv' log-scalings (B x N, B x M)
+    """
+    valid_a, valid_b = a > 0, b > 0
+    log_a, log_b = torch.log(a), torch.log(b)
+    balanced = reg_m == float('inf')
+    fi = 1. if balanced else reg_m / (reg_m + reg)
+
+    # the unbalanced problem penalizes the KL to a b^T, that is folded in the kernel
+    log_K = -M / reg
+    if not balanced:
+        log_K = log_K + log_a.unsqueeze(2) + log_b.unsqueeze(1)
+    log_K = log_K.masked_fill(~(valid_a.unsqueeze(2) & valid_b.unsqueeze(1)), -float('inf'))
+
+    f = torch.zeros_like(a) if not balanced else -torch.log(valid_a.sum(dim=1, keepdim=True).to(a.dtype)).expand_as(a)
+    g = torch.zeros_like(b) if not balanced else -torch.log(valid_b.sum(dim=1, keepdim=True).to(b.dtype)).expand_as(b)
+    if warmstart is not None:
+        # NaN entries of the warm start keep the cold initialization
+        f = torch.where(torch.isnan(warmstart[0]), f, warmstart[0].to(a.dtype))
+        g = torch.where(torch.isnan(warmstart[1]), g, warmstart[1].to(b.dtype))
+    f = f.masked_fill(~valid_a, -float('inf'))
+    g = g.masked_fill(~valid_b, -float('inf'))
+
+    niter = torch.zeros(a.shape[0], dtype=torch.long, device=a.device)
+    active = torch.ones(a.shape[0], dtype=torch.bool, device=a.device)
+    for _ in range(numItermax):
+        f_prev, g_prev = f, g
+        if balanced:
+            # ot.sinkhorn updates v, then u
+            g = torch.where(valid_b, log_b - torch.logsumexp(log_K + f.unsqueeze(2), dim=1), g)
+            f = torch.where(valid_a, log_a - torch.logsumexp(log_K + g.unsqueeze(1), dim=2), f)
+        else:
+            f = torch.where(valid_a, fi * (log_a - torch.logsumexp(log_K + g.unsqueeze(1), dim=2)), f)
+            g = torch.where(valid_b, fi * (log_b - torch.logsumexp(log_K + f.unsqueeze(2), dim=1)), g)
+        f = torch.where(active.unsqueeze(1), f, f_prev)
+        g = torch.where(active.unsqueeze(1), g, g_prev)
+        niter += active
+
+        if balanced:
+            err = torch.linalg.vector_norm(torch.exp(log_K + f.unsqueeze(2) + g.unsqueeze(1)).sum(dim=1) - b, dim=1)
+        else:
+            u, u_prev, v, v_prev = torch.exp(f), torch.exp(f_prev), torch.exp(g), torch.exp(g_prev)
+            err_u = (u - u_prev).abs().amax(dim=1) / torch.maximum(u.amax(dim=1), u_prev.amax(dim=1)).clamp(min=1.)
+            err_v = (v - v_prev).abs().amax(dim=1) / torch.maximum(v.amax(dim=1), v_prev.amax(dim=1)).clamp(min=1.)
+            err = 0.5 * (err_u + err_v)
+        active = active & (err >= stopThr)
+        if not active.any():
+            break
+
+    plan = torch.exp(log_K + f.unsqueeze(2) + g.unsqueeze(1))
+    return plan, {'niter': niter, 'logu': f, 'logv': g}
+
+
+class SinkhornCache:
+    r"""
+    Log-scalings of the last Sinkhorn solves of each patient, to warm-start the next epochs
+
+    The scalings of the instances (logu) are kept per instance of the bag, so that the randomly drawn
+    micro-batches of the next epoch start from the scalings their instances last had. Entries are keyed
+    by patient and micro-batch layout, and the least recently used ones are dropped beyond max_size.
+
+    args:
+        max_size (int): Maximum number of cached entries
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.cold_iter, self.cold_solve = 0, 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        # iterations of the warm-started solves of the current epoch, the cold ones are averaged over all epochs
+        self.warm_iter, self.warm_solve = 0, 0
+
+    def warmstart(self, keys, instances):
+        r"""
+        args:
+            keys (list): Key of each problem of the batch, e.g. (patient, number of micro-batches)
+            instances (list): Indices of the bag instances of each problem
+
+        returns:
+            (logu, logv, hits): padded B x N and B x M log-scalings, NaN where unknown, and which keys were cached
+        """
+        hits = [key in self.entries for key in keys]
+        if not any(hits):
+            return None, hits
+        ref = next(self.entries[key] for key, hit in zip(keys, hits) if hit)
+        logu = torch.full((len(keys), max(len(idx) for idx in instances)), float('nan'), dtype=ref['logu'].dtype, device=ref['logu'].device)
+        logv = torch.full((len(keys), len(ref['logv'])), float('nan'), dtype=ref['logv'].dtype, device=ref['logv'].device)
+        for b, (key, idx, hit) in enumerate(zip(keys, instances, hits)):
+            if hit:
+                self.entries.move_to_end(key)
+                entry = self.entries[key]
+                logu[b, :len(idx)] = entry['logu'][torch.as_tensor(idx, device=logu.device)]
+                logv[b] = entry['logv']
+        return (logu, logv), hits
+
+    def update(self, keys, instances, sizes, log, hits):
+        r"""
+        Stores the log-scalings of a solve, and its iterations
+
+        args:
+            sizes (list): Number of instances in the bag of each problem
+            log (dict): Log of sinkhorn_log
+            hits (list): Whether each problem was warm-started
+        """
+        for b, (key, idx, size, hit) in enumerate(zip(keys, instances, sizes, hits)):
+            niter = int(log['niter'][b])
+            if hit:
+                self.warm_iter, self.warm_solve = self.warm_iter + niter, self.warm_solve + 1
+            else:
+                self.cold_iter, self.cold_solve = self.cold_iter + niter, self.cold_solve + 1
+
+            if key not in self.entries:
+                self.entries[key] = {'logu': torch.full((size,), float('nan'), dtype=log['logu'].dtype, device=log['logu'].device)}
+            entry = self.entries[key]
+            entry['logu'][torch.as_tensor(idx, device=entry['logu'].device)] = log['logu'][b, :len(idx)].detach()
+            entry['logv'] = log['logv'][b].detach()
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def saving(self):
+        r"""
+        Fraction of the iterations saved by the warm-started solves of the epoch, against the average cold solve
+        """
+        if not self.warm_solve or not self.cold_solve:
+            return None
+        return 1 - (self.warm_iter / self.warm_solve) / (self.cold_iter / self.cold_solve)
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+import torch
+
+from mmsurv.models.cmta_util import NystromAttention, bipartite_merge
+
+
+def test_bipartite_merge_duplicates():
+    # tokens that repeat their neighbour are merged back into it, in the order of the sequence
+    generator = torch.Generator().manual_seed(0)
+    x = torch.randn(2, 9, 16, generator=generator)
+    x_twice = x.repeat_interleave(2, dim=1)
+    torch.testing.assert_close(bipartite_merge(x_twice, 9), x)
+    assert bipartite_merge(x_twice, 4).shape == (2, 14, 16)
+    # at most half of the tokens are removed
+    assert bipartite_merge(x, 10).shape == (2, 5, 16)
+    assert bipartite_merge(x, 0) is x
+
+
+def test_bipartite_merge_means():
+    # a merged token is the mean of the tokens it stands for
+    x = torch.tensor([[[1., 0.], [1., 0.1], [0., 1.], [5., 0.]]])
+    torch.testing.assert_close(bipartite_merge(x, 1), torch.tensor([[[1., 0.1], [0., 1.], [3., 0.]]]))
+
+
+@pytest.mark.parametrize("landmark_budget", [None, 2000])
+def test_attention_rows_match_map(landmark_budget, tmp_path):
+    # the rows extracted block by block are the rows of the full attention map, without its padding
+    torch.manual_seed(0)
+    attention = NystromAttention(dim=32, dim_head=8, heads=2, num_landmarks=16, landmark_budget=landmark_budget).eval()
+    x = torch.randn(2, 150, 32)
+    with torch.no_grad():
+        _, attn = attention(x, return_attn=True)
+        attn = attn[..., -150:, -150:]
+        _, attn_cls = attention(x, return_attn='cls')
+        rows = torch.cat([block for _, block in attention.attention_rows(x, block_size=64)], dim=2)
+        some_rows = torch.cat([block for _, block in attention.attention_rows(x, rows=[3, 140, 7], block_size=2)], dim=2)
+    torch.testing.assert_close(rows, attn)
+    torch.testing.assert_close(attn_cls, attn[..., :1, :])
+    torch.testing.assert_close(some_rows, attn[..., [3, 140, 7], :])
+    saved = np.load(attention.save_attention(str(tmp_path / 'attn.npy'), x, rows=[3, 140, 7], block_size=2))
+    torch.testing.assert_close(torch.from_numpy(saved), some_rows)
+
+
+def test_landmarks_budget():
+    attention = NystromAttention(dim=32, num_landmarks=256, landmark_budget=100000)
+    assert attention.landmarks(100) == 100
+    for n in [1000, 4097, 30000]:
+        m = attention.landmarks(n)
+        # within the budget, in groups of equal size padded by less than a group
+        assert n * m <= 100000 or m == 1
+        group = -(-n // m)
+        assert m * group - n < group
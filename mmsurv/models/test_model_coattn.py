@@ -0,0 +1,49 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from mmsurv.models.model_coattn import MCAT_Surv
+from mmsurv.models.model_motcat import MOTCAT_Surv
+from mmsurv.models.model_cmta import CMTA
+from mmsurv.utils.utils import collate_MIL_survival_sig
+
+
+OMIC_SIZES = [10, 20, 30]
+
+
+def random_patients(lengths=(40, 7, 25), seed=0):
+	generator = torch.Generator().manual_seed(seed)
+	# (bag, *signatures, label, event_time, c, index) as returned by the dataset
+	return [(torch.randn(n, 64, generator=generator), *[torch.randn(size, generator=generator) for size in OMIC_SIZES], 0, 1., 0., i) for i, n in enumerate(lengths)]
+
+
+@pytest.mark.parametrize("model_fn", [
+	lambda: MCAT_Surv(64, omic_sizes=OMIC_SIZES),
+	lambda: MCAT_Surv(64, omic_sizes=OMIC_SIZES, attn_chunk_size=16),
+	lambda: MOTCAT_Surv(64, omic_sizes=OMIC_SIZES),
+	lambda: MOTCAT_Surv(64, omic_sizes=OMIC_SIZES, ot_impl="torch-uot-l2"),
+	lambda: CMTA(64, omic_input_dim=OMIC_SIZES),
+], ids=["mcat", "mcat-chunked", "motcat", "motcat-torch", "cmta"])
+def test_padded_batch_matches_per_bag(model_fn):
+	# a padded, masked batch of bags gives the hazards of each bag alone
+	torch.manual_seed(0)
+	model = model_fn().eval()
+	patients = random_patients()
+	img, *omics, label, event_time, c, mask, index = collate_MIL_survival_sig(patients)
+	with torch.no_grad():
+		hazards = model(x_path=img, mask=mask, **{"x_omic%d" % (i+1): sig for i, sig in enumerate(omics)})[0]
+		for b, patient in enumerate(patients):
+			hazards_bag = model(x_path=patient[0], **{"x_omic%d" % (i+1): sig for i, sig in enumerate(patient[1:1+len(OMIC_SIZES)])})[0]
+			torch.testing.assert_close(hazards[b:b+1], hazards_bag, rtol=1e-4, atol=1e-5)
+
+
+def test_mcat_bucket_padding():
+	# mcat pads the bags to the bucket length of --compile_buckets, masked
+	torch.manual_seed(0)
+	model = MCAT_Surv(64, omic_sizes=OMIC_SIZES).eval()
+	img, *omics, label, event_time, c, mask, index = collate_MIL_survival_sig(random_patients())
+	omics = {"x_omic%d" % (i+1): sig for i, sig in enumerate(omics)}
+	with torch.no_grad():
+		hazards = model(x_path=img, mask=mask, **omics)[0]
+		hazards_padded = model(x_path=F.pad(img, (0, 0, 0, 512 - img.shape[1])), mask=F.pad(mask, (0, 512 - mask.shape[1]), value=True), **omics)[0]
+	torch.testing.assert_close(hazards_padded, hazards, rtol=1e-4, atol=1e-5)
@@ -0,0 +1,16 @@
+import pytest
+import torch
+
+from mmsurv.models.model_porpoise import PorpoiseMMF
+from mmsurv.models.test_model_set_mil import ragged_forward_matches_per_bag, streamed_forward_matches_dense
+
+
+@pytest.mark.parametrize("fusion", ['concat', 'bilinear'])
+def test_ragged_batch_matches_per_bag(fusion):
+    torch.manual_seed(0)
+    ragged_forward_matches_per_bag(PorpoiseMMF(20, path_input_dim=64, fusion=fusion).eval(), weighted=True)
+
+
+def test_streamed_inference_matches_dense():
+    torch.manual_seed(0)
+    streamed_forward_matches_dense(PorpoiseMMF(20, path_input_dim=64, fusion='concat').eval())
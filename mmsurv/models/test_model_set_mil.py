@@ -0,0 +1,99 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from mmsurv.models.model_set_mil import MIL_Attention_FC_surv, MIL_Cluster_FC_surv, MIL_Sum_FC_surv
+
+
+def cluster_loop(model, x, cluster_id):
+    # the former per-cluster encoding
+    return torch.stack([model.phis[i](x[cluster_id == i]).mean(0) if (cluster_id == i).any() else torch.zeros(512, device=x.device) for i in range(model.num_clusters)])
+
+
+def ragged_forward_matches_per_bag(model, lengths=(30, 1, 75), weighted=False):
+    # a ragged batch of bags gives the hazards of each bag alone
+    generator = torch.Generator().manual_seed(0)
+    bag_offsets = torch.cumsum(torch.tensor((0,) + lengths), 0)
+    x_path = torch.randn(int(bag_offsets[-1]), 64, generator=generator)
+    x_weight = torch.randint(1, 5, (len(x_path),), generator=generator).float() if weighted else None
+    x_omic = torch.randn(len(lengths), 20, generator=generator)
+    with torch.no_grad():
+        hazards, S = model(x_path=x_path, x_weight=x_weight, bag_offsets=bag_offsets, x_omic=x_omic)
+        for b, (start, end) in enumerate(zip(bag_offsets[:-1], bag_offsets[1:])):
+            hazards_bag, S_bag = model(x_path=x_path[start:end], x_weight=x_weight[start:end] if weighted else None, x_omic=x_omic[b])
+            torch.testing.assert_close(hazards[b:b+1], hazards_bag)
+            torch.testing.assert_close(S[b:b+1], S_bag)
+
+
+@pytest.mark.parametrize("weighted", [False, True])
+@pytest.mark.parametrize("model_cls", [MIL_Sum_FC_surv, MIL_Attention_FC_surv])
+def test_ragged_batch_matches_per_bag(model_cls, weighted):
+    torch.manual_seed(0)
+    ragged_forward_matches_per_bag(model_cls(64, omic_input_dim=20, fusion='concat').eval(), weighted=weighted)
+
+
+def streamed_forward_matches_dense(model, lengths=(300, 1, 75), chunk_size=64):
+    # bags streamed chunk by chunk give the hazards of the bags encoded at once
+    generator = torch.Generator().manual_seed(0)
+    bags = [torch.randn(n, 64, generator=generator) for n in lengths]
+    weights = [torch.randint(1, 5, (n,), generator=generator).float() for n in lengths]
+    x_omic = torch.randn(len(lengths), 20, generator=generator)
+    with torch.no_grad():
+        hazards, _ = model(x_path_chunks=[[(x[i:i+chunk_size], w[i:i+chunk_size]) for i in range(0, len(x), chunk_size)] for x, w in zip(bags, weights)], x_omic=x_omic)
+        for b, (x, w) in enumerate(zip(bags, weights)):
+            torch.testing.assert_close(hazards[b:b+1], model(x_path=x, x_weight=w, x_omic=x_omic[b])[0])
+
+
+@pytest.mark.parametrize("model_cls", [MIL_Sum_FC_surv, MIL_Attention_FC_surv])
+def test_streamed_inference_matches_dense(model_cls):
+    torch.manual_seed(0)
+    streamed_forward_matches_dense(model_cls(64, omic_input_dim=20, fusion='concat').eval())
+
+
+@pytest.mark.parametrize("model_cls", [MIL_Sum_FC_surv, MIL_Attention_FC_surv])
+def test_bucket_padding_matches_bag(model_cls):
+    # the instances padded to a bucket length of --compile_buckets are weighted 0 and added to the last bag
+    torch.manual_seed(0)
+    model = model_cls(64, omic_input_dim=20, fusion='concat').eval()
+    x_path, x_omic = torch.randn(300, 64), torch.randn(2, 20)
+    bag_offsets = torch.tensor([0, 120, 300])
+    with torch.no_grad():
+        hazards, _ = model(x_path=x_path, x_omic=x_omic, bag_offsets=bag_offsets)
+        hazards_padded, _ = model(x_path=F.pad(x_path, (0, 0, 0, 212)), x_omic=x_omic, x_weight=F.pad(torch.ones(300), (0, 212)), bag_offsets=torch.tensor([0, 120, 512]))
+    torch.testing.assert_close(hazards_padded, hazards)
+
+
+def skewed_bag(n=3000, device='cpu'):
+    generator = torch.Generator().manual_seed(0)
+    x = torch.randn(n, 64, generator=generator)
+    # most patches in cluster 0, none in cluster 1
+    cluster_id = torch.where(torch.rand(n, generator=generator) < 0.8, 0, torch.randint(2, 10, (n,), generator=generator))
+    return x.to(device), cluster_id.to(device)
+
+
+@pytest.mark.parametrize("chunk_size", [16384, 1000])
+@pytest.mark.parametrize("device", ['cpu', pytest.param('cuda', marks=pytest.mark.skipif(not torch.cuda.is_available(), reason='batched path of the accelerators'))])
+def test_cluster_pool_matches_loop(chunk_size, device):
+    torch.manual_seed(0)
+    model = MIL_Cluster_FC_surv(64, num_clusters=10, dropout=0., chunk_size=chunk_size, piece_len=256).to(device).train()
+    x, cluster_id = skewed_bag(device=device)
+    h = model.cluster_pool(x, cluster_id)
+    grads = torch.autograd.grad(h.pow(2).sum(), list(model.phis.parameters()), allow_unused=True)
+    h_loop = cluster_loop(model, x, cluster_id)
+    grads_loop = torch.autograd.grad(h_loop.pow(2).sum(), list(model.phis.parameters()), allow_unused=True)
+
+    torch.testing.assert_close(h, h_loop, rtol=1e-5, atol=1e-6)
+    assert h[1].abs().max() == 0
+    for g, g_loop in zip(grads, grads_loop):
+        assert (g is None) == (g_loop is None)
+        if g is not None:
+            torch.testing.assert_close(g, g_loop, rtol=1e-5, atol=1e-6)
+
+
+def test_cluster_pool_autocast():
+    model = MIL_Cluster_FC_surv(64, num_clusters=10, chunk_size=1000).eval()
+    x, cluster_id = skewed_bag()
+    with torch.no_grad(), torch.autocast(device_type='cpu', dtype=torch.bfloat16):
+        h = model.cluster_pool(x, cluster_id)
+    assert h.dtype == torch.float32
+    torch.testing.assert_close(h, cluster_loop(model, x, cluster_id).detach(), rtol=0.05, atol=0.02)
@@ -0,0 +1,252 @@
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from mmsurv.models.model_coattn import MCAT_Surv
+from mmsurv.models.model_utils import (Attn_Net_Gated, BilinearFusion, LRBilinearFusion, MultiheadAttention, SNN_Block, SNN_Signatures, attention_pool, checkpoint_activations, chunked_multi_head_attention_forward,
+                                       multi_head_attention_forward, ragged_bags, rank_in_bag, segment_softmax, sum_pool, topk_attention_pool)
+
+
+def test_attn_net_gated_seeded_init():
+    # the fused layer draws the weights of the two branches in their former order, and nothing more
+    torch.manual_seed(0)
+    attention_a, attention_b, attention_c = nn.Linear(64, 16), nn.Linear(64, 16), nn.Linear(16, 1)
+    next_draw = torch.rand(1)
+    torch.manual_seed(0)
+    net = Attn_Net_Gated(L=64, D=16)
+    assert torch.equal(net.attention_ab.weight, torch.cat([attention_a.weight, attention_b.weight]))
+    assert torch.equal(net.attention_ab.bias, torch.cat([attention_a.bias, attention_b.bias]))
+    assert torch.equal(net.attention_c.weight, attention_c.weight)
+    assert torch.equal(torch.rand(1), next_draw)
+
+
+def test_attn_net_gated_loads_branch_checkpoints():
+    torch.manual_seed(0)
+    attention_a, attention_b, attention_c = nn.Linear(64, 16), nn.Linear(64, 16), nn.Linear(16, 1)
+    state_dict = {'attention_a.0.weight': attention_a.weight, 'attention_a.0.bias': attention_a.bias,
+                  'attention_b.0.weight': attention_b.weight, 'attention_b.0.bias': attention_b.bias,
+                  'attention_c.weight': attention_c.weight, 'attention_c.bias': attention_c.bias}
+    net = Attn_Net_Gated(L=64, D=16)
+    net.load_state_dict({k: v.detach().clone() for k, v in state_dict.items()})
+
+    x = torch.randn(10, 64)
+    with torch.no_grad():
+        expected = attention_c(torch.tanh(attention_a(x)) * torch.sigmoid(attention_b(x)))
+        A, h = net(x)
+    torch.testing.assert_close(A, expected)
+    assert h is x
+
+
+def ragged_batch(lengths=(5, 1, 12), dim=8, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    bag_offsets = torch.cumsum(torch.tensor([0] + list(lengths)), 0)
+    return torch.randn(int(bag_offsets[-1]), dim, generator=generator), bag_offsets
+
+
+def test_ragged_bags():
+    _, bag_offsets = ragged_batch()
+    bag_ids, num_bags = ragged_bags(bag_offsets)
+    assert num_bags == 3
+    assert bag_ids.tolist() == [0] * 5 + [1] + [2] * 12
+    # a single bag runs the unbatched path
+    assert ragged_bags(bag_offsets[:2]) == (None, 1)
+    assert ragged_bags(None) == (None, 1)
+
+
+def test_segment_pools_match_per_bag():
+    h, bag_offsets = ragged_batch()
+    A = 50 * torch.randn(len(h)) # large logits, to check the per-bag max shift
+    bag_ids, num_bags = ragged_bags(bag_offsets)
+    A_bags = segment_softmax(A, bag_ids, num_bags)
+    M, _ = attention_pool(A, h, bag_ids, num_bags)
+    M_sum = sum_pool(h, bag_ids, num_bags)
+    for b, (start, end) in enumerate(zip(bag_offsets[:-1], bag_offsets[1:])):
+        torch.testing.assert_close(A_bags[start:end], F.softmax(A[start:end], dim=0))
+        M_bag, _ = attention_pool(A[start:end], h[start:end])
+        torch.testing.assert_close(M[b:b+1], M_bag)
+        torch.testing.assert_close(M_sum[b:b+1], sum_pool(h[start:end]))
+
+
+def signature_stacks(omic_sizes, hidden=[256, 256]):
+    # the former per-signature encoders of mcat, motcat and cmta
+    return nn.ModuleList([nn.Sequential(*[SNN_Block(dim1=dim1, dim2=dim2) for dim1, dim2 in zip([size] + hidden[:-1], hidden)]) for size in omic_sizes])
+
+
+def test_snn_signatures_matches_stacks():
+    omic_sizes = [10, 37, 5]
+    torch.manual_seed(0)
+    stacks = signature_stacks(omic_sizes).eval()
+    torch.manual_seed(0)
+    fused = SNN_Signatures(omic_sizes).eval()
+    x_omic = [torch.randn(3, size) for size in omic_sizes]
+    with torch.no_grad():
+        expected = torch.stack([stack(x) for stack, x in zip(stacks, x_omic)])
+        # seeded runs draw the same weights
+        torch.testing.assert_close(fused(x_omic), expected)
+
+        # and checkpoints of the stacks load into the fused encoder, also within a model
+        model = nn.Module()
+        model.sig_networks = SNN_Signatures(omic_sizes).eval()
+        model.load_state_dict({'sig_networks.' + k: v for k, v in stacks.state_dict().items()})
+        torch.testing.assert_close(model.sig_networks(x_omic), expected)
+
+
+def attention_inputs(tgt_len=6, src_len=50, bsz=3, embed_dim=32, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    query = torch.randn(tgt_len, bsz, embed_dim, generator=generator)
+    key = torch.randn(src_len, bsz, embed_dim, generator=generator)
+    # bags of 50, 31 and 7 instances padded in a batch
+    key_padding_mask = torch.arange(src_len).unsqueeze(0) >= torch.tensor([[50], [31], [7]])
+    return query, key, key_padding_mask
+
+
+@pytest.mark.parametrize("attn_mask", [None, 'bool', 'float'])
+def test_multihead_attention_fused_matches_weights(attn_mask):
+    # the scaled_dot_product_attention path gives the output of the path that materializes the weights
+    torch.manual_seed(0)
+    attention = MultiheadAttention(embed_dim=32, num_heads=4).eval()
+    query, key, key_padding_mask = attention_inputs()
+    if attn_mask == 'bool':
+        attn_mask = torch.rand(6, 50) < 0.2
+        attn_mask[:, 0] = False
+    elif attn_mask == 'float':
+        attn_mask = torch.randn(6, 50)
+    with torch.no_grad():
+        fused, weights = attention(query, key, key, key_padding_mask=key_padding_mask, attn_mask=attn_mask, need_weights=False)
+        expected, _ = attention(query, key, key, key_padding_mask=key_padding_mask, attn_mask=attn_mask, need_weights=True)
+    assert weights is None
+    torch.testing.assert_close(fused, expected, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("chunk_size", [7, 16, 64])
+def test_chunked_attention_matches_dense(chunk_size):
+    # the online softmax over chunks of keys gives the output and the gradients of the dense attention
+    torch.manual_seed(0)
+    attention = MultiheadAttention(embed_dim=32, num_heads=4)
+    query, key, key_padding_mask = attention_inputs()
+    key.requires_grad_(True)
+    params = [attention.in_proj_weight, attention.in_proj_bias, attention.out_proj.weight, attention.out_proj.bias]
+
+    chunked = chunked_multi_head_attention_forward(query, key, key, 4, *params, chunk_size, key_padding_mask=key_padding_mask)
+    grads = torch.autograd.grad(chunked.pow(2).sum(), [key] + params)
+    dense, _ = multi_head_attention_forward(query, key, key, 32, 4, attention.in_proj_weight, attention.in_proj_bias, None, None, False, 0.,
+                                            attention.out_proj.weight, attention.out_proj.bias, key_padding_mask=key_padding_mask, need_weights=False)
+    grads_dense = torch.autograd.grad(dense.pow(2).sum(), [key] + params)
+
+    torch.testing.assert_close(chunked, dense, rtol=1e-5, atol=1e-6)
+    for g, g_dense in zip(grads, grads_dense):
+        torch.testing.assert_close(g, g_dense, rtol=1e-4, atol=1e-5)
+
+
+def test_multihead_attention_kv_chunk_size():
+    torch.manual_seed(0)
+    attention = MultiheadAttention(embed_dim=32, num_heads=4, kv_chunk_size=16).eval()
+    query, key, key_padding_mask = attention_inputs()
+    with torch.no_grad():
+        chunked, _ = attention(query, key, key, key_padding_mask=key_padding_mask, need_weights=False)
+        # the weights are only available from the dense path
+        dense, weights = attention(query, key, key, key_padding_mask=key_padding_mask, need_weights=True)
+    assert weights.shape == (3, 4, 6, 50)
+    torch.testing.assert_close(chunked, dense, rtol=1e-5, atol=1e-6)
+
+
+def test_lr_bilinear_fusion():
+    # the fusion is the bilinear map of the gated units by the rank-r tensor of its factors
+    torch.manual_seed(0)
+    fusion = LRBilinearFusion(dim1=256, dim2=256, scale_dim1=8, scale_dim2=8, mmhid=256, rank=4).eval()
+    units = {}
+    fusion.linear_o1.register_forward_hook(lambda module, inputs, output: units.update(o1=output))
+    fusion.linear_o2.register_forward_hook(lambda module, inputs, output: units.update(o2=output))
+    vec1, vec2 = torch.randn(5, 256), torch.randn(5, 256)
+    with torch.no_grad():
+        out = fusion(vec1, vec2)
+        W = torch.einsum('r,rim,rjm->ijm', fusion.fusion_weights[0], fusion.h1_factor, fusion.h2_factor)
+        o1, o2 = F.pad(units['o1'], (0, 1), value=1.), F.pad(units['o2'], (0, 1), value=1.)
+        expected = F.relu(torch.einsum('bi,bj,ijm->bm', o1, o2, W) + fusion.fusion_bias)
+    assert out.shape == (5, 256)
+    torch.testing.assert_close(out, expected, rtol=1e-4, atol=1e-5)
+
+    # the same gated units as BilinearFusion, and a fraction of the parameters of its fusion
+    bilinear = BilinearFusion(dim1=256, dim2=256, scale_dim1=8, scale_dim2=8, mmhid=256)
+    n_params = lambda *modules: sum(p.numel() for module in modules for p in ([module] if isinstance(module, nn.Parameter) else module.parameters()))
+    lr_fusion, bilinear_fusion = n_params(fusion.h1_factor, fusion.h2_factor, fusion.fusion_weights, fusion.fusion_bias), n_params(bilinear.encoder1, bilinear.encoder2)
+    assert n_params(fusion) - lr_fusion == n_params(bilinear) - bilinear_fusion
+    assert 4 * lr_fusion < bilinear_fusion
+
+
+def test_checkpoint_activations():
+    # the checkpointed blocks give the outputs and the gradients of the model, with the same state dict
+    torch.manual_seed(0)
+    model = MCAT_Surv(64, omic_sizes=[10, 20]).eval()
+    x = {'x_path': torch.randn(50, 64), 'x_omic1': torch.randn(10), 'x_omic2': torch.randn(20)}
+    hazards = model(**x)[0]
+    grads = torch.autograd.grad(hazards.sum(), list(model.parameters()))
+    keys = list(model.state_dict())
+
+    checkpoint_activations(model, model.checkpoint_blocks + ['path_transformer.layers.0'])
+    assert isinstance(model.coattn, MultiheadAttention) and list(model.state_dict()) == keys
+    hazards_ckpt = model(**x)[0]
+    grads_ckpt = torch.autograd.grad(hazards_ckpt.sum(), list(model.parameters()))
+    torch.testing.assert_close(hazards_ckpt, hazards)
+    for g, g_ckpt in zip(grads, grads_ckpt):
+        torch.testing.assert_close(g_ckpt, g)
+
+    with pytest.raises(ValueError):
+        checkpoint_activations(model, ['path_transformer.layers.2'])
+
+
+def test_rank_in_bag():
+    score, bag_offsets = ragged_batch(dim=1)
+    score = score.squeeze(1)
+    bag_ids, num_bags = ragged_bags(bag_offsets)
+    rank = rank_in_bag(score, bag_ids, num_bags)
+    for start, end in zip(bag_offsets[:-1], bag_offsets[1:]):
+        expected = torch.empty(end - start, dtype=torch.long)
+        expected[torch.argsort(score[start:end], descending=True)] = torch.arange(end - start)
+        assert torch.equal(rank[start:end], expected)
+
+
+def attention_mil(dim=16):
+    return nn.Sequential(nn.Linear(dim, 32), nn.ReLU(), Attn_Net_Gated(L=32, D=8))
+
+
+@pytest.mark.parametrize("weighted", [False, True])
+def test_topk_attention_pool(weighted):
+    torch.manual_seed(0)
+    attention_net = attention_mil()
+    x, bag_offsets = ragged_batch(lengths=(40, 3, 100), dim=16)
+    x_weight = torch.randint(1, 5, (len(x),)).float() if weighted else None
+    bag_ids, num_bags = ragged_bags(bag_offsets)
+
+    def dense():
+        A, h = attention_net(x)
+        A = A.squeeze(1) + (torch.log(x_weight) if weighted else 0)
+        return attention_pool(A, h, bag_ids, num_bags)[0]
+
+    M_dense = dense()
+    grads_dense = torch.autograd.grad(M_dense.pow(2).sum(), list(attention_net.parameters()))
+    # the forward is the pooling of the whole bag
+    M, A_raw = topk_attention_pool(attention_net, x, x_weight, bag_ids, num_bags, k=8, n_random=4)
+    torch.testing.assert_close(M, M_dense)
+    torch.testing.assert_close(A_raw, attention_net(x)[0].squeeze(1).detach())
+    assert not A_raw.requires_grad
+    # and with every instance selected, so is the backward
+    M, _ = topk_attention_pool(attention_net, x, x_weight, bag_ids, num_bags, k=100, n_random=0)
+    grads = torch.autograd.grad(M.pow(2).sum(), list(attention_net.parameters()))
+    for g, g_dense in zip(grads, grads_dense):
+        torch.testing.assert_close(g, g_dense)
+
+
+def test_topk_attention_pool_selection():
+    # the gradient only goes through the top-k instances and the random ones of each bag
+    torch.manual_seed(0)
+    attention_net = attention_mil()
+    x, bag_offsets = ragged_batch(lengths=(40, 3, 100), dim=16)
+    x.requires_grad_(True)
+    bag_ids, num_bags = ragged_bags(bag_offsets)
+    M, A_raw = topk_attention_pool(attention_net, x, None, bag_ids, num_bags, k=5, n_random=2)
+    grad = torch.autograd.grad(M.sum(), x)[0]
+    selected = grad.abs().sum(dim=1) > 0
+    assert torch.bincount(bag_ids[selected], minlength=3).tolist() == [7, 3, 7]
+    assert (selected & (rank_in_bag(A_raw, bag_ids, num_bags) < 5)).sum() == 13
@@ -0,0 +1,87 @@
+import numpy as np
+import ot
+import pytest
+import torch
+
+from mmsurv.models.ot_util import SinkhornCache, sinkhorn_log
+
+
+def random_problem(n, m, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    M = torch.rand(n, m, generator=generator, dtype=torch.float64)
+    return M / M.max()
+
+
+@pytest.mark.parametrize("n", [50, 300])
+def test_sinkhorn_log_matches_pot_unbalanced(n):
+    M = random_problem(n, 6)
+    a, b = torch.full((n,), 1. / n, dtype=torch.float64), torch.full((6,), 1. / 6, dtype=torch.float64)
+    expected = ot.unbalanced.sinkhorn_knopp_unbalanced(a.numpy(), b.numpy(), M.numpy(), reg=0.1, reg_m=0.5)
+    plan, _ = sinkhorn_log(a[None], b[None], M[None], reg=0.1, reg_m=0.5)
+    np.testing.assert_allclose(plan[0].numpy(), expected, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize("n", [50, 300])
+def test_sinkhorn_log_matches_pot_balanced(n):
+    M = random_problem(n, 6, seed=1)
+    generator = torch.Generator().manual_seed(2)
+    a, b = torch.rand(n, generator=generator, dtype=torch.float64), torch.rand(6, generator=generator, dtype=torch.float64)
+    a, b = a / a.sum(), b / b.sum()
+    expected = ot.sinkhorn(a.numpy(), b.numpy(), M.numpy(), reg=0.1, stopThr=1e-9)
+    plan, _ = sinkhorn_log(a[None], b[None], M[None], reg=0.1, stopThr=1e-9)
+    np.testing.assert_allclose(plan[0].numpy(), expected, rtol=0, atol=1e-9)
+
+
+def test_sinkhorn_log_padded_rows():
+    # a bag padded in a batch gets the plan of the bag alone, and no mass on the padding
+    M_short, M_long = random_problem(40, 6, seed=3), random_problem(60, 6, seed=4)
+    a = torch.zeros(2, 60, dtype=torch.float64)
+    a[0, :40], a[1] = 1. / 40, 1. / 60
+    b = torch.full((2, 6), 1. / 6, dtype=torch.float64)
+    M = torch.stack([torch.cat([M_short, torch.zeros(20, 6, dtype=torch.float64)]), M_long])
+    plan, _ = sinkhorn_log(a, b, M, reg=0.1, reg_m=0.5)
+    alone, _ = sinkhorn_log(a[:1, :40], b[:1], M_short[None], reg=0.1, reg_m=0.5)
+    torch.testing.assert_close(plan[0, :40], alone[0], rtol=0, atol=1e-14)
+    assert plan[0, 40:].abs().max() == 0
+
+
+@pytest.mark.parametrize("reg_m", [0.5, float('inf')])
+def test_sinkhorn_log_warmstart(reg_m):
+    # started from the scalings of the previous epoch, the solve reaches the same plan in fewer iterations
+    n = 200
+    M_prev = random_problem(n, 6, seed=5)
+    M = M_prev + 0.01 * random_problem(n, 6, seed=6)
+    a, b = torch.full((1, n), 1. / n, dtype=torch.float64), torch.full((1, 6), 1. / 6, dtype=torch.float64)
+    _, log_prev = sinkhorn_log(a, b, M_prev[None], reg=0.1, reg_m=reg_m, stopThr=1e-12)
+    cold, log_cold = sinkhorn_log(a, b, M[None], reg=0.1, reg_m=reg_m, stopThr=1e-12)
+    warm, log_warm = sinkhorn_log(a, b, M[None], reg=0.1, reg_m=reg_m, stopThr=1e-12, warmstart=(log_prev['logu'], log_prev['logv']))
+    torch.testing.assert_close(warm, cold, rtol=0, atol=1e-12)
+    assert log_warm['niter'][0] < log_cold['niter'][0]
+
+    # NaN entries (instances not seen before) start cold
+    logu = log_prev['logu'].clone()
+    logu[:, ::3] = float('nan')
+    partial, _ = sinkhorn_log(a, b, M[None], reg=0.1, reg_m=reg_m, stopThr=1e-12, warmstart=(logu, log_prev['logv']))
+    torch.testing.assert_close(partial, cold, rtol=0, atol=1e-12)
+
+
+def test_sinkhorn_cache():
+    cache = SinkhornCache(max_size=2)
+    assert cache.warmstart([('a', 1)], [[0, 1, 2]]) == (None, [False])
+    log = {'niter': torch.tensor([30, 20]), 'logu': torch.tensor([[0., 1., 2.], [5., 6., float('-inf')]]), 'logv': torch.tensor([[7., 8.], [9., 10.]])}
+    # problem 0 holds instances 3, 0, 4 of a bag of 5, problem 1 instances 1, 0 of a bag of 2
+    cache.update([('a', 1), ('b', 1)], [[3, 0, 4], [1, 0]], [5, 2], log, [False, False])
+
+    # the scalings follow the instances into the micro-batches of the next epoch
+    (logu, logv), hits = cache.warmstart([('a', 1), ('c', 1), ('b', 1)], [[0, 1, 3], [0], [0, 1]])
+    assert hits == [True, False, True]
+    torch.testing.assert_close(logu[0], torch.tensor([1., float('nan'), 0.]), equal_nan=True)
+    assert torch.isnan(logu[1]).all() and torch.isnan(logv[1]).all()
+    torch.testing.assert_close(logu[2], torch.tensor([6., 5., float('nan')]), equal_nan=True)
+    torch.testing.assert_close(logv[2], torch.tensor([9., 10.]))
+
+    # warm solves are counted apart, and the least recently used entry is dropped beyond max_size
+    cache.update([('c', 1)], [[0]], [1], {'niter': torch.tensor([10]), 'logu': torch.zeros(1, 1), 'logv': torch.zeros(1, 2)}, [False])
+    cache.update([('b', 1)], [[0, 1]], [2], {'niter': torch.tensor([5]), 'logu': torch.zeros(1, 2), 'logv': torch.zeros(1, 2)}, [True])
+    assert list(cache.entries) == [('c', 1), ('b', 1)]
+    assert cache.saving() == 1 - 5 / 20
@@ -4,27 +4,102 @@ import pickle
 import os
 import h5py
 import pandas as pd
-from sklearn.cluster import KMeans
-
-
-args = argparse.ArgumentParser()
-args.add_argument("data_name")
-args.add_argument("--dataset_dir", type=str, default="./datasets_csv/")
-args.add_argument("--patch_dir", type=str, default=None)
-args.add_argument("--n_clusters", type=int, default=10)
-args.add_argument("--seed", type=int, default=42)
-
-args = args.parse_args()
-
-df = pd.read_csv(os.path.join(args.dataset_dir, args.data_name+"_selected.csv"))
-cancer_type = args.data_name.rsplit("_", 1)[0].upper()
-patch_dir = f"/media/nfs/SURV/{cancer_type}/SP1024/patches/" if not args.patch_dir else args.patch_dir
-cluster_ids = {}
-for slide in df["slide_id"].values:
-	with h5py.File(os.path.join(patch_dir, slide+".h5"), 'r') as f:
-		coords = np.array(f['coords'])
-	kmeans = KMeans(n_clusters=args.n_clusters, random_state=args.seed).fit(coords)
-	cluster_ids[slide] = kmeans.labels_
-
-with open(os.path.join(args.dataset_dir, args.data_name+"_cluster_ids.pkl"), "wb") as f:
-    pickle.dump(cluster_ids, f)
\ No newline at end of file
+import torch
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from threadpoolctl import threadpool_limits
+
+
+def setup_argparse():
+	args = argparse.ArgumentParser()
+	args.add_argument("data_name")
+	args.add_argument("--dataset_dir", type=str, default="./datasets_csv/")
+	args.add_argument("--patch_dir", type=str, default=None)
+	args.add_argument("--feats_dir", type=str, default=None, help='Directory of the patch features (required with --use_feats)')
+	args.add_argument("--use_feats", action='store_true', default=False, help='Cluster patch features instead of coordinates')
+	args.add_argument("--n_clusters", type=int, default=10)
+	args.add_argument("--seed", type=int, default=42)
+	args.add_argument("--algorithm", type=str, choices=['kmeans', 'minibatch'], default='kmeans', help='Full KMeans or MiniBatchKMeans (Default: kmeans)')
+	args.add_argument("--max_samples", type=int, default=None, help='Fit KMeans on at most this many sampled patches, then assign all patches (Default: None, fit on all)')
+	args.add_argument("--batch_size", type=int, default=4096, help='Batch size of MiniBatchKMeans (Default: 4096)')
+	args.add_argument("--num_workers", type=int, default=os.cpu_count(), help='Number of worker processes (Default: all cores)')
+	args.add_argument("--threads_per_worker", type=int, default=1, help='BLAS/OpenMP threads used by each worker (Default: 1)')
+	args.add_argument("--overwrite", action='store_true', default=False, help='Recompute all slides instead of resuming from the existing store')
+	return args.parse_args()
+
+
+def load_points(slide, args):
+	if args.use_feats:
+		points = torch.load(os.path.join(args.feats_dir, slide+".pt"), weights_only=True).numpy()
+	else:
+		with h5py.File(os.path.join(args.patch_dir, slide+".h5"), 'r') as f:
+			points = np.array(f['coords'])
+	return points
+
+
+def cluster_slide(slide, args):
+	r"""
+	Clusters the patches of a single slide.
+
+	Args:
+		slide (str): Slide ID
+		args (Namespace): Clustering options
+
+	Returns:
+		(slide, labels): Slide ID and the cluster id of each patch
+	"""
+	points = load_points(slide, args)
+	n_clusters = min(args.n_clusters, len(points))
+	with threadpool_limits(limits=args.threads_per_worker):
+		if args.algorithm == 'minibatch':
+			kmeans = MiniBatchKMeans(n_clusters=n_clusters, batch_size=args.batch_size, random_state=args.seed, n_init=3)
+		else:
+			kmeans = KMeans(n_clusters=n_clusters, random_state=args.seed)
+
+		if args.max_samples and len(points) > args.max_samples:
+			rng = np.random.default_rng(args.seed)
+			sample = rng.choice(len(points), args.max_samples, replace=False)
+			labels = kmeans.fit(points[sample]).predict(points)
+		else:
+			labels = kmeans.fit(points).labels_
+	return slide, labels.astype(np.int32)
+
+
+def run(args):
+	df = pd.read_csv(os.path.join(args.dataset_dir, args.data_name+"_selected.csv"))
+	cancer_type = args.data_name.rsplit("_", 1)[0].upper()
+	args.patch_dir = f"/media/nfs/SURV/{cancer_type}/SP1024/patches/" if not args.patch_dir else args.patch_dir
+	assert not args.use_feats or args.feats_dir, "--feats_dir is required with --use_feats"
+
+	# Cluster ids are written slide by slide into the store, so that an interrupted run resumes where it stopped.
+	store_path = os.path.join(args.dataset_dir, args.data_name+"_cluster_ids.h5")
+	slides = list(dict.fromkeys(df["slide_id"].values))
+	if args.overwrite and os.path.isfile(store_path):
+		os.remove(store_path)
+	with h5py.File(store_path, 'a') as store:
+		todo = [slide for slide in slides if slide not in store]
+		print("Clustering {} slides ({} already done)".format(len(todo), len(slides) - len(todo)))
+
+		if args.num_workers > 1:
+			with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+				futures = [executor.submit(cluster_slide, slide, args) for slide in todo]
+				for i, future in enumerate(as_completed(futures)):
+					slide, labels = future.result()
+					store.create_dataset(slide, data=labels)
+					store.flush()
+					if (i + 1) % 100 == 0:
+						print("\tProcessed:", i + 1, "/", len(todo))
+		else:
+			for slide in todo:
+				slide, labels = cluster_slide(slide, args)
+				store.create_dataset(slide, data=labels)
+				store.flush()
+
+		cluster_ids = {slide: np.array(store[slide]) for slide in slides}
+
+	with open(os.path.join(args.dataset_dir, args.data_name+"_cluster_ids.pkl"), "wb") as f:
+		pickle.dump(cluster_ids, f)
+
+
+if __name__ == "__main__":
+	run(setup_argparse())
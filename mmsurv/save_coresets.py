@@ -0,0 +1,183 @@
+import argparse
+import json
+import numpy as np
+import pickle
+import os
+import h5py
+import pandas as pd
+import torch
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+def setup_argparse():
+	args = argparse.ArgumentParser()
+	args.add_argument("data_name")
+	args.add_argument("--dataset_dir", type=str, default="./datasets_csv/")
+	args.add_argument("--feats_dir", type=str, required=True)
+	args.add_argument("--patch_dir", type=str, default=None, help='Directory of the patch coordinates (required with --space coords)')
+	args.add_argument("--out_dir", type=str, default=None, help='Coreset store (Default: <feats_dir>_coreset)')
+	args.add_argument("--policy", type=str, choices=['kcenter', 'cluster', 'density'], default='kcenter', help='Patch selection policy (Default: kcenter)')
+	args.add_argument("--space", type=str, choices=['feats', 'coords'], default='feats', help='Space in which kcenter and density compare patches (Default: feats)')
+	args.add_argument("--ratio", type=float, default=0.1, help='Fraction of patches to keep (Default: 0.1)')
+	args.add_argument("--max_patches", type=int, default=None, help='Upper bound on the coreset size of a slide')
+	args.add_argument("--proj_dim", type=int, default=64, help='Random projection of the features before kcenter/density, 0 to disable (Default: 64)')
+	args.add_argument("--n_anchors", type=int, default=2048, help='Number of anchors of the density estimate (Default: 2048)')
+	args.add_argument("--seed", type=int, default=42)
+	args.add_argument("--num_workers", type=int, default=os.cpu_count())
+	args.add_argument("--overwrite", action='store_true', default=False)
+	args.add_argument("--full_results_dir", type=str, default=None, help='Results directory of a run on --feats_dir, compared with --coreset_results_dir')
+	args.add_argument("--coreset_results_dir", type=str, default=None, help='Results directory of the same run on the coreset store')
+	return args.parse_args()
+
+
+def kcenter_greedy(points, k, generator):
+	r"""
+	Greedy k-center selection. Each patch is represented by its closest center.
+
+	Returns:
+		(indices, weights): Selected patches and the number of patches each one represents
+	"""
+	n = points.shape[0]
+	centers = [int(torch.randint(n, (1,), generator=generator))]
+	min_dist = ((points - points[centers[0]])**2).sum(1)
+	assign = torch.zeros(n, dtype=torch.long)
+	for j in range(1, k):
+		idx = int(torch.argmax(min_dist))
+		centers.append(idx)
+		dist = ((points - points[idx])**2).sum(1)
+		assign[dist < min_dist] = j
+		min_dist = torch.minimum(min_dist, dist)
+	weights = torch.bincount(assign, minlength=k)
+	return torch.LongTensor(centers), weights
+
+
+def cluster_quota(cluster_ids, k, generator):
+	r"""
+	Samples from every cluster a quota proportional to its size. Kept patches represent their cluster equally.
+	"""
+	n = cluster_ids.shape[0]
+	indices, weights = [], []
+	for c in torch.unique(cluster_ids):
+		members = torch.nonzero(cluster_ids == c).squeeze(1)
+		quota = max(1, int(round(k * len(members) / n)))
+		indices.append(members[torch.randperm(len(members), generator=generator)[:quota]])
+		weights.append(torch.full((quota,), len(members) / quota))
+	return torch.cat(indices), torch.cat(weights)
+
+
+def density_sampling(points, k, generator, n_anchors=2048):
+	r"""
+	Samples patches with probability inversely proportional to the local density, so that rare
+	tissue is kept while redundant regions are thinned out. Weights are the inverse inclusion probabilities.
+	"""
+	n = points.shape[0]
+	anchors = points[torch.randperm(n, generator=generator)[:n_anchors]]
+	knn = min(10, anchors.shape[0])
+	radius = torch.cdist(points, anchors).topk(knn, dim=1, largest=False)[0][:, -1]
+	probs = radius / radius.sum()
+	indices = torch.multinomial(probs, k, replacement=False, generator=generator)
+	weights = 1. / (k * probs[indices])
+	return indices, weights * n / weights.sum()
+
+
+def select_coreset(slide, args, cluster_ids=None):
+	features = torch.load(os.path.join(args.feats_dir, slide+".pt"), weights_only=True)
+	n = features.shape[0]
+	k = max(1, int(np.ceil(args.ratio * n)))
+	if args.max_patches:
+		k = min(k, args.max_patches)
+	generator = torch.Generator().manual_seed(args.seed)
+
+	if k >= n:
+		indices, weights = torch.arange(n), torch.ones(n)
+	elif args.policy == 'cluster':
+		indices, weights = cluster_quota(torch.as_tensor(cluster_ids), k, generator)
+	else:
+		if args.space == 'coords':
+			with h5py.File(os.path.join(args.patch_dir, slide+".h5"), 'r') as f:
+				points = torch.from_numpy(np.array(f['coords'])).float()
+		else:
+			points = features.float()
+			if args.proj_dim and args.proj_dim < points.shape[1]:
+				proj = torch.randn(points.shape[1], args.proj_dim, generator=generator) / np.sqrt(args.proj_dim)
+				points = points @ proj
+		if args.policy == 'kcenter':
+			indices, weights = kcenter_greedy(points, k, generator)
+		else:
+			indices, weights = density_sampling(points, k, generator, args.n_anchors)
+
+	order = torch.argsort(indices)
+	indices, weights = indices[order], weights[order].float()
+	torch.save(features[indices].clone(), os.path.join(args.out_dir, slide+".pt"))
+	return slide, indices.numpy(), weights.numpy(), n
+
+
+def run(args):
+	df = pd.read_csv(os.path.join(args.dataset_dir, args.data_name+"_selected.csv"))
+	args.out_dir = args.feats_dir.rstrip("/")+"_coreset" if not args.out_dir else args.out_dir
+	assert args.space != 'coords' or args.patch_dir, "--patch_dir is required with --space coords"
+	os.makedirs(args.out_dir, exist_ok=True)
+
+	cluster_ids = {}
+	if args.policy == 'cluster':
+		with open(os.path.join(args.dataset_dir, args.data_name+"_cluster_ids.pkl"), 'rb') as f:
+			cluster_ids = pickle.load(f)
+
+	# Like the cluster ids, the selection is stored slide by slide so that an interrupted run can resume.
+	store_path = os.path.join(args.out_dir, "coreset.h5")
+	if args.overwrite and os.path.isfile(store_path):
+		os.remove(store_path)
+	slides = list(dict.fromkeys(df["slide_id"].values))
+	with h5py.File(store_path, 'a') as store:
+		todo = [slide for slide in slides if slide not in store]
+		print("Selecting coresets of {} slides ({} already done)".format(len(todo), len(slides) - len(todo)))
+
+		with ProcessPoolExecutor(max_workers=max(1, args.num_workers), initializer=torch.set_num_threads, initargs=(1,)) as executor:
+			futures = [executor.submit(select_coreset, slide, args, cluster_ids.get(slide)) for slide in todo]
+			for i, future in enumerate(as_completed(futures)):
+				slide, indices, weights, n = future.result()
+				group = store.create_group(slide)
+				group.create_dataset('indices', data=indices)
+				group.create_dataset('weights', data=weights)
+				group.attrs['bag_size'] = n
+				store.flush()
+				if (i + 1) % 100 == 0:
+					print("\tProcessed:", i + 1, "/", len(todo))
+
+		coreset = {slide: {'indices': np.array(store[slide]['indices']), 'weights': np.array(store[slide]['weights'])} for slide in slides}
+		total = sum(store[slide].attrs['bag_size'] for slide in slides)
+
+	kept = sum(len(v['indices']) for v in coreset.values())
+	print("Kept {} / {} patches ({:.1f}x bag reduction)".format(kept, total, total / max(kept, 1)))
+	with open(os.path.join(args.out_dir, "coreset.pkl"), "wb") as f:
+		pickle.dump(coreset, f)
+	return kept, total
+
+
+def compare(args, kept, total):
+	r"""
+	Val and test c-index of the run on the coreset against the run on the whole bags, fold by fold, next to the bag reduction
+	"""
+	with open(os.path.join(args.coreset_results_dir, "experiment.json")) as f:
+		coreset_feats_dir = json.load(f)['feats_dir']
+	assert os.path.normpath(coreset_feats_dir) == os.path.normpath(args.out_dir), "The run of --coreset_results_dir is not on {}".format(args.out_dir)
+	full = pd.read_csv(os.path.join(args.full_results_dir, "summary_latest.csv"))
+	reduced = pd.read_csv(os.path.join(args.coreset_results_dir, "summary_latest.csv"))
+	assert len(full) == len(reduced), "The two runs have different folds"
+
+	results = pd.DataFrame({'fold': np.arange(len(full)), 'kept_patches': kept, 'total_patches': total, 'bag_reduction': total / max(kept, 1)})
+	for split in ['val', 'test']:
+		results['full_{}_cindex'.format(split)] = full['{}_cindex'.format(split)]
+		results['coreset_{}_cindex'.format(split)] = reduced['{}_cindex'.format(split)]
+		results['{}_cindex_delta'.format(split)] = results['coreset_{}_cindex'.format(split)] - results['full_{}_cindex'.format(split)]
+	results = pd.concat([results, results.drop(columns='fold').mean().to_frame().T.assign(fold='mean')], ignore_index=True)
+	print(results.to_string(index=False))
+	results.to_csv(os.path.join(args.coreset_results_dir, "coreset_comparison.csv"), index=False)
+
+
+if __name__ == "__main__":
+	args = setup_argparse()
+	assert bool(args.full_results_dir) == bool(args.coreset_results_dir), "--full_results_dir and --coreset_results_dir go together"
+	kept, total = run(args)
+	if args.coreset_results_dir:
+		compare(args, kept, total)
@@ -0,0 +1,115 @@
+import argparse
+import numpy as np
+import os
+import h5py
+import pandas as pd
+import torch
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+def setup_argparse():
+	args = argparse.ArgumentParser()
+	args.add_argument("data_name")
+	args.add_argument("--dataset_dir", type=str, default="./datasets_csv/")
+	args.add_argument("--feats_dir", type=str, required=True)
+	args.add_argument("--patch_dir", type=str, required=True, help='Directory of the CLAM patch coordinates')
+	args.add_argument("--out_dir", type=str, default=None, help='Region feature store (Default: <feats_dir>_regions<region_size>)')
+	args.add_argument("--region_size", type=int, default=4, help='Side of a region in patches (Default: 4, i.e. 4x4 patch windows)')
+	args.add_argument("--patch_size", type=float, default=None, help='Patch step in coordinate units (Default: inferred from the coordinates)')
+	args.add_argument("--pool", type=str, choices=['mean', 'max', 'weighted'], default='mean', help='Pooling within a region (Default: mean)')
+	args.add_argument("--temperature", type=float, default=0.1, help='Temperature of the weighted pooling (Default: 0.1)')
+	args.add_argument("--min_patches", type=int, default=0, help='Keep slides with at most this many patches at patch level (Default: 0, pool all)')
+	args.add_argument("--num_workers", type=int, default=os.cpu_count())
+	args.add_argument("--overwrite", action='store_true', default=False)
+	return args.parse_args()
+
+
+def infer_patch_size(coords):
+	r"""
+	Smallest step between neighbouring patch coordinates.
+	"""
+	steps = [np.diff(np.unique(coords[:, i])) for i in range(2)]
+	steps = np.concatenate([s[s > 0] for s in steps])
+	return steps.min() if len(steps) > 0 else 1.
+
+
+def region_pool(features, coords, region_size, patch_size, pool='mean', temperature=0.1):
+	r"""
+	Bins patches into square regions of region_size x region_size patches and pools their features.
+
+	Args:
+		features (torch.Tensor): N x D patch features
+		coords (np.ndarray): N x 2 patch coordinates
+		region_size (int): Side of a region in patches
+		patch_size (float): Patch step in coordinate units
+		pool (str): mean, max, or weighted (softmax of the cosine similarity to the region mean)
+
+	Returns:
+		(region_features, region_coords, counts)
+	"""
+	cells = np.floor(coords / (patch_size * region_size)).astype(np.int64)
+	cells, inverse = np.unique(cells, axis=0, return_inverse=True)
+	inverse = torch.from_numpy(inverse.reshape(-1))
+	n_regions, dim = cells.shape[0], features.shape[1]
+	features = features.float()
+
+	counts = torch.bincount(inverse, minlength=n_regions)
+	mean = torch.zeros(n_regions, dim).index_add_(0, inverse, features) / counts.unsqueeze(1)
+	if pool == 'mean':
+		pooled = mean
+	elif pool == 'max':
+		pooled = torch.full((n_regions, dim), -float('inf')).scatter_reduce_(0, inverse.unsqueeze(1).expand(-1, dim), features, reduce='amax')
+	elif pool == 'weighted':
+		sim = torch.nn.functional.cosine_similarity(features, mean[inverse], dim=1) / temperature
+		sim = torch.exp(sim - sim.max())
+		norm = torch.zeros(n_regions).index_add_(0, inverse, sim)
+		pooled = torch.zeros(n_regions, dim).index_add_(0, inverse, features * (sim / norm[inverse]).unsqueeze(1))
+	else:
+		raise NotImplementedError
+	return pooled, cells * patch_size * region_size, counts
+
+
+def save_regions(slide, args):
+	features = torch.load(os.path.join(args.feats_dir, slide+".pt"), weights_only=True)
+	with h5py.File(os.path.join(args.patch_dir, slide+".h5"), 'r') as f:
+		coords = np.array(f['coords'])
+	assert len(coords) == len(features), "Coordinates and features of {} are not aligned".format(slide)
+
+	if len(features) <= args.min_patches:
+		pooled, region_coords, counts = features, coords, torch.ones(len(features), dtype=torch.long)
+	else:
+		patch_size = args.patch_size if args.patch_size else infer_patch_size(coords)
+		pooled, region_coords, counts = region_pool(features, coords, args.region_size, patch_size, args.pool, args.temperature)
+
+	torch.save(pooled.to(features.dtype), os.path.join(args.out_dir, slide+".pt"))
+	with h5py.File(os.path.join(args.out_dir, slide+".h5"), 'w') as f:
+		f.create_dataset('coords', data=region_coords)
+		f.create_dataset('counts', data=counts.numpy())
+	return slide, len(features), len(pooled)
+
+
+def run(args):
+	df = pd.read_csv(os.path.join(args.dataset_dir, args.data_name+"_selected.csv"))
+	args.out_dir = args.feats_dir.rstrip("/")+"_regions{}".format(args.region_size) if not args.out_dir else args.out_dir
+	os.makedirs(args.out_dir, exist_ok=True)
+
+	slides = list(dict.fromkeys(df["slide_id"].values))
+	done = lambda slide: os.path.isfile(os.path.join(args.out_dir, slide+".pt")) and os.path.isfile(os.path.join(args.out_dir, slide+".h5"))
+	todo = slides if args.overwrite else [slide for slide in slides if not done(slide)]
+	print("Pooling {} slides into regions ({} already done)".format(len(todo), len(slides) - len(todo)))
+
+	n_patches, n_regions = 0, 0
+	with ProcessPoolExecutor(max_workers=max(1, args.num_workers), initializer=torch.set_num_threads, initargs=(1,)) as executor:
+		futures = [executor.submit(save_regions, slide, args) for slide in todo]
+		for i, future in enumerate(as_completed(futures)):
+			_, n, r = future.result()
+			n_patches += n
+			n_regions += r
+			if (i + 1) % 100 == 0:
+				print("\tProcessed:", i + 1, "/", len(todo))
+	if n_regions > 0:
+		print("{} patches pooled into {} regions ({:.1f}x shorter bags)".format(n_patches, n_regions, n_patches / n_regions))
+
+
+if __name__ == "__main__":
+	run(setup_argparse())
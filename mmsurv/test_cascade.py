@@ -0,0 +1,31 @@
+import numpy as np
+import torch
+
+from mmsurv.cascade import screen, split_rows
+from mmsurv.models.model_set_mil import MIL_Attention_FC_surv
+
+
+class ChunkedBag:
+	# iter_path_chunks of a dataset holding a single bag
+	def __init__(self, x):
+		self.x = x
+
+	def iter_path_chunks(self, idx, chunk_size, device=None):
+		for start in range(0, len(self.x), chunk_size):
+			yield self.x[start:start + chunk_size].to(device), None
+
+
+def test_screen_matches_topk():
+	# the patches kept chunk by chunk are the top_k of the whole bag, in row order
+	torch.manual_seed(0)
+	model = MIL_Attention_FC_surv(64).eval()
+	x = torch.randn(1000, 64)
+	with torch.no_grad():
+		rows = screen(model, ChunkedBag(x), 0, top_k=100, chunk_size=64)
+		expected = np.sort(model.attention_net(x)[0].squeeze(1).topk(100)[1].numpy())
+	assert np.array_equal(rows, expected)
+
+
+def test_split_rows():
+	splits = split_rows(np.array([0, 5, 9, 10, 14, 30]), [10, 5, 20])
+	assert [s.tolist() for s in splits] == [[0, 5, 9], [0, 4], [15]]
@@ -1,17 +1,22 @@
 from argparse import Namespace
 import os
+import collections
+from timeit import default_timer as timer
 import numpy as np
-import random
 from sksurv.metrics import concordance_index_censored
 import torch
+import torch.nn.functional as F
 
 from mmsurv.datasets.dataset_generic import save_splits
+from mmsurv.datasets.dataset_survival import AttentionPatchSampler
 from mmsurv.models.model_genomic import SNN
 from mmsurv.models.model_set_mil import MIL_Sum_FC_surv, MIL_Attention_FC_surv, MIL_Cluster_FC_surv
 from mmsurv.models.model_coattn import MCAT_Surv
 from mmsurv.models.model_motcat import MOTCAT_Surv
+from mmsurv.models.ot_util import SinkhornCache
 from mmsurv.models.model_porpoise import PorpoiseMMF
 from mmsurv.models.model_cmta import CMTA
+from mmsurv.models.model_utils import checkpoint_activations
 from mmsurv.utils.utils import *
 
 device=torch.device("cuda" if torch.cuda.is_available() else "cpu") 
@@ -64,9 +69,9 @@ class EarlyStopping:
 		self.val_loss_min = val_loss
 
 
-def train(datasets: tuple, cur: int, args: Namespace):
+def train(datasets: tuple, cur: int, args: Namespace, teacher_outputs: dict = None):
 	"""   
-		train for a single fold
+		train for a single fold, distilled from the cached outputs of a teacher if given (see main.get_teacher_outputs)
 	"""
 	print('\nTraining Fold {}!'.format(cur))
 	writer_dir = os.path.join(args.results_dir, str(cur))
@@ -91,16 +96,7 @@ def train(datasets: tuple, cur: int, args: Namespace):
 	print("Testing on {} samples".format(len(test_split)))
 
 	print('\nInit loss function...', end=' ')
-	if args.model_type == 'cmta':
-		loss_fn = [NLLSurvLoss(alpha=args.alpha_surv), nn.L1Loss()]
-	elif args.bag_loss == 'ce_surv':
-		loss_fn = CrossEntropySurvLoss(alpha=args.alpha_surv)
-	elif args.bag_loss == 'nll_surv':
-		loss_fn = NLLSurvLoss(alpha=args.alpha_surv)
-	elif args.bag_loss == 'cox_surv':
-		loss_fn = CoxSurvLoss()
-	else:
-		raise NotImplementedError
+	loss_fn = init_loss(args)
 
 	if args.reg_type == 'omic':
 		reg_fn = l1_reg_all
@@ -115,42 +111,18 @@ def train(datasets: tuple, cur: int, args: Namespace):
 	args.fusion = None if args.fusion == 'None' else args.fusion
 	args.omic_sizes = train_split.omic_sizes
 
-	if args.model_type == 'deepset':
-		model_dict = {"path_input_dim": args.path_input_dim, 'omic_input_dim': args.omic_sizes, 'fusion': args.fusion, 'n_classes': args.n_classes}
-		model = MIL_Sum_FC_surv(**model_dict)
-	elif args.model_type =='amil':
-		model_dict = {'path_input_dim': args.path_input_dim, 'omic_input_dim': args.omic_sizes, 'fusion': args.fusion, 'n_classes': args.n_classes}
-		model = MIL_Attention_FC_surv(**model_dict)
-	elif args.model_type == 'mcat':
-		model_dict = {"path_input_dim": args.path_input_dim, 'fusion': args.fusion, 'omic_sizes': args.omic_sizes, 'n_classes': args.n_classes}
-		model = MCAT_Surv(**model_dict)
-	elif args.model_type == 'motcat':
-		model_dict = {'path_input_dim': args.path_input_dim, 'ot_reg': args.ot_reg, 'ot_tau': args.ot_tau, 'ot_impl': args.ot_impl,'fusion': args.fusion, 'omic_sizes': args.omic_sizes, 'n_classes': args.n_classes}
-		model = MOTCAT_Surv(**model_dict)
-	elif args.model_type == 'porpoise':
-		model_dict = {'path_input_dim': args.path_input_dim, 'omic_input_dim': args.omic_sizes, 'fusion': args.fusion, 'n_classes': args.n_classes, 
-		'gate_path': args.gate_path, 'gate_omic': args.gate_omic, 'scale_dim1': args.scale_dim1, 'scale_dim2': args.scale_dim2, 
-		'skip': args.skip, 'dropinput': args.dropinput, 'path_input_dim': args.path_input_dim, 'use_mlp': args.use_mlp,
-		}
-		model = PorpoiseMMF(**model_dict)
-	elif args.model_type == 'deepattnmisl':
-		model_dict = {'path_input_dim': args.path_input_dim, 'omic_input_dim': args.omic_sizes, 'fusion': args.fusion, 'num_clusters': 10, 'n_classes': args.n_classes}
-		model = MIL_Cluster_FC_surv(**model_dict)
-	elif args.model_type == 'cmta':
-		model_dict = {
-			'path_input_dim': args.path_input_dim, 
-			'omic_input_dim': args.omic_sizes, 
-			'fusion': args.fusion, 
-			'n_classes': args.n_classes
-		}
-		model = CMTA(**model_dict)
-	else:
-		raise NotImplementedError
-	
+	model = init_model(args)
 	if hasattr(model, "relocate"):
-		model.relocate()
+		model = model.relocate(device)
 	else:
-		model = model.to(torch.device('cuda'))
+		model = model.to(device)
+	if args.compile:
+		# motcat and cmta take their shapes from the true bag lengths (micro-batches, PPEG grid), they are compiled with dynamic shapes
+		model.compile(dynamic=args.model_type in ['motcat', 'cmta'])
+		loss_fn = [torch.compile(fn) for fn in loss_fn] if isinstance(loss_fn, list) else torch.compile(loss_fn)
+	# the bags of the other models are padded to a few bucket lengths, so that their compiled graphs are reused
+	buckets = sorted(int(b) for b in args.compile_buckets.split(',')) if args.compile_buckets else []
+	buckets = buckets if args.compile and args.model_type in ['deepset', 'amil', 'porpoise', 'mcat'] else None
 	print('Done!')
 	if cur == 0:
 		print_network(model)
@@ -162,9 +134,14 @@ def train(datasets: tuple, cur: int, args: Namespace):
 	scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode="min", factor=0.5, patience=3, min_lr=1e-7)
 	
 	print('\nInit Loaders...', end=' ')
-	train_loader = get_split_loader(train_split, training=True, weighted = args.weighted_sample, mode=args.mode, batch_size=args.batch_size)
-	val_loader = get_split_loader(val_split, mode=args.mode, batch_size=args.batch_size)
-	test_loader = get_split_loader(test_split, mode=args.mode, batch_size=args.batch_size)
+	assert args.batch_size == 1 or args.model_type != "deepattnmisl", "Batches of several patients are not supported by deepattnmisl"
+	assert not args.stream_chunk_size or args.model_type in ['deepset', 'amil', 'porpoise'], "Streamed inference is only supported by deepset, amil and porpoise"
+	if args.stream_chunk_size:
+		# the evaluation bags are read by the model chunk by chunk instead of by the loader
+		val_split.stream_path, test_split.stream_path = True, True
+	train_loader = get_split_loader(train_split, training=True, weighted = args.weighted_sample, mode=args.mode, batch_size=args.batch_size, max_padding=args.max_padding, num_workers=args.num_workers, worker_cores=args.worker_cores)
+	val_loader = get_split_loader(val_split, mode=args.mode, batch_size=args.batch_size, max_padding=args.max_padding, num_workers=args.num_workers, worker_cores=args.worker_cores)
+	test_loader = get_split_loader(test_split, mode=args.mode, batch_size=args.batch_size, max_padding=args.max_padding, num_workers=args.num_workers, worker_cores=args.worker_cores)
 	print('Done!')
 
 	print('\nSetup EarlyStopping...', end=' ')
@@ -174,9 +151,20 @@ def train(datasets: tuple, cur: int, args: Namespace):
 		early_stopping = None
 	print('Done!\n\n')
 
+	assert not args.ot_cache_size or args.ot_impl.startswith('torch'), "The Sinkhorn warm start needs a torch OT solver (--ot_impl torch-uot-l2 or torch-sinkhorn-l2)"
+	ot_cache = SinkhornCache(max_size=args.ot_cache_size) if args.model_type == 'motcat' and args.ot_cache_size > 0 else None
+	assert not args.patch_budget or args.model_type in ['amil', 'porpoise'], "Attention-guided patch sampling is only supported by amil and porpoise"
+	patch_sampler = AttentionPatchSampler(args.patch_budget, explore=args.patch_explore, seed=args.seed) if args.patch_budget else None
+	assert teacher_outputs is None or args.model_type in ['deepset', 'amil', 'porpoise'], "The distilled student is deepset, amil or porpoise"
+	assert not args.distill_attention or (args.model_type in ['amil', 'porpoise'] and not args.topk_instances and not args.patch_budget), "Attention distillation needs amil or porpoise on whole bags"
+	distill = {'teacher_outputs': teacher_outputs, 'distill_weight': args.distill_weight, 'distill_attention': args.distill_attention} if teacher_outputs is not None else {}
+
 	for epoch in range(args.max_epochs):
-		loop_survival(cur, epoch, model, train_loader, loss_fn, reg_fn, args.lambda_reg, writer, optimizer, args.gc, model_type=args.model_type, bs_micro=args.bs_micro)
-		stop = loop_survival(cur, epoch, model, val_loader, loss_fn, reg_fn, args.lambda_reg, writer, scheduler=scheduler, model_type=args.model_type, training=False, results_dir=args.results_dir, early_stopping=early_stopping, bs_micro=args.bs_micro)
+		if patch_sampler is not None:
+			# the training bags of the epoch are sampled from the attention of the previous ones
+			patch_sampler.plan(train_split)
+		loop_survival(cur, epoch, model, train_loader, loss_fn, reg_fn, args.lambda_reg, writer, optimizer, args.gc, model_type=args.model_type, bs_micro=args.bs_micro, coreset_weights=args.coreset_weights, ot_cache=ot_cache, stream_chunk_size=args.stream_chunk_size, precision=args.precision, buckets=buckets, patch_sampler=patch_sampler, **distill)
+		stop = loop_survival(cur, epoch, model, val_loader, loss_fn, reg_fn, args.lambda_reg, writer, scheduler=scheduler, model_type=args.model_type, training=False, results_dir=args.results_dir, early_stopping=early_stopping, bs_micro=args.bs_micro, coreset_weights=args.coreset_weights, ot_cache=ot_cache, stream_chunk_size=args.stream_chunk_size, precision=args.precision, buckets=buckets)
 		if stop:
 			break
 	
@@ -184,8 +172,8 @@ def train(datasets: tuple, cur: int, args: Namespace):
 	if os.path.isfile(os.path.join(args.results_dir, "s_{}_minloss_checkpoint.pt".format(cur))):
 		model.load_state_dict(torch.load(os.path.join(args.results_dir, "s_{}_minloss_checkpoint.pt".format(cur)), weights_only=True))
 	
-	results_val_dict, val_cindex = loop_survival(cur, epoch, model, val_loader, loss_fn, reg_fn, args.lambda_reg, model_type=args.model_type, training=False, return_summary=True, bs_micro=args.bs_micro)
-	results_test_dict, test_cindex = loop_survival(cur, epoch, model, test_loader, loss_fn, reg_fn, args.lambda_reg, model_type=args.model_type, training=False, return_summary=True, bs_micro=args.bs_micro)
+	results_val_dict, val_cindex = loop_survival(cur, epoch, model, val_loader, loss_fn, reg_fn, args.lambda_reg, model_type=args.model_type, training=False, return_summary=True, bs_micro=args.bs_micro, coreset_weights=args.coreset_weights, ot_cache=ot_cache, stream_chunk_size=args.stream_chunk_size, precision=args.precision, buckets=buckets)
+	results_test_dict, test_cindex = loop_survival(cur, epoch, model, test_loader, loss_fn, reg_fn, args.lambda_reg, model_type=args.model_type, training=False, return_summary=True, bs_micro=args.bs_micro, coreset_weights=args.coreset_weights, ot_cache=ot_cache, stream_chunk_size=args.stream_chunk_size, precision=args.precision, buckets=buckets)
 
 	print('Val c-Index: {:.4f} | Test c-Index: {:.4f}'.format(val_cindex, test_cindex))
 	log = {'val_cindex': val_cindex, 'test_cindex': test_cindex}
@@ -195,12 +183,100 @@ def train(datasets: tuple, cur: int, args: Namespace):
 		writer.close()
 	return log, results_val_dict, results_test_dict
 
+def init_loss(args):
+	"""
+		survival loss of args.bag_loss, with the similarity loss of cmta
+	"""
+	if args.model_type == 'cmta':
+		return [NLLSurvLoss(alpha=args.alpha_surv), nn.L1Loss()]
+	elif args.bag_loss == 'ce_surv':
+		return CrossEntropySurvLoss(alpha=args.alpha_surv)
+	elif args.bag_loss == 'nll_surv':
+		return NLLSurvLoss(alpha=args.alpha_surv)
+	elif args.bag_loss == 'cox_surv':
+		return CoxSurvLoss()
+	raise NotImplementedError
+
+def teacher_outputs(args, model, split, attention=False):
+	"""
+		hazards of a trained model for each patient of the split, as in its evaluation, and with attention the attention
+		of its co-attention over the patches of the bag (mcat, motcat), averaged over the signatures
+	"""
+	loader = get_split_loader(split, mode=args.mode, num_workers=0)
+	results, _ = loop_survival(0, 0, model, loader, init_loss(args), model_type=args.model_type, training=False, return_summary=True, bs_micro=args.bs_micro, precision=args.precision)
+	slide_ids, case_ids = split.slide_data['slide_id'], split.slide_data['case_id']
+	outputs = {str(case_ids[idx]): {'hazards': torch.from_numpy(results[slide_ids.iloc[idx]]['hazards']).float()} for idx in range(len(split))}
+	if attention:
+		assert args.model_type in ['mcat', 'motcat'], "The attention of the teacher is the co-attention of mcat or motcat"
+		model.eval()
+		for data in loader:
+			data_WSI, *data_omic, label, event_time, c, mask = list(map(lambda x:x.to(device), data[:-1]))
+			with torch.no_grad(), get_autocast(args.precision):
+				A = model(x_path=data_WSI, mask=mask, return_attn=True, **{'x_omic%d' % (i+1): omic for i, omic in enumerate(data_omic)})[3]['coattn']
+			# the co-attention logits of mcat (B x heads x S x N) or the transport plan of motcat (B x 1 x S x N)
+			A = F.softmax(A.float(), dim=-1) if args.model_type == 'mcat' else A.float()
+			A = A.reshape(-1, A.shape[-1]).mean(dim=0)
+			outputs[str(case_ids[data[-1].item()])]['attention'] = (A / A.sum()).half().cpu()
+		# the patches of each slide, to check that the student's bags are the same
+		slide_lengths = split.get_slide_lengths()
+		for case_id in case_ids:
+			outputs[str(case_id)]['slide_lengths'] = torch.tensor([slide_lengths[slide_id.rstrip('.svs')] for slide_id in split.patient_dict[case_id]])
+	return outputs
+
+def init_model(args):
+	"""
+		builds the model of args.model_type, on the cpu, with its activation checkpointing (args.omic_sizes set from the split)
+	"""
+	if args.model_type == 'deepset':
+		model_dict = {"path_input_dim": args.path_input_dim, 'omic_input_dim': args.omic_sizes, 'fusion': args.fusion, 'n_classes': args.n_classes}
+		model = MIL_Sum_FC_surv(**model_dict)
+	elif args.model_type =='amil':
+		model_dict = {'path_input_dim': args.path_input_dim, 'omic_input_dim': args.omic_sizes, 'fusion': args.fusion, 'n_classes': args.n_classes, 'topk_instances': args.topk_instances, 'random_instances': args.random_instances}
+		model = MIL_Attention_FC_surv(**model_dict)
+	elif args.model_type == 'mcat':
+		model_dict = {"path_input_dim": args.path_input_dim, 'fusion': args.fusion, 'omic_sizes': args.omic_sizes, 'n_classes': args.n_classes, 'attn_chunk_size': args.attn_chunk_size or None}
+		model = MCAT_Surv(**model_dict)
+	elif args.model_type == 'motcat':
+		model_dict = {'path_input_dim': args.path_input_dim, 'ot_reg': args.ot_reg, 'ot_tau': args.ot_tau, 'ot_impl': args.ot_impl, 'ot_fp32': args.ot_fp32,'fusion': args.fusion, 'omic_sizes': args.omic_sizes, 'n_classes': args.n_classes}
+		model = MOTCAT_Surv(**model_dict)
+	elif args.model_type == 'porpoise':
+		model_dict = {'path_input_dim': args.path_input_dim, 'omic_input_dim': args.omic_sizes, 'fusion': args.fusion, 'n_classes': args.n_classes, 
+		'gate_path': args.gate_path, 'gate_omic': args.gate_omic, 'scale_dim1': args.scale_dim1, 'scale_dim2': args.scale_dim2, 
+		'skip': args.skip, 'dropinput': args.dropinput, 'path_input_dim': args.path_input_dim, 'use_mlp': args.use_mlp,
+		'topk_instances': args.topk_instances, 'random_instances': args.random_instances,
+		}
+		model = PorpoiseMMF(**model_dict)
+	elif args.model_type == 'deepattnmisl':
+		model_dict = {'path_input_dim': args.path_input_dim, 'omic_input_dim': args.omic_sizes, 'fusion': args.fusion, 'num_clusters': 10, 'n_classes': args.n_classes, 'topk_instances': args.topk_instances, 'random_instances': args.random_instances}
+		model = MIL_Cluster_FC_surv(**model_dict)
+	elif args.model_type == 'cmta':
+		model_dict = {
+			'path_input_dim': args.path_input_dim, 
+			'omic_input_dim': args.omic_sizes, 
+			'fusion': args.fusion, 
+			'n_classes': args.n_classes,
+			'attn_chunk_size': args.attn_chunk_size or None,
+			'merge_ratio': args.merge_ratio,
+			'landmark_budget': args.landmark_budget or None
+		}
+		model = CMTA(**model_dict)
+	else:
+		raise NotImplementedError
+	
+	if args.checkpoint_activations:
+		blocks = model.checkpoint_blocks if args.checkpoint_activations == 'default' else args.checkpoint_activations.split(',')
+		checkpoint_activations(model, blocks)
+		print('Checkpointed blocks:', ', '.join(blocks))
+	return model
+
 def loop_survival(
 		cur, epoch, model, loader, 
 		loss_fn=None, reg_fn=None, lambda_reg=0., writer=None, 
 		optimizer=None, gc=16, scheduler=None,
 		model_type="coattn", training=True, results_dir=None, 
-		early_stopping=None, return_summary=False, bs_micro=256
+		early_stopping=None, return_summary=False, bs_micro=256,
+		coreset_weights=False, ot_cache=None, stream_chunk_size=0, precision='fp32', buckets=None, patch_sampler=None,
+		teacher_outputs=None, distill_weight=0.5, distill_attention=0.
 	): 
 	model.train() if training else model.eval()
 	split_name = "Train" if training else "Validation"
@@ -209,56 +285,113 @@ def loop_survival(
 		patient_results = {}
 		slide_ids = loader.dataset.slide_data['slide_id']
 
-	all_risk_scores = np.zeros((len(loader)))
-	all_censorships = np.zeros((len(loader)))
-	all_event_times = np.zeros((len(loader)))
+	n_samples = len(loader.sampler)
+	all_risk_scores = np.zeros((n_samples))
+	all_censorships = np.zeros((n_samples))
+	all_event_times = np.zeros((n_samples))
+	seen, n_accum = 0, 0
+	if model_type == "motcat":
+		model.coattn.reset_stats()
+		if ot_cache is not None:
+			ot_cache.reset_stats()
+			case_ids = loader.dataset.slide_data['case_id']
+	# patches per second of the epoch, loading included
+	bag_lengths = np.asarray(loader.dataset.get_bag_lengths()) if loader.dataset.mode != 'omic' else None
+	patch_sampler = patch_sampler if training else None
+	teacher_outputs = teacher_outputs if training else None
+	if patch_sampler is not None:
+		bag_lengths = np.minimum(bag_lengths, patch_sampler.budget)
+	n_patches, start = 0, timer()
+	# step times of each bucket length, with --compile
+	bucket_times = collections.defaultdict(list)
 
 	for batch_idx, data in enumerate(loader):
-		
+		data, index = data[:-1], data[-1]
+		if bag_lengths is not None:
+			n_patches += int(bag_lengths[index.numpy()].sum())
+		# bucket length of the padded batch, None when the step runs on the true shapes
+		step_start, bucket = timer(), None
+
 		if model_type == "motcat":
-			data_WSI, data_omic1, data_omic2, data_omic3, data_omic4, data_omic5, data_omic6, label, event_time, c = list(map(lambda x:x.to(device), data))
+			data_WSI, *data_omic, label, event_time, c, mask = list(map(lambda x:x.to(device), data))
+			# every bag is split into its own micro-batches, all of them run as one padded batch, the omic branch once per patient
+			lengths = (~mask).sum(dim=1).tolist()
+			bag_ids, instances = split_micro_batches(lengths, bs_micro, shuffle=training, device=device)
+			wsi_mb = data_WSI[bag_ids.unsqueeze(1), instances.clamp(min=0)]
+			omic_mb = {'x_omic%d' % (i+1): omic for i, omic in enumerate(data_omic)}
+			if ot_cache is not None:
+				# warm start from the scalings of the patient's last solves with the same number of micro-batches
+				n_chunks = torch.bincount(bag_ids, minlength=len(lengths)).tolist()
+				keys = [(case_ids.iloc[index[b].item()], n_chunks[b]) for b in bag_ids.tolist()]
+				chunks = [chunk[chunk >= 0] for chunk in instances]
+				omic_mb['ot_warmstart'], hits = ot_cache.warmstart(keys, chunks)
+			with torch.set_grad_enabled(training), get_autocast(precision):
+				hazards, S, _, _  = model(x_path=wsi_mb, mask=instances < 0, bag_ids=bag_ids, **omic_mb)
+			if ot_cache is not None and model.coattn.last_log is not None:
+				ot_cache.update(keys, chunks, [lengths[b] for b in bag_ids.tolist()], model.coattn.last_log, hits)
+			
+			# the micro-batches of a patient are averaged
 			loss = 0.
-			all_risk = 0.
-			cnt = 0
-			index_chunk_list = split_chunk_list(data_WSI, bs_micro)
-			for tindex in index_chunk_list:
-				wsi_mb = torch.index_select(data_WSI, dim=0, index=torch.LongTensor(tindex).to(data_WSI.device)).cuda()
-				with torch.set_grad_enabled(training):
-					hazards, S, _, _  = model(x_path=wsi_mb, x_omic1=data_omic1, x_omic2=data_omic2, x_omic3=data_omic3, x_omic4=data_omic4, x_omic5=data_omic5, x_omic6=data_omic6)
-				
-				loss_micro = loss_fn(hazards=hazards, S=S, Y=label, c=c)
-				
-				loss += loss_micro
-				all_risk += -torch.sum(S, dim=1).detach().cpu().numpy().item()
-				cnt+=1
-			loss = loss / cnt
-			risk = all_risk / cnt
+			for b in range(len(lengths)):
+				chunk_b = bag_ids == b
+				loss += loss_fn(hazards=hazards[chunk_b], S=S[chunk_b], Y=label[b].expand(int(chunk_b.sum())), c=c[b].expand(int(chunk_b.sum())))
+			loss = loss / len(lengths)
+			cnt = torch.bincount(bag_ids, minlength=len(lengths)).unsqueeze(1)
+			hazards = torch.zeros(len(lengths), hazards.shape[1], device=device).index_add(0, bag_ids, hazards.detach()) / cnt
+			risk = -(torch.zeros(len(lengths), device=device).index_add(0, bag_ids, torch.sum(S.detach(), dim=1)) / cnt.squeeze(1)).cpu().numpy()
 		else:
 			if model_type == "mcat":
-				data_WSI, data_omic1, data_omic2, data_omic3, data_omic4, data_omic5, data_omic6, label, event_time, c = list(map(lambda x:x.to(device), data))
-				with torch.set_grad_enabled(training):
-					hazards, S, Y_hat, A  = model(x_path=data_WSI, x_omic1=data_omic1, x_omic2=data_omic2, x_omic3=data_omic3, x_omic4=data_omic4, x_omic5=data_omic5, x_omic6=data_omic6)
+				data_WSI, *data_omic, label, event_time, c, mask = list(map(lambda x:x.to(device), data))
+				if buckets is not None:
+					bucket = get_bucket(data_WSI.shape[1], buckets)
+					data_WSI = F.pad(data_WSI, (0, 0, 0, bucket - data_WSI.shape[1]))
+					mask = F.pad(mask, (0, bucket - mask.shape[1]), value=True)
+				with torch.set_grad_enabled(training), get_autocast(precision):
+					hazards, S, Y_hat, A  = model(x_path=data_WSI, mask=mask, **{'x_omic%d' % (i+1): omic for i, omic in enumerate(data_omic)})
 				loss = loss_fn(hazards=hazards, S=S, Y=label, c=c)
 			elif model_type == "deepattnmisl":
 				cluster_id = data[0]
 				data_WSI, data_omic, label, event_time, c = list(map(lambda x:x.to(device), data[1:]))
-				if data_WSI.shape[0] > 150000:
-					continue
-				hazards, S, Y_hat =  model(x_path=data_WSI, cluster_id=cluster_id, x_omic=data_omic)
+				with torch.set_grad_enabled(training), get_autocast(precision):
+					hazards, S, Y_hat =  model(x_path=data_WSI, cluster_id=cluster_id, x_omic=data_omic)
 				loss = loss_fn(hazards=hazards, S=S, Y=label, c=c)
 			elif model_type == "cmta":
-				data_WSI, data_omic1, data_omic2, data_omic3, data_omic4, data_omic5, data_omic6, label, event_time, c = list(map(lambda x:x.to(device), data))
-				with torch.set_grad_enabled(training):
-					hazards, S, P, P_hat, G, G_hat  = model(x_path=data_WSI, x_omic1=data_omic1, x_omic2=data_omic2, x_omic3=data_omic3, x_omic4=data_omic4, x_omic5=data_omic5, x_omic6=data_omic6)
+				data_WSI, *data_omic, label, event_time, c, mask = list(map(lambda x:x.to(device), data))
+				with torch.set_grad_enabled(training), get_autocast(precision):
+					hazards, S, P, P_hat, G, G_hat  = model(x_path=data_WSI, mask=mask, **{'x_omic%d' % (i+1): omic for i, omic in enumerate(data_omic)})
 				sur_loss = loss_fn[0](hazards=hazards, S=S, Y=label, c=c)
 				sim_loss_P = loss_fn[1](P.detach(), P_hat)
 				sim_loss_G = loss_fn[1](G.detach(), G_hat)
 				loss = sur_loss + sim_loss_P + sim_loss_G
 			else:
-				data_WSI, data_omic, label, event_time, c = list(map(lambda x:x.to(device), data))
-				with torch.set_grad_enabled(training):
-					hazards, S = model(x_path=data_WSI, x_omic=data_omic)
+				# several patients per batch are concatenated into a ragged bag, delimited by bag_offsets
+				data_WSI, data_omic, label, event_time, c, bag_offsets = list(map(lambda x:x.to(device), data))
+				if loader.dataset.stream_path:
+					# each bag is read from the store stream_chunk_size instances at a time
+					path_chunks = [loader.dataset.iter_path_chunks(i, stream_chunk_size, weights=coreset_weights, device=device) for i in index.tolist()]
+					with torch.no_grad(), get_autocast(precision):
+						hazards, S = model(x_path_chunks=path_chunks, x_omic=data_omic)
+				else:
+					# the sampled instances are weighted by the number of patches they stand for
+					path_weights = torch.cat([loader.dataset.get_path_weights(i, coreset=coreset_weights) for i in index.tolist()]).to(device) if coreset_weights or patch_sampler is not None else None
+					offsets = bag_offsets.tolist()
+					if buckets is not None:
+						# the padded instances get a weight of 0 and are added to the last bag
+						bucket = get_bucket(len(data_WSI), buckets)
+						path_weights = F.pad(torch.ones(len(data_WSI), device=device) if path_weights is None else path_weights, (0, bucket - len(data_WSI)))
+						data_WSI = F.pad(data_WSI, (0, 0, 0, bucket - len(data_WSI)))
+						bag_offsets = torch.cat([bag_offsets[:-1], bag_offsets.new_tensor([bucket])])
+					with torch.set_grad_enabled(training), get_autocast(precision):
+						hazards, S = model(x_path=data_WSI, x_omic=data_omic, x_weight=path_weights, bag_offsets=bag_offsets)
+					if patch_sampler is not None:
+						patch_sampler.update(loader.dataset, index.tolist(), model.last_attention[:offsets[-1]].detach().float().cpu().numpy(), offsets)
 				loss = loss_fn(hazards=hazards, S=S, Y=label, c=c)
+				if teacher_outputs is not None:
+					# the survival loss is mixed with the soft targets of the teacher
+					teacher = [teacher_outputs[str(loader.dataset.slide_data['case_id'][i])] for i in index.tolist()]
+					loss = (1 - distill_weight) * loss + distill_weight * distill_loss(hazards, torch.stack([t['hazards'] for t in teacher]).to(device))
+					if distill_attention:
+						loss = loss + distill_attention * attention_distill_loss(model.last_attention, [t['attention'].to(device) for t in teacher], offsets)
 			risk = -torch.sum(S, dim=1).detach().cpu().numpy()
 		
 		loss_value = loss.item()
@@ -268,45 +401,75 @@ def loop_survival(
 		else:
 			loss_reg = reg_fn(model) * lambda_reg
 
-		all_risk_scores[batch_idx] = risk
-		all_censorships[batch_idx] = c.item()
-		all_event_times[batch_idx] = event_time
+		risk = np.atleast_1d(risk)
+		bs = len(risk)
+		all_risk_scores[seen:seen+bs] = risk
+		all_censorships[seen:seen+bs] = c.cpu().numpy()
+		all_event_times[seen:seen+bs] = event_time.cpu().numpy()
+		seen += bs
 
 		if return_summary:
-			slide_id = slide_ids.iloc[batch_idx]
-			patient_results.update({
-				slide_id: {
-					'slide_id': np.array(slide_id), 
-					'risk': risk, 
-					'disc_label': label.item(), 
-					'survival': event_time.cpu().numpy(), 
-					'censorship': c.cpu().numpy(),
-					"hazards": np.squeeze(hazards.detach().cpu().numpy())
-			}})
-
-		loss_surv += loss_value
-		running_loss += loss_value + loss_reg
+			hazards_np = hazards.detach().reshape(bs, -1).cpu().numpy()
+			for j, idx in enumerate(index.tolist()):
+				slide_id = slide_ids.iloc[idx]
+				patient_results.update({
+					slide_id: {
+						'slide_id': np.array(slide_id), 
+						'risk': risk[j:j+1], 
+						'disc_label': label[j].item(), 
+						'survival': event_time[j:j+1].cpu().numpy(), 
+						'censorship': c[j:j+1].cpu().numpy(),
+						"hazards": hazards_np[j]
+				}})
+
+		loss_surv += loss_value * bs
+		running_loss += (loss_value + loss_reg) * bs
 
 		if (batch_idx + 1) % 100 == 0:
-			print('batch {}, loss: {:.4f}, label: {}, event_time: {:.4f}, risk: {:.4f}, bag_size: {}'.format(batch_idx, loss_value + loss_reg, label.item(), float(event_time), float(risk), data_WSI.size(0)))
+			print('batch {}, loss: {:.4f}, label: {}, event_time: {:.4f}, risk: {:.4f}, bag_size: {}'.format(batch_idx, loss_value + loss_reg, label[0].item(), float(event_time[0]), float(risk[0]), data_WSI.size(0)))
 		
 		if training:
-			# backward pass
-			loss = loss / gc + loss_reg
+			# backward pass, the batch counts as bs patients of the gradient accumulation, each with its regularization term
+			loss = loss * bs / gc + loss_reg * bs
 			loss.backward()
 
-			if (batch_idx + 1) % gc == 0: 
+			n_accum += bs
+			if n_accum >= gc: 
 				optimizer.step()
 				optimizer.zero_grad()
+				n_accum = 0
+		if bucket is not None:
+			bucket_times[bucket].append(timer() - step_start)
 
 	# calculate loss and error for epoch
-	loss_surv /= len(loader)
-	running_loss /= len(loader)
+	patches_per_s = n_patches / (timer() - start) if bag_lengths is not None else None
+	loss_surv /= seen
+	running_loss /= seen
 
 	c_index = concordance_index_censored((1-all_censorships).astype(bool), all_event_times, all_risk_scores, tied_tol=1e-08)[0]
 	if return_summary:
 		return patient_results, c_index
 	print('{} | epoch: {}, loss_surv: {:.4f}, loss: {:.4f}, c_index: {:.4f}\n'.format(split_name, epoch, loss_surv, running_loss, c_index))
+	if patches_per_s is not None:
+		print('{} | epoch: {}, patches/s: {:.0f}\n'.format(split_name, epoch, patches_per_s))
+	for bucket, times in sorted(bucket_times.items()):
+		# the first step of a bucket includes its compilation
+		step_time = np.median(times[1:]) if len(times) > 1 else times[0]
+		print('{} | epoch: {}, bucket {}: {} steps, {:.1f} ms/step\n'.format(split_name, epoch, bucket, len(times), step_time * 1e3))
+		if writer:
+			writer.add_scalar(f'{split_name}/ms_per_step_{bucket}', step_time * 1e3, epoch)
+	if buckets is not None:
+		stats = compile_stats()
+		print('{} | epoch: {}, compiled graphs: {graphs}, frames: {frames}, graph breaks: {graph_breaks}, graph cache hits: {cache_hits}, misses: {cache_misses}\n'.format(split_name, epoch, **stats))
+		if writer:
+			for k, v in stats.items():
+				writer.add_scalar(f'{split_name}/compile_{k}', v, epoch)
+	ot_iter = model.coattn.n_iter / model.coattn.n_solve if model_type == "motcat" and model.coattn.n_solve else None
+	if ot_iter is not None:
+		print('{} | epoch: {}, sinkhorn iterations per plan: {:.1f}\n'.format(split_name, epoch, ot_iter))
+	ot_saving = ot_cache.saving() if ot_cache is not None else None
+	if ot_saving is not None:
+		print('{} | epoch: {}, sinkhorn iterations saved by the warm start: {:.1%} ({} plans)\n'.format(split_name, epoch, ot_saving, ot_cache.warm_solve))
 	
 	if scheduler is not None:
 		last_lr = scheduler.get_last_lr()
@@ -317,6 +480,12 @@ def loop_survival(
 		writer.add_scalar(f'{split_name}/loss_surv', loss_surv, epoch)
 		writer.add_scalar(f'{split_name}/loss', running_loss, epoch)
 		writer.add_scalar(f'{split_name}/c_index', c_index, epoch)
+		if patches_per_s is not None:
+			writer.add_scalar(f'{split_name}/patches_per_s', patches_per_s, epoch)
+		if ot_iter is not None:
+			writer.add_scalar(f'{split_name}/ot_iter', ot_iter, epoch)
+		if ot_saving is not None:
+			writer.add_scalar(f'{split_name}/ot_saving', ot_saving, epoch)
 		if not training:
 			writer.add_scalar(f'{split_name}/lr', last_lr, epoch)
 
@@ -338,11 +507,26 @@ def loop_survival(
 	return False
 
 
-def split_chunk_list(data, batch_size):
-	numGroup = data.shape[0] // batch_size + 1
-	feat_index = list(range(data.shape[0]))
-	random.shuffle(feat_index)
-	index_chunk_list = np.array_split(np.array(feat_index), numGroup)
-	index_chunk_list = [sst.tolist() for sst in index_chunk_list]
-	return index_chunk_list
+def split_micro_batches(lengths, batch_size, shuffle=True, device=None):
+	"""
+	Splits each bag into len // batch_size + 1 micro-batches of near equal size (as np.array_split), 
+	of randomly drawn instances if shuffle, else of consecutive ones.
 
+	Returns:
+		bag_ids (LongTensor): Bag of each micro-batch (M)
+		instances (LongTensor): Indices of the instances of each micro-batch in its bag, -1 on the padding (M x L)
+	"""
+	bag_ids, instances = [], []
+	for b, n in enumerate(lengths):
+		num_chunks = n // batch_size + 1
+		order = torch.randperm(n, device=device) if shuffle else torch.arange(n, device=device)
+		sizes = torch.full((num_chunks,), n // num_chunks, device=device)
+		sizes[:n % num_chunks] += 1
+		pos = torch.arange(int(sizes[0]), device=device).unsqueeze(0)
+		valid = pos < sizes.unsqueeze(1)
+		pos = (torch.cumsum(sizes, 0) - sizes).unsqueeze(1) + pos
+		instances.append(torch.where(valid, order[pos.clamp(max=n-1)], -1))
+		bag_ids.append(torch.full((num_chunks,), b, device=device))
+	max_size = max(chunks.shape[1] for chunks in instances)
+	instances = torch.cat([torch.nn.functional.pad(chunks, (0, max_size - chunks.shape[1]), value=-1) for chunks in instances])
+	return torch.cat(bag_ids), instances
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+from mmsurv.utils.utils import BucketBatchSampler, attention_distill_loss, distill_loss, get_bucket
+
+
+def padding(lengths, batch):
+	return 1 - sum(lengths[i] for i in batch) / (max(lengths[i] for i in batch) * len(batch))
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_bucket_batch_sampler(shuffle):
+	torch.manual_seed(0)
+	lengths = np.random.default_rng(0).integers(1, 5000, 237)
+	sampler = BucketBatchSampler(lengths, batch_size=8, shuffle=shuffle, max_padding=0.25, pool_size=4)
+	batches = list(sampler)
+	# every patient once, in batches of at most batch_size and max_padding
+	assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+	assert all(len(batch) <= 8 and padding(lengths, batch) <= 0.25 for batch in batches)
+	assert len(sampler) == len(batches)
+	if not shuffle:
+		# in order, sorted by length within each pool of pool_size batches
+		for start in range(0, len(lengths), 32):
+			pool = [i for batch in batches for i in batch if start <= i < start + 32]
+			assert sorted(pool) == list(range(start, min(start + 32, len(lengths))))
+			assert list(lengths[pool]) == sorted(lengths[start:start+32])
+
+
+def test_bucket_batch_sampler_weighted():
+	torch.manual_seed(0)
+	lengths = np.arange(1, 101)
+	weights = torch.zeros(100)
+	weights[:10] = 1
+	batches = list(BucketBatchSampler(lengths, batch_size=4, weights=weights, max_padding=1.))
+	# as many draws as patients, with replacement, from the weighted ones only
+	drawn = [i for batch in batches for i in batch]
+	assert len(drawn) == 100 and set(drawn) <= set(range(10))
+	assert all(len(batch) == 4 for batch in batches)
+
+
+def test_get_bucket():
+	assert [get_bucket(n) for n in [1, 512, 513, 3000]] == [512, 512, 1024, 4096]
+	buckets = [512, 1024, 2048]
+	# beyond the largest bucket, multiples of it
+	assert [get_bucket(n, buckets) for n in [100, 1024, 1025, 2049, 4097]] == [512, 1024, 2048, 4096, 6144]
+
+
+def test_distill_losses():
+	torch.manual_seed(0)
+	hazards, teacher_hazards = torch.rand(3, 4), torch.rand(3, 4)
+	expected = F.binary_cross_entropy(hazards, teacher_hazards, reduction='none').sum(dim=1).mean()
+	torch.testing.assert_close(distill_loss(hazards, teacher_hazards), expected)
+
+	# the attention of a bag is matched to the teacher's over the same instances, 0 when they agree
+	bag_offsets = [0, 5, 12]
+	teacher_attention = [F.softmax(torch.randn(5), dim=0), F.softmax(torch.randn(7), dim=0)]
+	logits = torch.cat([torch.log(attention) + 3. for attention in teacher_attention])
+	torch.testing.assert_close(attention_distill_loss(logits, teacher_attention, bag_offsets), torch.tensor(0.), atol=1e-6, rtol=0)
+	logits = torch.randn(12)
+	expected = sum(F.kl_div(F.log_softmax(logits[start:end], dim=0), attention, reduction='sum') for start, end, attention in zip(bag_offsets[:-1], bag_offsets[1:], teacher_attention)) / 2
+	torch.testing.assert_close(attention_distill_loss(logits, teacher_attention, bag_offsets), expected)
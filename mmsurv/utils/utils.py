@@ -3,12 +3,16 @@ import math
 import pandas as pd
 from itertools import islice, chain
 import collections
+from functools import partial
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.utils.data import DataLoader, Sampler, WeightedRandomSampler, RandomSampler, SequentialSampler, sampler
 import torch.optim as optim
 device=torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# cores available to the process at start, before any pinning
+cpu_cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
 
 def get_data(args):
 	df = pd.read_csv(args.csv_path, compression="zip" if ".zip" in args.csv_path else None)
@@ -57,6 +61,64 @@ class SubsetSequentialSampler(Sampler):
 	def __len__(self):
 		return len(self.indices)
 
+class BucketBatchSampler(Sampler):
+	"""Batches patients of similar bag length, so that padding a batch wastes little compute.
+
+	Patients are drawn like WeightedRandomSampler (weights), RandomSampler (shuffle) or in order,
+	sorted by bag length within pools of pool_size batches, and cut into batches whose padded
+	fraction stays below max_padding.
+
+	Arguments:
+		lengths (sequence): bag length of each patient
+		batch_size (int): maximum number of patients per batch
+		weights (torch.Tensor): sampling weights, drawn with replacement
+		shuffle (bool): random order of the patients and of the batches
+		max_padding (float): maximum fraction of padded instances in a batch
+		pool_size (int): number of batches sorted together
+	"""
+	def __init__(self, lengths, batch_size, weights=None, shuffle=True, max_padding=0.25, pool_size=50):
+		self.lengths = np.asarray(lengths)
+		self.batch_size = batch_size
+		self.weights = weights
+		self.shuffle = shuffle
+		self.max_padding = max_padding
+		self.pool_size = pool_size
+		self.num_batches = None
+
+	def __iter__(self):
+		n = len(self.lengths)
+		if self.weights is not None:
+			order = torch.multinomial(self.weights, n, replacement=True).tolist()
+		elif self.shuffle:
+			order = torch.randperm(n).tolist()
+		else:
+			order = list(range(n))
+
+		batches = []
+		pool = self.batch_size * self.pool_size
+		for start in range(0, n, pool):
+			batch, total = [], 0
+			for idx in sorted(order[start:start+pool], key=lambda i: self.lengths[i]):
+				length = self.lengths[idx]
+				padding = 1 - (total + length) / max(length * (len(batch) + 1), 1)
+				if batch and (len(batch) == self.batch_size or padding > self.max_padding):
+					batches.append(batch)
+					batch, total = [], 0
+				batch.append(idx)
+				total += length
+			batches.append(batch)
+
+		if self.shuffle or self.weights is not None:
+			batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+		self.num_batches = len(batches)
+		return iter(batches)
+
+	def __len__(self):
+		# exact once the first epoch has been drawn
+		if self.num_batches is None:
+			return math.ceil(len(self.lengths) / self.batch_size)
+		return self.num_batches
+
 def collate_MIL(batch):
 	img = torch.cat([item[0] for item in batch], dim = 0)
 	label = torch.LongTensor([item[1] for item in batch])
@@ -69,11 +131,13 @@ def collate_features(batch):
 
 def collate_MIL_survival(batch):
 	img = torch.cat([item[0] for item in batch], dim = 0)
-	omic = torch.cat([item[1] for item in batch], dim = 0).type(torch.FloatTensor)
+	omic = torch.stack([item[1] for item in batch], dim = 0).type(torch.FloatTensor)
 	label = torch.LongTensor(np.array([item[2] for item in batch]))
 	event_time = torch.FloatTensor([item[3] for item in batch])
 	c = torch.FloatTensor([item[4] for item in batch])
-	return [img, omic, label, event_time, c]
+	bag_offsets = torch.LongTensor(np.cumsum([0] + [item[0].shape[0] for item in batch]))
+	index = torch.LongTensor([item[5] for item in batch])
+	return [img, omic, label, event_time, c, bag_offsets, index]
 
 def collate_MIL_survival_cluster(batch):
 	img = torch.cat([item[1] for item in batch], dim = 0)
@@ -82,28 +146,93 @@ def collate_MIL_survival_cluster(batch):
 	label = torch.LongTensor(np.array([item[3] for item in batch]))
 	event_time = torch.FloatTensor([item[4] for item in batch])
 	c = torch.FloatTensor([item[5] for item in batch])
-	return [cluster_ids, img, omic, label, event_time, c]
+	index = torch.LongTensor([item[6] for item in batch])
+	return [cluster_ids, img, omic, label, event_time, c, index]
 
 def collate_MIL_survival_sig(batch):
-	img = torch.cat([item[0] for item in batch], dim = 0)
-	omic1 = torch.cat([item[1] for item in batch], dim = 0).type(torch.FloatTensor)
-	omic2 = torch.cat([item[2] for item in batch], dim = 0).type(torch.FloatTensor)
-	omic3 = torch.cat([item[3] for item in batch], dim = 0).type(torch.FloatTensor)
-	omic4 = torch.cat([item[4] for item in batch], dim = 0).type(torch.FloatTensor)
-	omic5 = torch.cat([item[5] for item in batch], dim = 0).type(torch.FloatTensor)
-	omic6 = torch.cat([item[6] for item in batch], dim = 0).type(torch.FloatTensor)
-
-	label = torch.LongTensor(np.array([item[7] for item in batch]))
-	event_time = torch.FloatTensor([item[8] for item in batch])
-	c = torch.FloatTensor([item[9] for item in batch])
-	return [img, omic1, omic2, omic3, omic4, omic5, omic6, label, event_time, c]
+	# bags are padded to the longest one of the batch, mask is True on the padded instances
+	img = torch.nn.utils.rnn.pad_sequence([item[0] for item in batch], batch_first=True)
+	lengths = torch.LongTensor([item[0].shape[0] for item in batch])
+	mask = torch.arange(img.shape[1]).unsqueeze(0) >= lengths.unsqueeze(1)
+	# one tensor per signature, between the bag and the label
+	omics = [torch.stack(sig_feats, dim = 0).type(torch.FloatTensor) for sig_feats in zip(*[item[1:-4] for item in batch])]
+
+	label = torch.LongTensor(np.array([item[-4] for item in batch]))
+	event_time = torch.FloatTensor([item[-3] for item in batch])
+	c = torch.FloatTensor([item[-2] for item in batch])
+	index = torch.LongTensor([item[-1] for item in batch])
+	return [img, *omics, label, event_time, c, mask, index]
 
 def get_simple_loader(dataset, batch_size=1):
 	kwargs = {'num_workers': 4} if device.type == "cuda" else {}
 	loader = DataLoader(dataset, batch_size=batch_size, sampler = sampler.SequentialSampler(dataset), collate_fn = collate_MIL, **kwargs)
 	return loader 
 
-def get_split_loader(split_dataset, training = False, testing = False, weighted = False, mode='coattn', batch_size=1):
+def set_execution_profile(args):
+	"""
+		sets the threads of torch and the number of loader workers, with args.pin_workers the last cores of the process 
+		are left to the workers and the compute threads are pinned to the others. Returns the cores of the workers.
+	"""
+	if args.num_workers < 0:
+		args.num_workers = 4 if device.type == "cuda" else 0
+	worker_cores = []
+	if args.pin_workers and 0 < args.num_workers < len(cpu_cores):
+		worker_cores = cpu_cores[-args.num_workers:]
+		compute_cores = cpu_cores[:-args.num_workers]
+		os.sched_setaffinity(0, compute_cores)
+		if not args.num_threads:
+			torch.set_num_threads(len(compute_cores))
+	if args.num_threads:
+		torch.set_num_threads(args.num_threads)
+	if args.num_interop_threads:
+		try:
+			torch.set_num_interop_threads(args.num_interop_threads)
+		except RuntimeError:
+			# only possible before the first inter-op parallel work of the process
+			print("Inter-op threads already set to %d" % torch.get_num_interop_threads())
+	print("Threads: %d intra-op, %d inter-op, %d loader workers" % (torch.get_num_threads(), torch.get_num_interop_threads(), args.num_workers))
+	return worker_cores
+
+def pin_worker(worker_cores, worker_id):
+	"""
+		worker_init_fn pinning a loader worker to a single core of worker_cores
+	"""
+	os.sched_setaffinity(0, [worker_cores[worker_id % len(worker_cores)]])
+	torch.set_num_threads(1)
+
+def get_bucket(n, buckets=None):
+	"""
+		bag length n is padded to, the smallest of the sorted buckets >= n (powers of two from 512 if None), 
+		a multiple of the largest one beyond it
+	"""
+	if not buckets:
+		return max(512, 1 << (n - 1).bit_length())
+	for bucket in buckets:
+		if bucket >= n:
+			return bucket
+	return -(-n // buckets[-1]) * buckets[-1]
+
+def compile_stats():
+	"""
+		counters of the compiled graphs of the process (torch.compile)
+	"""
+	from torch._dynamo.utils import counters
+	return {
+		'graphs': counters['stats']['unique_graphs'], 
+		'frames': counters['frames']['total'], 
+		'graph_breaks': sum(counters['graph_break'].values()), 
+		'cache_hits': counters['inductor']['fxgraph_cache_hit'], 
+		'cache_misses': counters['inductor']['fxgraph_cache_miss']
+	}
+
+def get_autocast(precision='fp32'):
+	"""
+		autocast context of the forward passes, bf16 runs the matmuls in bfloat16. The survival head, the losses,
+		the Sinkhorn solves and the Moore-Penrose iterations stay in float32 whatever the precision.
+	"""
+	return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+def get_split_loader(split_dataset, training = False, testing = False, weighted = False, mode='coattn', batch_size=1, max_padding=0.25, num_workers=-1, worker_cores=None):
 	"""
 		return either the validation loader or training loader 
 	"""
@@ -114,8 +243,17 @@ def get_split_loader(split_dataset, training = False, testing = False, weighted
 	else:
 		collate = collate_MIL_survival
 	
-	kwargs = {'num_workers': 4} if device.type == "cuda" else {}
-	if not testing:
+	if num_workers < 0:
+		num_workers = 4 if device.type == "cuda" else 0
+	kwargs = {'num_workers': num_workers}
+	if num_workers > 0 and worker_cores:
+		kwargs['worker_init_fn'] = partial(pin_worker, worker_cores)
+	if mode == 'coattn' and batch_size > 1 and not testing:
+		# padded batches of the co-attention models are bucketed by bag length
+		weights = make_weights_for_balanced_classes_split(split_dataset) if training and weighted else None
+		batch_sampler = BucketBatchSampler(split_dataset.get_bag_lengths(), batch_size, weights=weights, shuffle=training, max_padding=max_padding)
+		loader = DataLoader(split_dataset, batch_sampler=batch_sampler, collate_fn = collate, **kwargs)
+	elif not testing:
 		if training:
 			if weighted:
 				weights = make_weights_for_balanced_classes_split(split_dataset)
@@ -353,6 +491,24 @@ class NLLSurvLoss(object):
 	#reg = - (1 - c) * (torch.log(torch.gather(hazards, 1, Y)) + torch.gather(torch.cumsum(torch.log(1-h_padded), dim=1), 1, Y))
 
 
+def distill_loss(hazards, teacher_hazards, eps=1e-7):
+	r"""
+	Binary cross-entropy of the hazards of each time interval against the hazards of a teacher, summed over the intervals
+	"""
+	hazards = hazards.float().clamp(min=eps, max=1-eps)
+	return -(teacher_hazards * torch.log(hazards) + (1 - teacher_hazards) * torch.log(1 - hazards)).sum(dim=1).mean()
+
+def attention_distill_loss(logits, teacher_attention, bag_offsets):
+	r"""
+	KL divergence of the attention of each bag (logits of the concatenated instances, split by bag_offsets) to the attention of a teacher over the same instances
+	"""
+	loss = 0.
+	for b, attention in enumerate(teacher_attention):
+		log_attention = F.log_softmax(logits[bag_offsets[b]:bag_offsets[b+1]].float(), dim=0)
+		loss += F.kl_div(log_attention, attention.float(), reduction='sum')
+	return loss / len(teacher_attention)
+
+
 class CoxSurvLoss(object):
 	def __call__(hazards, S, c, **kwargs):
 		# This calculation credit to Travers Ching https://github.com/traversc/cox-nnet
@@ -401,15 +557,17 @@ def check_directories(args):
 	feat_extractor = None
 	if args.feats_dir:
 		feat_extractor = args.feats_dir.split('/')[-1] if len(args.feats_dir.split('/')[-1]) > 0 else args.feats_dir.split('/')[-2]
-		if feat_extractor == "RESNET50":
+		# derived feature stores (e.g. UNI_coreset, UNI_regions4) keep the dimension of their extractor
+		feat_name = feat_extractor.split('_')[0] if feat_extractor.endswith("_coreset") or "_regions" in feat_extractor else feat_extractor
+		if feat_name == "RESNET50":
 			args.path_input_dim = 2048 
-		elif feat_extractor in ["PLIP", "CONCH"]:
+		elif feat_name in ["PLIP", "CONCH"]:
 			args.path_input_dim = 512 
-		elif feat_extractor in ["UNI", "SSL2"]:
+		elif feat_name in ["UNI", "SSL2"]:
 			args.path_input_dim = 1024
-		elif feat_extractor == "HOPT":
+		elif feat_name == "HOPT":
 			args.path_input_dim = 1536
-		elif feat_extractor == "VIRCHOW":
+		elif feat_name == "VIRCHOW":
 			args.path_input_dim = 2560
 		else:
 			args.path_input_dim = 768